@@ -1,16 +1,18 @@
+import asyncio
 import logging
 import os
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.prebuilt import create_react_agent
 
-from llm.connection_manager import get_checkpointer
+from llm.connection_manager import aget_checkpointer, get_checkpointer
 from llm.prompt import system_message
-from llm.tools import initialize_tools
-from llm.utils import cleanup_old_tool_results, get_tool_result
+from llm.storage import image_key, image_variant_key, presign_get_url, presign_get_urls
+from llm.tools import IMAGE_TOOL_NAMES, initialize_tools
+from llm.utils import cleanup_old_tool_results, get_latest_tool_result
 
 load_dotenv()
 
@@ -18,37 +20,61 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global agent instance
+# Global agent instance, and the checkpointer it was built with
 _agent_executor = None
+_agent_checkpointer = None
+# Global agent instance for the async path, and the checkpointer it was built with
+_async_agent_executor = None
+_async_agent_checkpointer = None
 # Counter for periodic cleanup
 _request_count = 0
 
 
+def _build_agent(checkpointer):
+    """Build a ReAct agent backed by the given checkpointer."""
+    # Build LLM
+    print("[AGENT] building LLM")
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+
+    # Build tools
+    print("[AGENT] initializing tools")
+    tools = initialize_tools()
+
+    print("[AGENT] creating agent")
+    return create_react_agent(
+        llm,
+        tools=tools,
+        prompt=system_message,
+        checkpointer=checkpointer,
+    )
+
+
 def _get_agent():
     """Get or create the agent instance."""
-    global _agent_executor
-
-    if _agent_executor is None:
-        # Build LLM
-        print("[AGENT] building LLM")
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
-
-        # Build tools
-        print("[AGENT] initializing tools")
-        tools = initialize_tools()
-
-        # Create agent with fresh checkpointer
-        print("[AGENT] creating agent")
-        _agent_executor = create_react_agent(
-            llm,
-            tools=tools,
-            prompt=system_message,
-            checkpointer=get_checkpointer(),
-        )
+    global _agent_executor, _agent_checkpointer
+
+    # The checkpointer is swapped on reconnect, so rebuild the agent when it changes
+    checkpointer = get_checkpointer()
+    if _agent_executor is None or _agent_checkpointer is not checkpointer:
+        _agent_executor = _build_agent(checkpointer)
+        _agent_checkpointer = checkpointer
 
     return _agent_executor
 
 
+async def _aget_agent():
+    """Get or create the agent instance used by the async path."""
+    global _async_agent_executor, _async_agent_checkpointer
+
+    # Rebuild the agent if the checkpointer was recreated (e.g. on a new event loop)
+    checkpointer = await aget_checkpointer()
+    if _async_agent_executor is None or _async_agent_checkpointer is not checkpointer:
+        _async_agent_executor = _build_agent(checkpointer)
+        _async_agent_checkpointer = checkpointer
+
+    return _async_agent_executor
+
+
 def _build_message_with_context(message: str, selected_images: Optional[List[dict]], user_id: str) -> str:
     """Build the full message with image context if provided."""
     if not selected_images or len(selected_images) == 0:
@@ -92,31 +118,27 @@ def _extract_agent_response(response) -> str:
     return "I'm sorry, I couldn't process your request. Please try again."
 
 
-def _generate_presigned_url(user_id: str, image_id: str) -> Optional[str]:
-    """Generate a presigned URL for an image."""
-    import boto3
-
-    s3_client = boto3.client(
-        "s3",
-        region_name=os.environ.get("AWS_REGION", "us-east-1"),
-        aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    )
+def _chunk_text(content: Any) -> str:
+    """Extract the text from a streamed model chunk, whose content may be a string or a list of parts."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content if isinstance(part, (str, dict)))
+    return ""
+
 
+def _generate_presigned_url(user_id: str, image_id: str) -> Optional[str]:
+    """Generate a presigned URL for an image, reusing a cached one while it is fresh."""
     bucket_name = os.environ.get("AWS_S3_BUCKET_NAME")
     if not bucket_name:
         print("[AGENT] AWS_S3_BUCKET_NAME not set")
         return None
 
     try:
-        s3_key = f"users/{user_id}/images/{image_id}"
+        s3_key = image_key(user_id, image_id)
         print(f"[AGENT] Generating presigned URL for S3 key: {s3_key}")
 
-        presigned_url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": s3_key},
-            ExpiresIn=7200,  # 2 hours
-        )
+        presigned_url = presign_get_url(bucket_name, s3_key)
         print(f"[AGENT] Generated presigned URL: {presigned_url[:50]}...")
         return presigned_url
 
@@ -125,6 +147,22 @@ def _generate_presigned_url(user_id: str, image_id: str) -> Optional[str]:
         return None
 
 
+def _generate_variant_urls(user_id: str, image_id: str, variants: List[str]) -> Dict[str, str]:
+    """Presign the stored variants of an image, keyed by variant name."""
+    bucket_name = os.environ.get("AWS_S3_BUCKET_NAME")
+    if not bucket_name or not variants:
+        return {}
+
+    try:
+        keys = {name: image_variant_key(user_id, image_id, name) for name in variants}
+        urls = presign_get_urls(bucket_name, list(keys.values()))
+        return {name: urls[key] for name, key in keys.items()}
+
+    except Exception as e:
+        print(f"[AGENT] Error generating variant URLs: {e}")
+        return {}
+
+
 def _process_generated_image(user_id: str, tool_result: dict) -> Optional[dict]:
     """Process a generated image tool result and return image data."""
     image_id = tool_result.get("image_id")
@@ -147,9 +185,10 @@ def _process_generated_image(user_id: str, tool_result: dict) -> Optional[dict]:
         "id": image_id,
         "url": presigned_url,
         "title": title,
-        "description": f"AI-generated image: {prompt}",
+        "description": tool_result.get("description") or f"AI-generated image: {prompt}",
         "timestamp": datetime.now().isoformat(),
         "type": "generated",
+        "variants": _generate_variant_urls(user_id, image_id, tool_result.get("variants") or []),
     }
 
     print(f"[AGENT] Created generated_image_data: {generated_image_data}")
@@ -159,7 +198,10 @@ def _process_generated_image(user_id: str, tool_result: dict) -> Optional[dict]:
 def _process_tool_results(user_id: str) -> Optional[dict]:
     """Process any tool results for the user and return generated image data if found."""
     print(f"[AGENT] Checking for tool results for user {user_id}")
-    tool_result = get_tool_result(user_id, "generate_image")
+    # A turn returns one image: the newest, e.g. the edit of an image generated earlier in the turn
+    tool_result, kept = get_latest_tool_result(user_id, IMAGE_TOOL_NAMES)
+    if kept:
+        print(f"[AGENT] Turn produced several images, keeping the {', '.join(kept)} result for the next turn")
 
     if tool_result:
         print(f"[AGENT] Found tool result: {tool_result}")
@@ -170,6 +212,26 @@ def _process_tool_results(user_id: str) -> Optional[dict]:
     return None
 
 
+def _prepare_agent_input(message: str, client_ip: str, user_id: str, selected_images: Optional[List[dict]]) -> tuple[dict, dict]:
+    """Run periodic cleanup and build the agent input and config for one chat turn."""
+    global _request_count
+
+    # Periodic cleanup every 10 requests
+    _request_count += 1
+    if _request_count % 10 == 0:
+        print(f"[AGENT] Running periodic cleanup (request #{_request_count})")
+        cleanup_old_tool_results()
+
+    # Prepare the message with context
+    print("[AGENT] building message with context")
+    full_message = _build_message_with_context(message, selected_images, user_id)
+
+    # Configure thread ID for conversation continuity
+    config = {"configurable": {"thread_id": user_id, "client_ip": client_ip}}
+
+    return {"messages": [{"role": "user", "content": full_message}]}, config
+
+
 def chat_with_agent(
     message: str,
     client_ip: str,
@@ -187,27 +249,13 @@ def chat_with_agent(
     Returns:
         Tuple of (agent_response, generated_image_data)
     """
-    global _request_count
-
-    # Periodic cleanup every 10 requests
-    _request_count += 1
-    if _request_count % 10 == 0:
-        print(f"[AGENT] Running periodic cleanup (request #{_request_count})")
-        cleanup_old_tool_results()
-
     print(f"[AGENT] Starting chat_with_agent - user_id: {user_id}, message: {message[:100]}...")
     agent = _get_agent()
-
-    # Prepare the message with context
-    print("[AGENT] building message with context")
-    full_message = _build_message_with_context(message, selected_images, user_id)
-
-    # Configure thread ID for conversation continuity
-    config = {"configurable": {"thread_id": user_id, "client_ip": client_ip}}
+    agent_input, config = _prepare_agent_input(message, client_ip, user_id, selected_images)
 
     # Get response from agent
     print(f"[AGENT] Invoking agent with config: {config}")
-    response = agent.invoke({"messages": [{"role": "user", "content": full_message}]}, config=config)
+    response = agent.invoke(agent_input, config=config)
     print(f"[AGENT] Agent response received: {type(response)}")
 
     # Extract the agent's response
@@ -221,6 +269,93 @@ def chat_with_agent(
     return agent_response, generated_image_data
 
 
+async def achat_with_agent(
+    message: str,
+    client_ip: str,
+    user_id: str = "default",
+    selected_images: Optional[List[dict]] = None,
+) -> tuple[str, Optional[dict]]:
+    """
+    Async version of chat_with_agent that never blocks the event loop.
+
+    Args:
+        message: The user's message
+        user_id: Unique identifier for the user/thread
+        selected_images: List of selected image objects (optional)
+        client_ip: IP address of the client
+    Returns:
+        Tuple of (agent_response, generated_image_data)
+    """
+    print(f"[AGENT] Starting achat_with_agent - user_id: {user_id}, message: {message[:100]}...")
+    agent = await _aget_agent()
+    agent_input, config = _prepare_agent_input(message, client_ip, user_id, selected_images)
+
+    # Get response from agent
+    print(f"[AGENT] Invoking agent asynchronously with config: {config}")
+    response = await agent.ainvoke(agent_input, config=config)
+    print(f"[AGENT] Agent response received: {type(response)}")
+
+    # Extract the agent's response
+    agent_response = _extract_agent_response(response)
+    print(f"[AGENT] Extracted agent response: {agent_response[:100]}...")
+
+    # Presigning may create the shared S3 client on first use, so keep it off the event loop
+    generated_image_data = await asyncio.to_thread(_process_tool_results, user_id)
+
+    print(f"[AGENT] Returning response - agent_response length: {len(agent_response)}, generated_image_data: {generated_image_data is not None}")
+    return agent_response, generated_image_data
+
+
+async def astream_chat_with_agent(
+    message: str,
+    client_ip: str,
+    user_id: str = "default",
+    selected_images: Optional[List[dict]] = None,
+) -> AsyncIterator[dict]:
+    """
+    Stream a chat turn as events while the agent runs.
+
+    Args:
+        message: The user's message
+        user_id: Unique identifier for the user/thread
+        selected_images: List of selected image objects (optional)
+        client_ip: IP address of the client
+    Yields:
+        Dicts with "event" and "data" keys. "token" events carry model text as it
+        arrives, "generation_started", "generation_progress" and "generation_finished"
+        track the generate_image and edit_image tools, and a final "done" event carries the
+        agent_response and generated_image_data that chat_with_agent would return.
+    """
+    print(f"[AGENT] Starting astream_chat_with_agent - user_id: {user_id}, message: {message[:100]}...")
+    agent = await _aget_agent()
+    agent_input, config = _prepare_agent_input(message, client_ip, user_id, selected_images)
+
+    final_state = None
+    async for event in agent.astream_events(agent_input, config=config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream":
+            text = _chunk_text(event["data"]["chunk"].content)
+            if text:
+                yield {"event": "token", "data": {"text": text}}
+        elif kind == "on_tool_start" and event["name"] in IMAGE_TOOL_NAMES:
+            tool_input = event["data"].get("input") or {}
+            yield {"event": "generation_started", "data": {"title": tool_input.get("title", "Generated Image")}}
+        elif kind == "on_custom_event" and event["name"] == "generation_progress":
+            yield {"event": "generation_progress", "data": event["data"]}
+        elif kind == "on_tool_end" and event["name"] in IMAGE_TOOL_NAMES:
+            output = event["data"].get("output")
+            yield {"event": "generation_finished", "data": {"result": str(getattr(output, "content", output))}}
+        elif kind == "on_chain_end" and not event.get("parent_ids"):
+            # The root graph run ends last and carries the final state
+            final_state = event["data"].get("output")
+
+    agent_response = _extract_agent_response(final_state)
+    generated_image_data = await asyncio.to_thread(_process_tool_results, user_id)
+
+    print(f"[AGENT] Finished streaming - agent_response length: {len(agent_response)}, generated_image_data: {generated_image_data is not None}")
+    yield {"event": "done", "data": {"agent_response": agent_response, "generated_image_data": generated_image_data}}
+
+
 if __name__ == "__main__":
     # Test the agent
     response = chat_with_agent("Hello! How can you help me with image editing?", "127.0.0.1")
@@ -2,32 +2,68 @@
 Database connection manager for robust Neon free tier handling.
 
 This module provides thread-safe database connection management with automatic
-reconnection, health monitoring, and background refresh capabilities.
+reconnection, health monitoring, and background refresh capabilities. Connections
+come from a psycopg_pool pool that is shared by the checkpointer and the
+rate-limit queries in llm/utils.py.
 """
 
+import asyncio
 import atexit
 import logging
 import os
 import threading
 import time
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Set
 
 from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+from llm.schema import bootstrap_schema
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 # Global connection state
 _checkpointer = None
+_pool = None
 _checkpointer_lock = threading.Lock()
-_last_connection_time = 0
-_connection_timeout = 300  # 5 minutes - Neon free tier timeout
 _refresh_interval = 240  # 4 minutes - refresh before timeout
 _refresh_thread = None
 _refresh_stop_event = threading.Event()
 
-
-def _create_checkpointer():
-    """Create a new PostgresSaver instance with optimized connection settings."""
+# Pool sizing, overridable through the environment
+_pool_min_size = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+_pool_max_size = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+_pool_max_idle = float(os.environ.get("DB_POOL_MAX_IDLE", "120"))  # close surplus idle connections after 2 minutes
+_pool_max_lifetime = float(os.environ.get("DB_POOL_MAX_LIFETIME", "240"))  # recycle before Neon's 5 minute cutoff
+_pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", "30"))  # max wait for a free connection
+# Connection settings required by PostgresSaver and AsyncPostgresSaver
+_connection_kwargs: Dict[str, Any] = {"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row}
+
+# Lazy validation: a pooled connection is only probed after sitting idle this long
+_idle_check_threshold = float(os.environ.get("DB_IDLE_CHECK_SECONDS", "30"))
+_connection_last_used: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_stats_lock = threading.Lock()
+_connection_stats = {"probes_run": 0, "probes_avoided": 0, "probe_failures": 0, "standby_swaps": 0}
+
+# Hot-standby reconnection: replaced pools keep serving in-flight requests for a grace period
+_retired_pool_grace_period = 30
+_retired_pools: Set[ConnectionPool] = set()
+_standby_lock = threading.Lock()
+
+# Async connection state, bound to the event loop that created it
+_async_checkpointer = None
+_async_pool = None
+_async_checkpointer_lock = None
+_async_checkpointer_loop = None
+
+
+def _get_database_url():
+    """Build the database URL with keepalive settings tuned for the Neon free tier."""
     url = os.environ.get("DATABASE_URL")
     if not url:
         raise RuntimeError("DATABASE_URL is not set. Point it to your Neon connection string.")
@@ -53,13 +89,94 @@ def _create_checkpointer():
         if "keepalives_idle=10" not in url:
             logger.warning("Database URL already has keepalive settings, but they may not be optimized for Neon free tier")
 
-    logger.info("Creating new database connection with optimized settings")
-    cm = PostgresSaver.from_conn_string(url)
-    saver = cm.__enter__()  # enter the context manager once
-    atexit.register(lambda: cm.__exit__(None, None, None))  # clean shutdown
-    saver.setup()  # create tables on first run; no-op afterward
+    return url
+
+
+def _record_probe(outcome):
+    """Increment one of the connection probe counters."""
+    with _stats_lock:
+        _connection_stats[outcome] += 1
 
-    return saver
+
+def _mark_connection_used(conn):
+    """Pool configure/reset callback: remember when the connection last did real work."""
+    _connection_last_used[conn] = time.monotonic()
+
+
+def _needs_probe(conn):
+    """Return True if the connection sat idle long enough that it may have been dropped."""
+    last_used = _connection_last_used.get(conn)
+    if last_used is None or time.monotonic() - last_used > _idle_check_threshold:
+        _record_probe("probes_run")
+        return True
+    _record_probe("probes_avoided")
+    return False
+
+
+def _check_connection(conn):
+    """
+    Pool check callback, run on checkout outside of any module lock.
+
+    Recently used connections are handed out as-is; a real query that fails on a
+    dead connection leaves it broken, and the pool replaces it on return.
+    """
+    if not _needs_probe(conn):
+        return
+    try:
+        conn.execute("SELECT 1")
+    except Exception:
+        _record_probe("probe_failures")
+        raise
+
+
+async def _amark_connection_used(conn):
+    """Async pool configure/reset callback, see _mark_connection_used."""
+    _mark_connection_used(conn)
+
+
+async def _acheck_connection(conn):
+    """Async pool check callback, see _check_connection."""
+    if not _needs_probe(conn):
+        return
+    try:
+        await conn.execute("SELECT 1")
+    except Exception:
+        _record_probe("probe_failures")
+        raise
+
+
+def _pool_settings():
+    """Return the keyword arguments shared by the sync and async connection pools."""
+    return {
+        "min_size": _pool_min_size,
+        "max_size": _pool_max_size,
+        "max_idle": _pool_max_idle,
+        "max_lifetime": _pool_max_lifetime,
+        "timeout": _pool_timeout,
+        "kwargs": _connection_kwargs,
+    }
+
+
+def _create_checkpointer():
+    """Create a new PostgresSaver instance and the connection pool that backs it."""
+    url = _get_database_url()
+
+    logger.info(f"Creating new database connection pool (min={_pool_min_size}, max={_pool_max_size})")
+    pool = ConnectionPool(
+        url,
+        open=False,
+        name="img_edit_agent",
+        configure=_mark_connection_used,
+        check=_check_connection,
+        reset=_mark_connection_used,
+        **_pool_settings(),
+    )
+    pool.open(wait=True, timeout=_pool_timeout)
+    if os.environ.get("DB_SKIP_SCHEMA_BOOTSTRAP") != "1":
+        bootstrap_schema(pool)  # applies pending migrations once per process; reconnects skip it
+    saver = PostgresSaver(pool)
+
+    return pool, saver
 
 
 def _test_connection(checkpointer):
@@ -74,9 +191,65 @@ def _test_connection(checkpointer):
         return False
 
 
+def _close_pool(pool):
+    """Close a connection pool, logging instead of raising on failure."""
+    try:
+        pool.close()
+    except Exception as e:
+        logger.warning(f"Error closing database connection pool: {e}")
+
+
+def _close_retired_pool(pool):
+    """Close a retired pool at the end of its grace period, unless shutdown already closed it."""
+    with _checkpointer_lock:
+        if pool not in _retired_pools:
+            return
+        _retired_pools.discard(pool)
+    _close_pool(pool)
+
+
+def _retire_pool(pool):
+    """Close a replaced pool after a grace period so in-flight requests can finish on it."""
+    with _checkpointer_lock:
+        _retired_pools.add(pool)
+    timer = threading.Timer(_retired_pool_grace_period, _close_retired_pool, args=(pool,))
+    timer.daemon = True
+    timer.start()
+
+
+def _swap_in_standby():
+    """
+    Build a replacement pool and checkpointer, then swap them in atomically.
+
+    The slow part (TLS handshake and saver.setup()) runs without holding
+    _checkpointer_lock, so requests keep using the old handle until the new one
+    is ready. Concurrent callers share a single rebuild.
+    """
+    global _checkpointer, _pool
+
+    if not _standby_lock.acquire(blocking=False):
+        logger.info("Standby connection is already being built")
+        return
+
+    try:
+        new_pool, new_checkpointer = _create_checkpointer()
+
+        with _checkpointer_lock:
+            old_pool = _pool
+            _pool, _checkpointer = new_pool, new_checkpointer
+
+        with _stats_lock:
+            _connection_stats["standby_swaps"] += 1
+        logger.info("Swapped in standby database connection pool")
+
+        if old_pool is not None:
+            _retire_pool(old_pool)
+    finally:
+        _standby_lock.release()
+
+
 def _connection_refresh_worker():
     """Background worker to periodically refresh database connection."""
-    global _checkpointer, _last_connection_time
     logger.info("Starting database connection refresh worker")
     while not _refresh_stop_event.is_set():
         try:
@@ -85,16 +258,14 @@ def _connection_refresh_worker():
                 break
 
             logger.info("Performing periodic database connection refresh")
-            with _checkpointer_lock:
-                if _checkpointer is not None:
-                    # Test and potentially refresh the connection
-                    if not _test_connection(_checkpointer):
-                        logger.info("Connection refresh detected dead connection, creating new one")
-                        _checkpointer = _create_checkpointer()
-                    else:
-                        logger.info("Connection refresh: connection is healthy")
-                        # Update last connection time to extend the timeout
-                        _last_connection_time = time.time()
+            checkpointer = _checkpointer
+            if checkpointer is not None:
+                # Test outside the lock, then build any replacement in the background
+                if not _test_connection(checkpointer):
+                    logger.info("Connection refresh detected dead connection, building standby")
+                    _swap_in_standby()
+                else:
+                    logger.info("Connection refresh: connection is healthy")
         except Exception as e:
             logger.error(f"Error in connection refresh worker: {e}")
 
@@ -121,48 +292,126 @@ def _stop_refresh_worker():
 
 
 def get_checkpointer():
-    """Get a working PostgresSaver instance with automatic reconnection."""
-    global _checkpointer, _last_connection_time
+    """
+    Get a working PostgresSaver instance with automatic reconnection.
+
+    No liveness probe runs here: the pool validates idle connections on checkout
+    (see _check_connection) and replaces connections that fail a real query.
+    """
+    global _checkpointer, _pool
 
     # Start the refresh worker if not already running
     _start_refresh_worker()
 
     with _checkpointer_lock:
-        current_time = time.time()
-
-        # Check if we need to create a new connection or test existing one
         if _checkpointer is None:
             logger.info("No checkpointer exists, creating new connection")
-            _checkpointer = _create_checkpointer()
-            _last_connection_time = current_time
-            return _checkpointer
-
-        # Check if connection is too old (Neon free tier timeout)
-        if current_time - _last_connection_time > _connection_timeout:
-            logger.info("Connection is older than timeout period, creating new connection")
-            _checkpointer = _create_checkpointer()
-            _last_connection_time = current_time
-            return _checkpointer
-
-        # Test if the current connection is still alive
-        if not _test_connection(_checkpointer):
-            logger.warning("Database connection is dead, creating new connection")
-            _checkpointer = _create_checkpointer()
-            _last_connection_time = current_time
-            return _checkpointer
-
-        # Connection is still good, update last connection time
-        _last_connection_time = current_time
+            _pool, _checkpointer = _create_checkpointer()
+
         return _checkpointer
 
 
+def get_connection_stats():
+    """Return connection probe counters and, once created, the pool's own statistics."""
+    with _stats_lock:
+        stats = dict(_connection_stats)
+    if _pool is not None:
+        stats["pool"] = _pool.get_stats()
+    return stats
+
+
+async def _acreate_checkpointer():
+    """Create a new AsyncPostgresSaver instance and the async pool that backs it."""
+    url = _get_database_url()
+
+    logger.info(f"Creating new async database connection pool (min={_pool_min_size}, max={_pool_max_size})")
+    pool = AsyncConnectionPool(
+        url,
+        open=False,
+        name="img_edit_agent_async",
+        configure=_amark_connection_used,
+        check=_acheck_connection,
+        reset=_amark_connection_used,
+        **_pool_settings(),
+    )
+    await pool.open(wait=True, timeout=_pool_timeout)
+    # The schema bootstrap runs on the sync pool, which the rate-limit queries need anyway
+    await asyncio.to_thread(get_checkpointer)
+    saver = AsyncPostgresSaver(pool)
+
+    return pool, saver
+
+
+async def _aclose_stale_pool(pool, loop):
+    """Close the async pool a previous event loop left behind."""
+    if loop is not None and loop.is_running():
+        # That loop still runs in another thread and owns the pool's worker tasks, so close it there
+        asyncio.run_coroutine_threadsafe(pool.close(), loop)
+        return
+    try:
+        await pool.close()
+    except Exception as e:
+        # The pool's workers died with their loop; the pool is still marked closed and its idle connections dropped
+        logger.info(f"Closed async connection pool of a finished event loop: {e}")
+
+
+async def aget_checkpointer():
+    """
+    Get a working AsyncPostgresSaver instance for the running event loop.
+
+    Unlike get_checkpointer, this never blocks the event loop: connections come
+    from a psycopg AsyncConnectionPool and creation is guarded by an asyncio.Lock.
+    """
+    global _async_checkpointer, _async_pool, _async_checkpointer_lock, _async_checkpointer_loop
+
+    # Async connections cannot be shared across event loops, so start fresh on a new loop
+    loop = asyncio.get_running_loop()
+    if _async_checkpointer_lock is None or _async_checkpointer_loop is not loop:
+        stale_pool, stale_loop = _async_pool, _async_checkpointer_loop
+        _async_checkpointer_lock = asyncio.Lock()
+        _async_checkpointer_loop = loop
+        _async_checkpointer = None
+        _async_pool = None
+        if stale_pool is not None:
+            await _aclose_stale_pool(stale_pool, stale_loop)
+
+    async with _async_checkpointer_lock:
+        # The pool recycles connections itself (max_lifetime), so it is only created once
+        if _async_checkpointer is None:
+            logger.info("No async checkpointer exists, creating new connection pool")
+            _async_pool, _async_checkpointer = await _acreate_checkpointer()
+
+        return _async_checkpointer
+
+
+@contextmanager
+def get_db_connection():
+    """
+    Borrow a connection from the pool shared with the checkpointer.
+
+    The connection runs in autocommit mode and returns dict rows.
+    """
+    get_checkpointer()
+    with _pool.connection() as conn:
+        yield conn
+
+
 def cleanup_on_exit():
     """Cleanup function to be called on application exit."""
     logger.info("Cleaning up database connections...")
     _stop_refresh_worker()
-    # PostgresSaver doesn't have a close() method, so we just clear the reference
-    global _checkpointer
-    _checkpointer = None
+    global _checkpointer, _pool, _async_checkpointer, _async_pool
+    with _checkpointer_lock:
+        pools = [_pool, *_retired_pools]
+        _retired_pools.clear()
+        _checkpointer = None
+        _pool = None
+    for pool in pools:
+        if pool is not None:
+            _close_pool(pool)
+    # The async pool belongs to the event loop, which is gone by now, so just drop the reference
+    _async_checkpointer = None
+    _async_pool = None
     logger.info("Database connections cleaned up")
 
 
@@ -0,0 +1,187 @@
+"""
+Deterministic image edits run locally with Pillow.
+
+Requests like "rotate it 90°", "make it black and white" or "crop to a square"
+don't need a model: applying them here takes milliseconds instead of a paid
+Replicate generation, and they don't count toward the weekly generation limit.
+The edit_image tool passes a list of operations, each a dict with an "op" name
+and that operation's parameters, which are applied in order.
+"""
+
+import io
+import math
+import os
+from typing import Any, Callable, Dict, List, Tuple
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+# Output format name -> (Pillow format, content type)
+OUTPUT_FORMATS: Dict[str, Tuple[str, str]] = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+# Longest side a resize may produce
+_max_side = int(os.getenv("IMAGE_EDIT_MAX_SIDE", "4096"))
+
+EditOperation = Dict[str, Any]
+
+
+class EditError(ValueError):
+    """Raised when an edit operation is unknown or its parameters are invalid."""
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA")
+
+
+def _fraction(op: EditOperation, name: str, default: float) -> float:
+    value = op.get(name)
+    value = default if value is None else float(value)
+    if not 0 <= value <= 1:
+        raise EditError(f"{name} must be between 0 and 1, got {value}")
+    return value
+
+
+def _crop(image: Image.Image, op: EditOperation) -> Image.Image:
+    """Crop to a centered aspect ratio ("1:1", "16:9") or to a box given as fractions of the image."""
+    width, height = image.size
+    if op.get("aspect_ratio"):
+        try:
+            ratio_w, ratio_h = (float(part) for part in str(op["aspect_ratio"]).split(":"))
+        except ValueError:
+            raise EditError(f"aspect_ratio must look like 16:9, got {op['aspect_ratio']!r}")
+        if not (0 < ratio_w < math.inf and 0 < ratio_h < math.inf):
+            raise EditError(f"aspect_ratio parts must be positive numbers, got {op['aspect_ratio']!r}")
+        ratio = ratio_w / ratio_h
+        # At least one pixel each way, however extreme the ratio
+        crop_w, crop_h = (max(1, round(height * ratio)), height) if width / height > ratio else (width, max(1, round(width / ratio)))
+        left, top = (width - crop_w) // 2, (height - crop_h) // 2
+        return image.crop((left, top, left + crop_w, top + crop_h))
+
+    box = [_fraction(op, "left", 0), _fraction(op, "top", 0), _fraction(op, "right", 1), _fraction(op, "bottom", 1)]
+    if box[0] >= box[2] or box[1] >= box[3]:
+        raise EditError("crop box must have left < right and top < bottom")
+    return image.crop((round(box[0] * width), round(box[1] * height), round(box[2] * width), round(box[3] * height)))
+
+
+def _resize(image: Image.Image, op: EditOperation) -> Image.Image:
+    """Resize to width and/or height, keeping the aspect ratio when only one is given."""
+    width, height = int(op.get("width") or 0), int(op.get("height") or 0)
+    if not width and not height:
+        raise EditError("resize needs a width or a height")
+    if not width:
+        width = round(image.width * height / image.height)
+    elif not height:
+        height = round(image.height * width / image.width)
+    if not (0 < width <= _max_side and 0 < height <= _max_side):
+        raise EditError(f"resize must stay between 1 and {_max_side} pixels per side, got {width}x{height}")
+    return image.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def _rotate(image: Image.Image, op: EditOperation) -> Image.Image:
+    """Rotate clockwise by degrees, growing the canvas to fit."""
+    degrees = float(op.get("degrees") or 0) % 360
+    # Quarter turns are exact pixel moves, with no resampling or padding
+    quarter_turns = {90: Image.Transpose.ROTATE_270, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_90}
+    if degrees.is_integer() and round(degrees) in quarter_turns:
+        return image.transpose(quarter_turns[round(degrees)])
+    if degrees == 0:
+        return image
+    fill = (0,) * len(image.getbands()) if _has_alpha(image) else None
+    return image.rotate(-degrees, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=fill)
+
+
+def _flip(image: Image.Image, op: EditOperation) -> Image.Image:
+    """Mirror horizontally (default) or vertically."""
+    direction = op.get("direction") or "horizontal"
+    if direction not in ("horizontal", "vertical"):
+        raise EditError(f"direction must be horizontal or vertical, got {direction!r}")
+    return ImageOps.mirror(image) if direction == "horizontal" else ImageOps.flip(image)
+
+
+def _grayscale(image: Image.Image, op: EditOperation) -> Image.Image:
+    return image.convert("LA" if _has_alpha(image) else "L")
+
+
+def _enhancer(enhancer: Callable[[Image.Image], Any], default: float) -> Callable[[Image.Image, EditOperation], Image.Image]:
+    """Build an operation scaling an ImageEnhance property by "factor" (1.0 leaves it unchanged)."""
+
+    def apply(image: Image.Image, op: EditOperation) -> Image.Image:
+        factor = default if op.get("factor") is None else float(op["factor"])
+        if not 0 <= factor <= 10:
+            raise EditError(f"factor must be between 0 and 10, got {factor}")
+        return enhancer(image).enhance(factor)
+
+    return apply
+
+
+def _blur(image: Image.Image, op: EditOperation) -> Image.Image:
+    radius = 2.0 if op.get("radius") is None else float(op["radius"])
+    if not 0 < radius <= 100:
+        raise EditError(f"radius must be between 0 and 100, got {radius}")
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+
+EDIT_OPERATIONS: Dict[str, Callable[[Image.Image, EditOperation], Image.Image]] = {
+    "crop": _crop,
+    "resize": _resize,
+    "rotate": _rotate,
+    "flip": _flip,
+    "grayscale": _grayscale,
+    "brightness": _enhancer(ImageEnhance.Brightness, 1.2),
+    "contrast": _enhancer(ImageEnhance.Contrast, 1.2),
+    "blur": _blur,
+    "sharpen": _enhancer(ImageEnhance.Sharpness, 2.0),
+}
+
+
+def apply_edits(image_data: bytes, operations: List[EditOperation], output_format: str = "png") -> Tuple[bytes, str]:
+    """
+    Apply edit operations to an image, in order.
+
+    The image is first turned upright from its EXIF orientation; the output
+    carries no metadata.
+
+    Args:
+        image_data: The encoded source image
+        operations: Dicts with an "op" from EDIT_OPERATIONS and its parameters
+        output_format: A key of OUTPUT_FORMATS
+
+    Returns:
+        A tuple of (encoded image, content type)
+
+    Raises:
+        EditError: If an operation or the output format is invalid
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise EditError(f"output_format must be one of {', '.join(OUTPUT_FORMATS)}, got {output_format!r}")
+    if not operations:
+        raise EditError("no operations given")
+
+    with Image.open(io.BytesIO(image_data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+    for op in operations:
+        name = op.get("op")
+        if name not in EDIT_OPERATIONS:
+            raise EditError(f"unknown operation {name!r}, expected one of {', '.join(EDIT_OPERATIONS)}")
+        image = EDIT_OPERATIONS[name](image, op)
+
+    image_format, content_type = OUTPUT_FORMATS[output_format]
+    if image_format == "JPEG" and _has_alpha(image):
+        image = image.convert("RGB" if image.mode == "RGBA" else "L")
+    output = io.BytesIO()
+    image.save(output, format=image_format, **({"quality": 90} if image_format != "PNG" else {"optimize": True}))
+    return output.getvalue(), content_type
+
+
+def describe_edits(operations: List[EditOperation]) -> str:
+    """Summarize operations for the image description, e.g. "rotate (degrees=90), grayscale"."""
+    parts = []
+    for op in operations:
+        params = ", ".join(f"{key}={value}" for key, value in op.items() if key != "op" and value is not None)
+        parts.append(f"{op.get('op')} ({params})" if params else str(op.get("op")))
+    return ", ".join(parts)
@@ -0,0 +1,211 @@
+"""
+Content-addressed cache of generation results.
+
+Sending the same prompt with the same source image used to run (and pay for)
+another Replicate prediction and upload a duplicate object. Every saved
+generation is now recorded in generation_cache under a key hashing the model,
+the normalized prompt, the image handed to the model and the remaining model
+parameters. A later generation with the same key is served by a server-side S3
+copy of the stored image into the requesting user's gallery, which takes
+milliseconds and doesn't count toward the weekly generation limit.
+
+The image part of the key hashes the prepared data URI the model receives, so
+it follows the image bytes. With IMAGE_INPUT_PREPROCESS=false the model gets a
+presigned URL instead; its path (an image id that is never reused) stands in
+for the bytes, and the changing signature is ignored.
+
+Entries unused for GENERATION_CACHE_TTL_DAYS are evicted, as are the least
+recently used ones beyond GENERATION_CACHE_MAX_ENTRIES. Lookups are tallied per
+day in generation_cache_stats for hit rates over time.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from llm.connection_manager import get_db_connection
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_ttl_days = int(os.getenv("GENERATION_CACHE_TTL_DAYS", "30"))
+_max_entries = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "100000"))
+# Stores between two eviction passes
+_evict_every = int(os.getenv("GENERATION_CACHE_EVICT_EVERY", "100"))
+
+# Model input fields that are keyed separately from the other parameters
+_PROMPT_FIELD = "prompt"
+_IMAGE_FIELDS = ("input_image", "image")
+
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "errors": 0}
+_stats_lock = threading.Lock()
+_stores_since_eviction = 0
+
+
+def generation_cache_enabled() -> bool:
+    return os.getenv("GENERATION_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and case, which don't change what the model is asked for."""
+    return " ".join(prompt.split()).casefold()
+
+
+def input_image_digest(image: str) -> str:
+    """Hash an input image reference: a data URI by content, a URL by its path, ignoring any signature."""
+    if not image.startswith("data:"):
+        scheme, netloc, path, _, _ = urlsplit(image)
+        image = urlunsplit((scheme, netloc, path, "", ""))
+    return hashlib.sha256(image.encode("utf-8")).hexdigest()
+
+
+def generation_cache_key(model: str, model_input: Dict[str, Any]) -> str:
+    """
+    Build the cache key of a Replicate request.
+
+    Args:
+        model: The Replicate model reference
+        model_input: The model input, as built for replicate.run
+
+    Returns:
+        A hex SHA-256 digest
+    """
+    image = next((model_input[field] for field in _IMAGE_FIELDS if model_input.get(field)), "")
+    params = {name: value for name, value in model_input.items() if name != _PROMPT_FIELD and name not in _IMAGE_FIELDS}
+    payload = {
+        "model": model,
+        "prompt": normalize_prompt(str(model_input.get(_PROMPT_FIELD, ""))),
+        "image": input_image_digest(str(image)),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def lookup_generation(cache_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Find a live cache entry, marking it used and tallying the lookup.
+
+    Returns:
+        The generation_cache row ("user_id", "image_id", "content_type",
+        "variants", ...) or None on a miss
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            """
+            WITH hit AS (
+                UPDATE generation_cache
+                SET hit_count = hit_count + 1, last_hit_at = now()
+                WHERE cache_key = %s AND last_hit_at > now() - make_interval(days => %s)
+                RETURNING *
+            ), tally AS (
+                INSERT INTO generation_cache_stats (day, hits, misses)
+                SELECT CURRENT_DATE, count(*), 1 - count(*) FROM hit
+                ON CONFLICT (day) DO UPDATE SET
+                    hits = generation_cache_stats.hits + EXCLUDED.hits,
+                    misses = generation_cache_stats.misses + EXCLUDED.misses
+            )
+            SELECT * FROM hit
+        """,
+            (cache_key, _ttl_days),
+        ).fetchone()
+    _count("hits" if row else "misses")
+    return row
+
+
+def store_generation(cache_key: str, model: str, user_id: str, image_id: str, variants: List[str], content_type: str = "image/png") -> None:
+    """
+    Record a saved generation under its cache key.
+
+    The first image stored for a key is kept; a concurrent identical generation
+    doesn't replace it. Every GENERATION_CACHE_EVICT_EVERY stores also run an
+    eviction pass.
+    """
+    global _stores_since_eviction
+
+    with get_db_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO generation_cache (cache_key, model, user_id, image_id, content_type, variants)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO NOTHING
+        """,
+            (cache_key, model, user_id, image_id, content_type, variants),
+        )
+    _count("stores")
+
+    with _stats_lock:
+        _stores_since_eviction += 1
+        due = _stores_since_eviction >= _evict_every
+        if due:
+            _stores_since_eviction = 0
+    if due:
+        evict_generation_cache()
+
+
+def forget_generation(cache_key: str) -> None:
+    """Drop an entry whose image can no longer be copied (e.g. it was deleted from S3)."""
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM generation_cache WHERE cache_key = %s", (cache_key,))
+
+
+def evict_generation_cache(ttl_days: Optional[int] = None, max_entries: Optional[int] = None) -> int:
+    """
+    Remove expired entries, then the least recently used ones over the size limit.
+
+    Only cache rows are removed; the images stay in their owners' galleries.
+
+    Returns:
+        The number of entries removed
+    """
+    ttl_days = _ttl_days if ttl_days is None else ttl_days
+    max_entries = _max_entries if max_entries is None else max_entries
+    with get_db_connection() as conn:
+        expired = conn.execute("DELETE FROM generation_cache WHERE last_hit_at <= now() - make_interval(days => %s)", (ttl_days,)).rowcount
+        overflow = conn.execute(
+            """
+            DELETE FROM generation_cache WHERE cache_key IN (
+                SELECT cache_key FROM generation_cache ORDER BY last_hit_at DESC OFFSET %s
+            )
+        """,
+            (max_entries,),
+        ).rowcount
+    removed = expired + overflow
+    _count("evictions", removed)
+    if removed:
+        logger.info(f"Evicted {removed} generation cache entries ({expired} expired, {overflow} over the limit)")
+    return removed
+
+
+def record_cache_error() -> None:
+    """Count a lookup or store that failed; the generation goes ahead uncached."""
+    _count("errors")
+
+
+def get_generation_cache_stats() -> Dict[str, int]:
+    """Return this process's cache counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def get_generation_cache_hit_rates(days: int = 7) -> List[Dict[str, Any]]:
+    """
+    Return the daily lookup tallies of the last few days, newest first.
+
+    Returns:
+        Dicts with "day", "hits", "misses" and "hit_rate"
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT day, hits, misses FROM generation_cache_stats WHERE day > CURRENT_DATE - %s ORDER BY day DESC",
+            (days,),
+        ).fetchall()
+    return [{**row, "hit_rate": row["hits"] / (row["hits"] + row["misses"]) if row["hits"] + row["misses"] else 0.0} for row in rows]
@@ -0,0 +1,158 @@
+"""
+Shared outbound HTTP clients.
+
+Downloads from Replicate's CDN (and any other fetchers) go through one pooled
+requests.Session for sync code and one httpx.AsyncClient per event loop for async
+code, so repeated requests to the same host reuse kept-alive connections instead of
+paying a new TCP and TLS handshake each time. Both clients apply connect/read
+timeouts, so a stalled server cannot hang a worker, and retry a bounded number of
+times: the sync session retries connection errors and 429/5xx responses with
+backoff, while the async client retries failed connection attempts. HTTP/2 can be
+enabled for the async client with HTTP2_ENABLED=true when the h2 package is
+installed (pip install "httpx[http2]").
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Optional, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+# httpx connection pools belong to the event loop that opened them, so each loop gets its own client
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_async_clients_lock = threading.Lock()
+
+# Statuses worth retrying: rate limiting and transient server or gateway errors
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _timeouts() -> Tuple[float, float]:
+    """Return the (connect, read) timeouts in seconds."""
+    return float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")), float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+
+
+def _max_retries() -> int:
+    return int(os.getenv("HTTP_MAX_RETRIES", "3"))
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to requests made without one."""
+
+    def __init__(self, *args: Any, timeout: Tuple[float, float], **kwargs: Any):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def _build_session() -> requests.Session:
+    """Build the shared session from the HTTP_* environment variables."""
+    retry = Retry(
+        total=_max_retries(),
+        backoff_factor=float(os.getenv("HTTP_RETRY_BACKOFF", "0.5")),
+        status_forcelist=_RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        # Hand the last error response back so raise_for_status reports it
+        raise_on_status=False,
+    )
+    adapter = _TimeoutHTTPAdapter(
+        timeout=_timeouts(),
+        max_retries=retry,
+        # Number of hosts with their own pool, and kept-alive connections per host
+        pool_connections=int(os.getenv("HTTP_POOL_HOSTS", "10")),
+        pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", "20")),
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """
+    Get the shared requests session, creating it on first use.
+
+    Returns:
+        A requests.Session with per-host connection pools, default timeouts and retries
+    """
+    global _session
+
+    if _session is not None:
+        return _session
+
+    with _session_lock:
+        # Another thread may have created it while we waited
+        if _session is None:
+            _session = _build_session()
+            print("[HTTP] Created shared HTTP session")
+        return _session
+
+
+def _http2_enabled() -> bool:
+    """Whether to negotiate HTTP/2, falling back to HTTP/1.1 if h2 is not installed."""
+    if os.getenv("HTTP2_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("[HTTP] HTTP2_ENABLED is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def _build_async_client() -> httpx.AsyncClient:
+    """Build an async client from the HTTP_* environment variables."""
+    connect_timeout, read_timeout = _timeouts()
+    max_connections = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+    http2 = _http2_enabled()
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(retries=_max_retries(), http2=http2, limits=limits),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        follow_redirects=True,
+    )
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Get the shared async client for the running event loop, creating it on first use.
+
+    The client is shared and must not be closed by callers; see aclose_async_http_client.
+
+    Returns:
+        An httpx.AsyncClient with pooling, timeouts, connect retries and optional HTTP/2
+    """
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = _async_clients[loop] = _build_async_client()
+            print("[HTTP] Created shared async HTTP client")
+        return client
+
+
+async def aclose_async_http_client() -> None:
+    """Close the running loop's async client, e.g. on application shutdown."""
+    with _async_clients_lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def reset_http_session() -> None:
+    """Close the shared session so the next call builds a new one (used by tests)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
@@ -0,0 +1,313 @@
+"""
+Input image preparation for generations.
+
+Users' uploads are often full-resolution phone photos, while the model works at
+around one megapixel. Before a generation the source image is fetched, rotated
+upright from its EXIF orientation, downscaled to IMAGE_INPUT_MAX_SIDE, stripped
+of metadata and re-encoded, and Replicate is given the compact result as a data
+URI instead of the original presigned URL. If anything goes wrong the original URL
+is used, so preparation can only make a generation cheaper, never fail it. Only
+the user's own images in our bucket are downloaded; the URL comes from the model,
+so any other URL is handed to Replicate unchanged rather than fetched here.
+
+Decoding and resizing are CPU-bound; Pillow releases the GIL while doing them, so
+async callers run preparation in a small dedicated thread pool.
+
+Generated images also get lighter variants for the gallery: a full-size WebP (and
+AVIF, if enabled in IMAGE_VARIANTS) and a small WebP thumbnail. Encoding those
+costs far more CPU than a resize, so they are rendered in a process pool where
+that work can't compete with the API's own threads.
+"""
+
+import asyncio
+import base64
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from llm.http_client import get_async_http_client, get_http_session
+from llm.storage import user_object_key
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Longest side, in pixels, of the image handed to the model
+_max_side = int(os.getenv("IMAGE_INPUT_MAX_SIDE", "1024"))
+# Larger source files are passed through by URL rather than downloaded
+_max_source_bytes = int(os.getenv("IMAGE_INPUT_MAX_BYTES", str(25 * 1024 * 1024)))
+_jpeg_quality = int(os.getenv("IMAGE_INPUT_JPEG_QUALITY", "90"))
+# Size of the chunks a source image is downloaded in
+_download_chunk_bytes = 64 * 1024
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+# Variant name -> (Pillow format, content type, longest side or None for full size, encoder options)
+VARIANT_SPECS: Dict[str, Tuple[str, str, Optional[int], Dict[str, int]]] = {
+    "webp": ("WEBP", "image/webp", None, {"quality": 85, "method": 4}),
+    "avif": ("AVIF", "image/avif", None, {"quality": 60, "speed": 8}),
+    "thumb": ("WEBP", "image/webp", int(os.getenv("IMAGE_THUMBNAIL_SIDE", "384")), {"quality": 80, "method": 4}),
+}
+# Generated images larger than this are stored without variants
+VARIANT_MAX_SOURCE_BYTES = int(os.getenv("IMAGE_VARIANT_MAX_BYTES", str(32 * 1024 * 1024)))
+# A streamed image's copy for its variants is kept in memory up to this size, then in a temporary file
+VARIANT_SPOOL_BYTES = int(os.getenv("IMAGE_VARIANT_SPOOL_BYTES", str(1024 * 1024)))
+_variant_timeout = float(os.getenv("IMAGE_VARIANT_TIMEOUT", "60"))
+_variant_executor: Optional[ProcessPoolExecutor] = None
+_variant_executor_lock = threading.Lock()
+
+# An encoded image, or the path of a file holding one
+ImageSource = Union[bytes, str]
+
+
+def _preprocessing_enabled() -> bool:
+    return os.getenv("IMAGE_INPUT_PREPROCESS", "true").lower() in ("1", "true", "yes")
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Create the preparation pool on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_PREP_WORKERS", "2")), thread_name_prefix="image-prep")
+    return _executor
+
+
+def prepare_input_image(image_data: bytes, max_side: Optional[int] = None) -> Tuple[bytes, str]:
+    """
+    Orient, downscale and re-encode an input image.
+
+    Images with transparency are written as PNG, everything else as JPEG. The
+    output carries no EXIF or other metadata, and images already within max_side
+    are never upscaled.
+
+    Args:
+        image_data: The encoded source image
+        max_side: Longest side of the output, defaults to IMAGE_INPUT_MAX_SIDE
+
+    Returns:
+        A tuple of (encoded image, MIME type)
+    """
+    max_side = max_side or _max_side
+    with Image.open(io.BytesIO(image_data)) as source:
+        # Let the JPEG decoder skip straight to a nearby power-of-two scale
+        source.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(output, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=_jpeg_quality, optimize=True)
+            mime_type = "image/jpeg"
+    return output.getvalue(), mime_type
+
+
+def to_data_uri(image_data: bytes, mime_type: str) -> str:
+    """Encode image bytes as a data URI."""
+    return f"data:{mime_type};base64,{base64.b64encode(image_data).decode('ascii')}"
+
+
+def _prepare_to_data_uri(image_url: str, image_data: bytes) -> str:
+    """Prepare downloaded bytes, falling back to the source URL if they can't be processed."""
+    try:
+        prepared, mime_type = prepare_input_image(image_data)
+    except Exception as e:
+        print(f"[IMAGES] Could not prepare input image, using the original: {e}")
+        return image_url
+    print(f"[IMAGES] Prepared input image: {len(image_data)} -> {len(prepared)} bytes")
+    return to_data_uri(prepared, mime_type)
+
+
+class ImageURLNotAllowed(ValueError):
+    """Raised when asked to download a URL that isn't one of the user's images in our bucket."""
+
+
+def _should_prepare(image_url: str, user_id: str) -> bool:
+    """Only the user's images in our bucket are prepared; other URLs and data URIs are passed through."""
+    return _preprocessing_enabled() and user_object_key(image_url, user_id) is not None
+
+
+def _too_large(content_length: Optional[str]) -> bool:
+    """Whether a response's Content-Length is over the download limit."""
+    return content_length is not None and content_length.isdigit() and int(content_length) > _max_source_bytes
+
+
+def _append_chunk(image_data: bytearray, chunk: bytes) -> None:
+    """
+    Add a downloaded chunk, stopping as soon as the image outgrows the limit.
+
+    Content-Length can be missing (chunked responses) or wrong, so the limit is
+    enforced on what is actually read.
+
+    Raises:
+        ValueError: If the image is larger than IMAGE_INPUT_MAX_BYTES
+    """
+    if len(image_data) + len(chunk) > _max_source_bytes:
+        raise ValueError(f"Image is larger than {_max_source_bytes} bytes")
+    image_data += chunk
+
+
+def fetch_image(image_url: str, user_id: str) -> bytes:
+    """
+    Download one of the user's images with the shared HTTP session.
+
+    Raises:
+        ImageURLNotAllowed: If the URL isn't an object under users/{user_id}/ in our bucket
+        ValueError: If the image is larger than IMAGE_INPUT_MAX_BYTES
+        requests.RequestException: If the download fails
+    """
+    if user_object_key(image_url, user_id) is None:
+        raise ImageURLNotAllowed("image_url must be one of the user's images")
+    with get_http_session().get(image_url, stream=True, allow_redirects=False) as response:
+        response.raise_for_status()
+        if _too_large(response.headers.get("Content-Length")):
+            raise ValueError(f"Image is larger than {_max_source_bytes} bytes")
+        image_data = bytearray()
+        for chunk in response.iter_content(chunk_size=_download_chunk_bytes):
+            _append_chunk(image_data, chunk)
+        return bytes(image_data)
+
+
+def prepare_input_image_url(image_url: str, user_id: str) -> str:
+    """
+    Fetch and prepare the source image of a generation.
+
+    Args:
+        image_url: URL of the user's source image
+        user_id: The user whose images may be downloaded
+
+    Returns:
+        A data URI of the prepared image, or image_url if it could not be prepared
+    """
+    if not _should_prepare(image_url, user_id):
+        return image_url
+    try:
+        image_data = fetch_image(image_url, user_id)
+    except Exception as e:
+        print(f"[IMAGES] Could not fetch input image, using the original URL: {e}")
+        return image_url
+    return _prepare_to_data_uri(image_url, image_data)
+
+
+async def aprepare_input_image_url(image_url: str, user_id: str) -> str:
+    """
+    Fetch and prepare the source image of a generation without blocking the event loop.
+
+    The download uses the shared async client and the image work runs in the
+    preparation thread pool.
+
+    Args:
+        image_url: URL of the user's source image
+        user_id: The user whose images may be downloaded
+
+    Returns:
+        A data URI of the prepared image, or image_url if it could not be prepared
+    """
+    if not _should_prepare(image_url, user_id):
+        return image_url
+    try:
+        async with get_async_http_client().stream("GET", image_url, follow_redirects=False) as response:
+            response.raise_for_status()
+            if _too_large(response.headers.get("Content-Length")):
+                return image_url
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes(_download_chunk_bytes):
+                _append_chunk(buffer, chunk)
+            image_data = bytes(buffer)
+    except Exception as e:
+        print(f"[IMAGES] Could not fetch input image, using the original URL: {e}")
+        return image_url
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), _prepare_to_data_uri, image_url, image_data)
+
+
+def enabled_variants() -> List[str]:
+    """Return the variant names configured in IMAGE_VARIANTS (default "webp,thumb")."""
+    names = [name.strip() for name in os.getenv("IMAGE_VARIANTS", "webp,thumb").split(",") if name.strip()]
+    unknown = [name for name in names if name not in VARIANT_SPECS]
+    if unknown:
+        print(f"[IMAGES] Ignoring unknown image variants: {', '.join(unknown)}")
+    return [name for name in names if name in VARIANT_SPECS]
+
+
+def render_variants(image_data: ImageSource, variants: List[str]) -> Dict[str, bytes]:
+    """
+    Encode the requested variants of an image.
+
+    The image is decoded once and each variant is encoded from it. Runs in a
+    variant pool process, so it only takes and returns picklable bytes and paths.
+
+    Args:
+        image_data: The encoded generated image, or the path of a file holding it
+        variants: Names from VARIANT_SPECS
+
+    Returns:
+        A dict of variant name to encoded bytes
+    """
+    rendered = {}
+    with Image.open(io.BytesIO(image_data) if isinstance(image_data, bytes) else image_data) as source:
+        image = source.convert("RGBA" if source.mode in ("RGBA", "LA", "PA", "P") else "RGB")
+    for name in variants:
+        image_format, _, max_side, options = VARIANT_SPECS[name]
+        variant = image
+        if max_side:
+            variant = image.copy()
+            variant.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        variant.save(output, format=image_format, **options)
+        rendered[name] = output.getvalue()
+    return rendered
+
+
+def _get_variant_executor() -> ProcessPoolExecutor:
+    """Create the variant pool on first use."""
+    global _variant_executor
+    with _variant_executor_lock:
+        if _variant_executor is None:
+            # Spawned rather than forked: the API process runs threads holding locks a fork would copy
+            _variant_executor = ProcessPoolExecutor(
+                max_workers=int(os.getenv("IMAGE_VARIANT_WORKERS", "2")),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _variant_executor
+
+
+def create_image_variants(image_data: ImageSource, variants: List[str]) -> Dict[str, Tuple[bytes, str]]:
+    """
+    Render variants of a generated image in the variant process pool.
+
+    Blocks until they are ready, so call it from a worker thread rather than the event loop.
+    A path is opened by the pool process, so the image never has to be held here.
+
+    Args:
+        image_data: The encoded generated image, or the path of a file holding it
+        variants: Names from VARIANT_SPECS
+
+    Returns:
+        A dict of variant name to (encoded bytes, content type)
+    """
+    future = _get_variant_executor().submit(render_variants, image_data, variants)
+    try:
+        rendered = future.result(timeout=_variant_timeout)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool next time
+        shutdown_variant_executor(wait=False)
+        raise
+    return {name: (data, VARIANT_SPECS[name][1]) for name, data in rendered.items()}
+
+
+def shutdown_variant_executor(wait: bool = True) -> None:
+    """Stop the variant pool's processes."""
+    global _variant_executor
+    with _variant_executor_lock:
+        executor, _variant_executor = _variant_executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,174 @@
+"""
+Durable Postgres queue of image generations.
+
+With GENERATION_MODE=queue the generate_image tool inserts a row into
+generation_jobs and any number of `python -m llm.worker` processes claim rows with
+SELECT ... FOR UPDATE SKIP LOCKED. A claimed job is hidden from other workers until
+its visibility timeout expires; the worker extends it while the job runs, so a
+crashed worker's job is picked up again. Failed attempts are retried with
+exponential backoff and dead-lettered (status 'dead') after max_attempts.
+"""
+
+import json
+import logging
+import os
+import uuid
+from typing import Any, Dict, List, Optional
+
+from llm.connection_manager import get_db_connection
+from llm.jobs import JOB_FAILED, JOB_SUCCEEDED
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+JOB_DEAD = "dead"
+
+_default_max_attempts = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", "3"))
+# Seconds a claimed job stays hidden from other workers without a heartbeat
+_visibility_timeout = int(os.getenv("GENERATION_JOB_VISIBILITY_TIMEOUT", "300"))
+# Base delay before a failed attempt is retried, doubled on each further attempt
+_retry_backoff = int(os.getenv("GENERATION_JOB_RETRY_BACKOFF", "10"))
+
+
+def enqueue_generation(prompt: str, user_id: str, image_url: str, title: str, client_ip: str, max_attempts: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Add a generation to the queue.
+
+    Returns:
+        The inserted generation_jobs row
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            """
+            INSERT INTO generation_jobs (id, user_id, client_ip, prompt, image_url, title, max_attempts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING *
+        """,
+            (uuid.uuid4(), user_id, client_ip, prompt, image_url, title, max_attempts or _default_max_attempts),
+        ).fetchone()
+
+
+def claim_job(worker_id: str, visibility_timeout: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Claim the next available job for a worker.
+
+    Queued jobs whose backoff has elapsed and running jobs whose visibility timeout
+    expired (their worker died) are both claimable. Concurrent workers skip rows
+    another worker is claiming instead of waiting on them.
+
+    Returns:
+        The claimed row with attempts already incremented, or None if the queue is empty
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            """
+            UPDATE generation_jobs
+            SET status = 'running', attempts = attempts + 1, locked_by = %s,
+                locked_until = now() + make_interval(secs => %s), updated_at = now()
+            WHERE id = (
+                SELECT id FROM generation_jobs
+                WHERE (status = 'queued' AND available_at <= now())
+                   OR (status = 'running' AND locked_until < now())
+                ORDER BY available_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+        """,
+            (worker_id, visibility_timeout or _visibility_timeout),
+        ).fetchone()
+
+
+def extend_lock(job_id: uuid.UUID, worker_id: str, visibility_timeout: Optional[int] = None) -> bool:
+    """Push back a running job's visibility timeout. Returns False if the worker no longer holds it."""
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            """
+            UPDATE generation_jobs SET locked_until = now() + make_interval(secs => %s), updated_at = now()
+            WHERE id = %s AND locked_by = %s AND status = 'running'
+        """,
+            (visibility_timeout or _visibility_timeout, job_id, worker_id),
+        )
+        return cursor.rowcount == 1
+
+
+def complete_job(job_id: uuid.UUID, worker_id: str, result: Dict[str, Any]) -> bool:
+    """Mark a job succeeded with its result. Returns False if the worker no longer holds it."""
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            """
+            UPDATE generation_jobs
+            SET status = 'succeeded', result = %s, last_error = NULL, locked_until = NULL, updated_at = now()
+            WHERE id = %s AND locked_by = %s AND status = 'running'
+        """,
+            (json.dumps(result), job_id, worker_id),
+        )
+        return cursor.rowcount == 1
+
+
+def fail_job(job_id: uuid.UUID, worker_id: str, error: str, retryable: bool = True) -> Optional[str]:
+    """
+    Record a failed attempt.
+
+    The job is requeued with exponential backoff while it has attempts left and the
+    error is retryable; otherwise it is dead-lettered, or marked failed if the error
+    is not worth retrying.
+
+    Returns:
+        The job's new status, or None if the worker no longer holds it
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            """
+            UPDATE generation_jobs
+            SET status = CASE
+                    WHEN NOT %(retryable)s THEN 'failed'
+                    WHEN attempts >= max_attempts THEN 'dead'
+                    ELSE 'queued'
+                END,
+                available_at = now() + make_interval(secs => %(backoff)s * power(2, greatest(attempts - 1, 0))),
+                last_error = %(error)s, locked_until = NULL, updated_at = now()
+            WHERE id = %(job_id)s AND locked_by = %(worker_id)s AND status = 'running'
+            RETURNING status
+        """,
+            {"retryable": retryable, "backoff": _retry_backoff, "error": error, "job_id": job_id, "worker_id": worker_id},
+        ).fetchone()
+        return row["status"] if row else None
+
+
+def get_queued_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Return a generation_jobs row by id, or None if there is no such job."""
+    try:
+        job_uuid = uuid.UUID(job_id)
+    except ValueError:
+        return None
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM generation_jobs WHERE id = %s", (job_uuid,)).fetchone()
+
+
+def list_queued_user_jobs(user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    """Return a user's most recent generation_jobs rows, newest first."""
+    with get_db_connection() as conn:
+        return conn.execute("SELECT * FROM generation_jobs WHERE user_id = %s ORDER BY created_at DESC LIMIT %s", (user_id, limit)).fetchall()
+
+
+def to_job_snapshot(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a generation_jobs row to the job snapshot shape used by llm.jobs."""
+    result = row["result"] or {}
+    succeeded = row["status"] == JOB_SUCCEEDED
+    image = None
+    if succeeded:
+        image = {"image_id": result["image_id"], "title": result["title"], "prompt": result["prompt"], "variants": result.get("variants", [])}
+    return {
+        "job_id": str(row["id"]),
+        "user_id": row["user_id"],
+        "title": row["title"],
+        # A dead-lettered job has failed as far as the client is concerned
+        "status": JOB_FAILED if row["status"] == JOB_DEAD else row["status"],
+        "message": result.get("message") if succeeded else row["last_error"],
+        "error": None if succeeded else row["last_error"],
+        "image": image,
+        "attempts": row["attempts"],
+        "created_at": row["created_at"].timestamp(),
+        "updated_at": row["updated_at"].timestamp(),
+    }
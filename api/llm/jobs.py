@@ -0,0 +1,177 @@
+"""
+In-process executor for background image generation jobs.
+
+With GENERATION_MODE=background the generate_image tool submits its work here and
+returns a job id at once, so a chat turn finishes in LLM time while the image is
+generated, downloaded and uploaded by a bounded pool of worker threads. Job state
+is kept in memory (most recent jobs only) and does not survive a restart.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Worker threads running generations, and how many jobs may be queued or running at once
+_max_concurrency = int(os.getenv("GENERATION_MAX_CONCURRENCY", "4"))
+_max_pending = int(os.getenv("GENERATION_MAX_PENDING", "32"))
+# Finished jobs kept for status lookups before the oldest are dropped
+_max_retained_jobs = int(os.getenv("GENERATION_MAX_RETAINED_JOBS", "1000"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+_FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+
+_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_jobs_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_completion_listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+
+class JobQueueFull(RuntimeError):
+    """Raised when too many generation jobs are already queued or running."""
+
+
+def get_generation_mode() -> str:
+    """Return how generate_image runs: "inline" (default), "background" or "queue" (see llm.job_queue)."""
+    return os.getenv("GENERATION_MODE", "inline").lower()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Create the worker pool on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_concurrency, thread_name_prefix="generation-job")
+    return _executor
+
+
+def _pending_count() -> int:
+    """Number of jobs not yet finished. Caller must hold _jobs_lock."""
+    return sum(1 for job in _jobs.values() if job["status"] not in _FINISHED_STATUSES)
+
+
+def _evict_finished_jobs() -> None:
+    """Drop the oldest finished jobs above the retention limit. Caller must hold _jobs_lock."""
+    excess = len(_jobs) - _max_retained_jobs
+    if excess <= 0:
+        return
+    for job_id in [job_id for job_id, job in _jobs.items() if job["status"] in _FINISHED_STATUSES][:excess]:
+        del _jobs[job_id]
+
+
+def _update_job(job_id: str, **fields: Any) -> Dict[str, Any]:
+    """Update a job's fields and return a snapshot of it."""
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job.update(fields, updated_at=time.time())
+        return dict(job)
+
+
+def _notify_listeners(job: Dict[str, Any]) -> None:
+    """Call the completion listeners, never letting one break the worker."""
+    for listener in list(_completion_listeners):
+        try:
+            listener(job)
+        except Exception as e:
+            print(f"[JOBS] Completion listener failed for job {job['job_id']}: {e}")
+
+
+def _run_job(job_id: str, func: Callable[..., Dict[str, Any]], args: tuple) -> None:
+    """Run one job in a worker thread and record its outcome."""
+    _update_job(job_id, status=JOB_RUNNING)
+    print(f"[JOBS] Job {job_id} started")
+    try:
+        result = func(*args)
+    except Exception as e:
+        logger.exception(f"Job {job_id} raised")
+        result = {"success": False, "message": f"Failed to generate image: {str(e)}"}
+
+    if result.get("success"):
+        image = {"image_id": result["image_id"], "title": result["title"], "prompt": result["prompt"], "variants": result.get("variants", [])}
+        job = _update_job(job_id, status=JOB_SUCCEEDED, message=result["message"], image=image)
+    else:
+        job = _update_job(job_id, status=JOB_FAILED, message=result.get("message"), error=result.get("message"))
+    print(f"[JOBS] Job {job_id} {job['status']}")
+    _notify_listeners(job)
+
+
+def submit_job(user_id: str, title: str, func: Callable[..., Dict[str, Any]], *args: Any) -> Dict[str, Any]:
+    """
+    Queue a generation to run in the background.
+
+    Args:
+        user_id: The user the job belongs to
+        title: Title of the image being generated
+        func: Called with *args in a worker thread; returns a dict with "success" and
+            "message", plus "image_id", "title", "prompt" and "variants" on success
+        *args: Positional arguments for func
+
+    Returns:
+        A snapshot of the queued job
+
+    Raises:
+        JobQueueFull: If the pending job limit has been reached
+    """
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    with _jobs_lock:
+        if _pending_count() >= _max_pending:
+            raise JobQueueFull(f"{_max_pending} generation jobs are already pending")
+        _jobs[job_id] = {
+            "job_id": job_id,
+            "user_id": user_id,
+            "title": title,
+            "status": JOB_QUEUED,
+            "message": None,
+            "error": None,
+            "image": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        _evict_finished_jobs()
+        job = dict(_jobs[job_id])
+
+    _get_executor().submit(_run_job, job_id, func, args)
+    print(f"[JOBS] Queued job {job_id} for user {user_id}")
+    return job
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Return a snapshot of a job, or None if it is unknown or was evicted."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def list_user_jobs(user_id: str) -> List[Dict[str, Any]]:
+    """Return snapshots of a user's jobs, newest first."""
+    with _jobs_lock:
+        return [dict(job) for job in reversed(_jobs.values()) if job["user_id"] == user_id]
+
+
+def add_completion_listener(listener: Callable[[Dict[str, Any]], None]) -> None:
+    """Register a callback run in the worker thread with each finished job."""
+    _completion_listeners.append(listener)
+
+
+def remove_completion_listener(listener: Callable[[Dict[str, Any]], None]) -> None:
+    """Unregister a callback added with add_completion_listener."""
+    if listener in _completion_listeners:
+        _completion_listeners.remove(listener)
+
+
+def shutdown_jobs(wait: bool = True) -> None:
+    """Stop accepting work and optionally wait for running jobs to finish."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
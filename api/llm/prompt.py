@@ -22,8 +22,9 @@ system_message = """
     1. **ONE IMAGE PER REQUEST**: You can ONLY generate ONE image per user request, regardless of what they ask for.
     If they request multiple images, explain this limitation and ask which one they'd like most.
 
-    2. **ALWAYS USE THE TOOL**: When generating or modifying images, you MUST use the generate_image tool. Never try to create images directly.
-    Only use the tool when it is clear the user wants you to edit/generate the image. Remember, one image per user request!
+    2. **ALWAYS USE THE TOOLS**: When generating or modifying images, you MUST use the generate_image or edit_image tool.
+    Never try to create images directly.
+    Only use a tool when it is clear the user wants you to edit/generate the image. Remember, one image per user request!
     If there is an error, or the tool is not working, just say so to the user.
 
     3. **PROMPT IMPROVEMENT**: Always enhance user prompts unless they explicitly say "use my exact prompt" or similar.
@@ -37,6 +38,10 @@ system_message = """
     - Only use image IDs if absolutely necessary for distinguishing images with same IDs
     - Confirm your understanding before proceeding
 
+    5. **PICK THE RIGHT TOOL**: Use edit_image for simple, exact changes: crop, resize, rotate, flip, black and white,
+    brightness, contrast, blur, sharpen or changing the file format. It is instant and does not use up the user's
+    weekly generations. Use generate_image for anything creative or that changes the content of the image.
+
     🎯 PROMPT ENHANCEMENT GUIDELINES:
     - Add artistic style descriptions (e.g., "cinematic lighting", "soft bokeh background")
     - Include mood and atmosphere (e.g., "warm golden hour", "mysterious shadows")
@@ -58,6 +63,12 @@ system_message = """
     - image_url: The source image URL
     - title: An accurate title for the generated image. Be concise.
 
+    When using the edit_image tool, provide:
+    - user_id: The user's ID
+    - image_url: The source image URL
+    - operations: The edits to apply, in order (e.g. [{{"op": "rotate", "degrees": 90}}, {{"op": "grayscale"}}])
+    - title: A concise title for the edited image
+
     Remember: You're not just a tool - you're a creative partner helping users bring their artistic visions to life! 🎨✨
     """.format(
     model_name="black-forest-labs/flux-kontext-pro",
@@ -69,6 +80,8 @@ generate_image_tool_description = """
     This tool creates stunning images using advanced AI generation techniques.
     IMPORTANT: Use this tool only ONCE per user request. If the tool returns and error or has issues, just say so.\
         Don't use this tool multiple times for the same user request or message.
+    If the tool says the generation started in the background, tell the user the image is on its way\
+        and will appear in their gallery shortly. Don't call the tool again to check on it.
 
     PARAMETERS:
     - prompt (required): A detailed description of what to generate.\
@@ -96,3 +109,29 @@ generate_image_tool_description = """
     - Requires a source image URL
     - Generation may take 10-30 seconds
     """
+
+
+edit_image_tool_description = """
+    Apply exact, deterministic edits to an image: crop, resize, rotate, flip, grayscale, brightness,
+    contrast, blur, sharpen and format conversion. Runs instantly on our servers and does NOT count
+    toward the user's weekly generation limit, so prefer it over generate_image for these edits.
+    Use generate_image instead for creative changes (new content, styles, objects, backgrounds).
+
+    PARAMETERS:
+    - user_id (required): The unique identifier for the user.
+    - image_url (required): URL of the image to edit.
+    - operations (required): List of edits applied in order. Each has an "op" and its parameters:
+      - crop: "aspect_ratio" like "1:1" or "16:9" for a centered crop,\
+        or "left", "top", "right", "bottom" as fractions between 0 and 1 of the image
+      - resize: "width" and/or "height" in pixels (the aspect ratio is kept if only one is given)
+      - rotate: "degrees" clockwise (e.g. 90, 180, -90)
+      - flip: "direction" "horizontal" (mirror) or "vertical"
+      - grayscale: no parameters (black and white)
+      - brightness, contrast, sharpen: "factor", where 1.0 is unchanged, 1.3 is 30% more and 0.7 is 30% less
+      - blur: "radius" in pixels (2 is subtle, 10 is strong)
+    - title (optional): A concise title for the edited image. Defaults to "Edited Image".
+    - output_format (optional): "png" (default), "jpeg" or "webp".
+
+    LIMITATIONS:
+    - Only ONE edited image per request; put every edit in a single call's operations list.
+    """
@@ -0,0 +1,316 @@
+"""
+Per-process cache of the weekly generation quota.
+
+Reserving a generation in rate_limits took a database round trip per
+generation. A process now leases a few of an IP's weekly generations at a
+time (QUOTA_LEASE_SIZE) and hands them out from memory. rate_limits counts
+what has been leased, so the API and worker processes can never grant more
+than the limit between them. A refunded generation goes back into the local
+lease, and an IP the database turned away is answered from memory for
+QUOTA_DENIAL_SECONDS.
+
+A lease takes at most half of what the IP has left (rounded up), so the last
+few generations don't all end up in one process. rate_limits.leased_out counts
+the generations leased to processes and not yet settled. When the limit is
+reached while other processes still hold some of those, the IP isn't out of
+generations yet: reserve() raises QuotaHeld, the caller asks the user to retry
+shortly, and the refusal isn't remembered.
+
+Unused generations are written back behind the requests: every
+QUOTA_FLUSH_INTERVAL seconds a background thread returns the leases idle for
+QUOTA_LEASE_IDLE_SECONDS, older than QUOTA_LEASE_MAX_AGE or of past weeks,
+along with refunds that arrived after their lease was returned, in one batched
+UPDATE. Used-up leases are settled in the same batch so other processes stop
+counting them as held. Shutdown returns everything still held. A process that dies without flushing loses at
+most its unused leases for the week, so the count errs high, never over; its
+leased_out stops counting as held once the row has gone unchanged for longer
+than a lease can live.
+"""
+
+import os
+import threading
+import time
+from datetime import date
+from typing import Dict, Optional, Tuple
+
+from llm.utils import current_week_start, get_ip_leased_generations, lease_ip_generations, return_ip_generations
+
+_lease_size = int(os.getenv("QUOTA_LEASE_SIZE", "5"))
+_lease_idle_seconds = float(os.getenv("QUOTA_LEASE_IDLE_SECONDS", "60"))
+_lease_max_age = float(os.getenv("QUOTA_LEASE_MAX_AGE", "300"))
+_denial_seconds = float(os.getenv("QUOTA_DENIAL_SECONDS", "30"))
+_flush_interval = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))
+
+# (ip_address, week_start)
+QuotaKey = Tuple[str, date]
+
+
+def quota_cache_enabled() -> bool:
+    return os.getenv("QUOTA_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+class QuotaHeld(RuntimeError):
+    """Raised when an IP's remaining generations are leased by other processes, which use or return them shortly."""
+
+
+class _Lease:
+    """Generations of one IP and week held by this process."""
+
+    def __init__(self):
+        self.leased = 0
+        self.used = 0
+        self.denied_until = 0.0
+        self.last_used = time.monotonic()
+        self.leased_at = time.monotonic()
+        # Held while asking the database for more, so one request per IP goes out at a time
+        self.lock = threading.Lock()
+
+
+class QuotaCache:
+    """Leases weekly generations from rate_limits and hands them out from memory."""
+
+    def __init__(
+        self,
+        lease_size: Optional[int] = None,
+        idle_seconds: Optional[float] = None,
+        denial_seconds: Optional[float] = None,
+        max_age: Optional[float] = None,
+    ):
+        self._lease_size = max(1, _lease_size if lease_size is None else lease_size)
+        self._idle_seconds = _lease_idle_seconds if idle_seconds is None else idle_seconds
+        self._denial_seconds = _denial_seconds if denial_seconds is None else denial_seconds
+        self._max_age = _lease_max_age if max_age is None else max_age
+        # Every live process settles a lease within max_age and a flush or two, so older leased_out is stale
+        self._lease_horizon = self._max_age + 2 * _flush_interval
+        self._leases: Dict[QuotaKey, _Lease] = {}
+        # Refunds whose lease was already returned, to give back with the next flush
+        self._returns: Dict[QuotaKey, int] = {}
+        # Settled leases whose leased_out a failed flush couldn't release
+        self._releases: Dict[QuotaKey, int] = {}
+        self._lock = threading.Lock()
+        self._stats = {"local": 0, "leases": 0, "denied_locally": 0, "held_elsewhere": 0, "returned": 0, "flushes": 0, "errors": 0}
+
+    def _take(self, lease: _Lease) -> bool:
+        """Use one of a lease's generations; call with self._lock held."""
+        if lease.used >= lease.leased:
+            return False
+        lease.used += 1
+        lease.last_used = time.monotonic()
+        return True
+
+    def reserve(self, ip_address: str, limit: int) -> Optional[date]:
+        """
+        Take one of an IP's weekly generations, leasing more from Postgres when none are held.
+
+        Returns:
+            The week the generation was counted in, to pass to refund(), or None
+            if the limit is reached
+
+        Raises:
+            QuotaHeld: If the limit is reached but other processes still hold leased generations
+            psycopg.Error: If a lease was needed and the database can't be reached
+        """
+        week_start = current_week_start()
+        key = (ip_address, week_start)
+        while True:
+            with self._lock:
+                lease = self._leases.setdefault(key, _Lease())
+            with lease.lock:
+                with self._lock:
+                    # A flush returned this lease while we waited for it; start on a new one
+                    if self._leases.get(key) is not lease:
+                        continue
+                    if self._take(lease):
+                        self._stats["local"] += 1
+                        return week_start
+                    if lease.denied_until > time.monotonic():
+                        self._stats["denied_locally"] += 1
+                        return None
+
+                granted, held = lease_ip_generations(ip_address, week_start, self._lease_size, limit, lease.leased, self._lease_horizon)
+                with self._lock:
+                    self._stats["leases"] += 1
+                    if granted and not lease.leased:
+                        lease.leased_at = time.monotonic()
+                    lease.leased += granted
+                    if self._take(lease):
+                        return week_start
+                    if held:
+                        # Not remembered: the other leases are used or come back within seconds
+                        self._stats["held_elsewhere"] += 1
+                        raise QuotaHeld(f"{held} of IP {ip_address}'s generations are leased by other processes")
+                    lease.denied_until = time.monotonic() + self._denial_seconds
+                    return None
+
+    def refund(self, ip_address: str, week_start: date) -> None:
+        """Give back a generation reserved with reserve() that didn't save an image."""
+        key = (ip_address, week_start)
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease.used > 0:
+                lease.used -= 1
+            else:
+                self._returns[key] = self._returns.get(key, 0) + 1
+
+    def has_quota(self, ip_address: str) -> Optional[bool]:
+        """
+        Answer a limit check from memory when possible.
+
+        Returns:
+            True if generations are held for the IP, False if the database
+            recently turned it away, None if only the database knows
+        """
+        with self._lock:
+            lease = self._leases.get((ip_address, current_week_start()))
+            if lease is None:
+                return None
+            if lease.used < lease.leased:
+                return True
+            if lease.denied_until > time.monotonic():
+                return False
+            return None
+
+    def held_elsewhere(self, ip_address: str) -> bool:
+        """
+        Check whether other processes hold leased generations of an IP for this week.
+
+        Returns:
+            True if some are held, so an IP at its limit may get generations back
+            shortly; False if none are or the database can't be reached
+        """
+        week_start = current_week_start()
+        with self._lock:
+            lease = self._leases.get((ip_address, week_start))
+            own = lease.leased if lease is not None else 0
+        try:
+            return get_ip_leased_generations(ip_address, week_start, self._lease_horizon) > own
+        except Exception as e:
+            print(f"[QUOTA] Could not check leases held for IP {ip_address}: {e}")
+            return False
+
+    def flush(self, everything: bool = False) -> int:
+        """
+        Return idle leases' unused generations and buffered refunds to Postgres in one batch.
+
+        Used-up leases are settled in the same batch, and stay in memory only to
+        remember a refusal.
+
+        Args:
+            everything: Return every lease, e.g. on shutdown, rather than only idle and old ones
+
+        Returns:
+            The number of generations given back
+        """
+        now = time.monotonic()
+        this_week = current_week_start()
+        with self._lock:
+            unused, self._returns = self._returns, {}
+            released, self._releases = self._releases, {}
+            for key, lease in list(self._leases.items()):
+                expired = (
+                    everything
+                    or key[1] != this_week
+                    or now - lease.last_used >= self._idle_seconds
+                    or (lease.leased > 0 and now - lease.leased_at >= self._max_age)
+                )
+                used_up = lease.leased > 0 and lease.used >= lease.leased
+                if not expired and not used_up:
+                    continue
+                # Skip a lease that is being topped up; the next flush gets it
+                if not lease.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if lease.leased:
+                        released[key] = released.get(key, 0) + lease.leased
+                    if lease.leased > lease.used:
+                        unused[key] = unused.get(key, 0) + lease.leased - lease.used
+                    if expired:
+                        del self._leases[key]
+                    else:
+                        lease.leased = lease.used = 0
+                finally:
+                    lease.lock.release()
+
+        if not unused and not released:
+            return 0
+        try:
+            return_ip_generations(unused, released)
+        except Exception as e:
+            print(f"[QUOTA] Could not return unused generations, retrying on the next flush: {e}")
+            with self._lock:
+                for key, count in unused.items():
+                    self._returns[key] = self._returns.get(key, 0) + count
+                for key, count in released.items():
+                    self._releases[key] = self._releases.get(key, 0) + count
+                self._stats["errors"] += 1
+            return 0
+
+        returned = sum(unused.values())
+        with self._lock:
+            self._stats["returned"] += returned
+            self._stats["flushes"] += 1
+        return returned
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return the cache counters and what is currently held."""
+        with self._lock:
+            held = sum(lease.leased - lease.used for lease in self._leases.values())
+            return {**self._stats, "ips": len(self._leases), "held": held, "pending_returns": sum(self._returns.values())}
+
+
+_cache: Optional[QuotaCache] = None
+_cache_lock = threading.Lock()
+_flusher: Optional[threading.Thread] = None
+_flusher_stop = threading.Event()
+
+
+def get_quota_cache() -> QuotaCache:
+    """Return this process's quota cache."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QuotaCache()
+        return _cache
+
+
+def _flush_periodically(interval: float) -> None:
+    while not _flusher_stop.wait(interval):
+        try:
+            get_quota_cache().flush()
+        except Exception as e:
+            print(f"[QUOTA] Flush failed: {e}")
+
+
+def start_quota_flusher(interval: Optional[float] = None) -> None:
+    """Start the background thread returning idle leases, if it isn't running."""
+    global _flusher
+    with _cache_lock:
+        if _flusher is not None and _flusher.is_alive():
+            return
+        _flusher_stop.clear()
+        _flusher = threading.Thread(target=_flush_periodically, args=(interval or _flush_interval,), name="quota-flusher", daemon=True)
+        _flusher.start()
+
+
+def stop_quota_flusher() -> int:
+    """
+    Stop the background flush and return every lease this process holds.
+
+    Returns:
+        The number of generations given back
+    """
+    global _flusher
+    with _cache_lock:
+        flusher, _flusher = _flusher, None
+    if flusher is not None:
+        _flusher_stop.set()
+        flusher.join(timeout=5)
+    returned = get_quota_cache().flush(everything=True)
+    if returned:
+        print(f"[QUOTA] Returned {returned} unused generations on shutdown")
+    return returned
+
+
+def get_quota_cache_stats() -> Dict[str, int]:
+    """Return this process's quota cache counters."""
+    return get_quota_cache().get_stats()
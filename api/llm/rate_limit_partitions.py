@@ -0,0 +1,153 @@
+"""
+Weekly range partitions of the rate_limits table.
+
+rate_limits got a row per IP per week and nothing ever deleted them, so its
+lookups and upserts slowed down as it grew. Since the rate_limits_partitioned
+migration it is partitioned by week_start, one partition per week named
+rate_limits_pYYYYMMDD. Every request-path query filters on the current
+week_start, so Postgres prunes it to that one partition.
+
+Partitions are created RATE_LIMIT_PARTITIONS_AHEAD weeks in advance, and those
+more than RATE_LIMIT_RETENTION_WEEKS weeks old are dropped, which removes old
+counters without a DELETE. The maintenance runs the first time a process
+writes a counter in a new week, and with `python -m llm.rate_limit_partitions`.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from psycopg import sql
+
+from llm.connection_manager import get_db_connection
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_retention_weeks = int(os.getenv("RATE_LIMIT_RETENTION_WEEKS", "12"))
+_weeks_ahead = int(os.getenv("RATE_LIMIT_PARTITIONS_AHEAD", "4"))
+# Seconds before a failed maintenance is tried again
+_retry_interval = 300
+# Arbitrary key for pg_advisory_xact_lock so processes don't create the same partition at once
+_ADVISORY_LOCK_KEY = 7402114
+
+_PARTITION_NAME = re.compile(r"^rate_limits_p(\d{8})$")
+
+_maintained_week: Optional[date] = None
+_retry_at = 0.0
+_maintenance_lock = threading.Lock()
+
+
+def week_start_of(day: date) -> date:
+    """Return the Monday starting the rate limit week that contains day."""
+    return day - timedelta(days=day.weekday())
+
+
+def partition_name(week_start: date) -> str:
+    return f"rate_limits_p{week_start:%Y%m%d}"
+
+
+def oldest_retained_week(today: Optional[date] = None) -> date:
+    """Return the first week whose counters are kept."""
+    return week_start_of(today or datetime.now().date()) - timedelta(weeks=_retention_weeks)
+
+
+def create_partitions(conn, weeks: Iterable[date], parent: str = "rate_limits") -> List[str]:
+    """
+    Create the weekly partitions that don't exist yet.
+
+    Args:
+        conn: A connection, ideally inside a transaction holding the maintenance lock
+        weeks: Week starts (Mondays) to cover
+        parent: The partitioned table
+
+    Returns:
+        The names of the partitions created
+    """
+    created = []
+    for week in sorted(set(weeks)):
+        name = partition_name(week)
+        if conn.execute("SELECT to_regclass(%s) AS oid", (name,)).fetchone()["oid"] is not None:
+            continue
+        conn.execute(
+            sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})").format(
+                sql.Identifier(name), sql.Identifier(parent), sql.Literal(week), sql.Literal(week + timedelta(weeks=1))
+            )
+        )
+        created.append(name)
+    return created
+
+
+def drop_expired_partitions(conn, oldest_week: date) -> List[str]:
+    """
+    Drop the weekly partitions of weeks before oldest_week.
+
+    Returns:
+        The names of the partitions dropped
+    """
+    rows = conn.execute(
+        """
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'rate_limits'::regclass
+    """
+    ).fetchall()
+    dropped = []
+    for row in rows:
+        match = _PARTITION_NAME.match(row["relname"])
+        if match and datetime.strptime(match.group(1), "%Y%m%d").date() < oldest_week:
+            conn.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(row["relname"])))
+            dropped.append(row["relname"])
+    return sorted(dropped)
+
+
+def maintain_partitions(conn, today: Optional[date] = None) -> Dict[str, Any]:
+    """
+    Create this week's and the upcoming partitions and drop the expired ones.
+
+    Returns:
+        A dict with the "created" and "dropped" partition names
+    """
+    this_week = week_start_of(today or datetime.now().date())
+    with conn.transaction():
+        conn.execute("SELECT pg_advisory_xact_lock(%s)", (_ADVISORY_LOCK_KEY,))
+        created = create_partitions(conn, (this_week + timedelta(weeks=n) for n in range(_weeks_ahead + 1)))
+        dropped = drop_expired_partitions(conn, oldest_retained_week(this_week))
+    if created or dropped:
+        logger.info(f"rate_limits partitions created: {created or 'none'}, dropped: {dropped or 'none'}")
+    return {"created": created, "dropped": dropped}
+
+
+def ensure_partitions() -> None:
+    """
+    Run the partition maintenance once per week in this process.
+
+    A failure is logged and tried again after a few minutes; until then a
+    missing partition makes counter writes fail.
+    """
+    global _maintained_week, _retry_at
+
+    this_week = week_start_of(datetime.now().date())
+    if _maintained_week == this_week:
+        return
+    with _maintenance_lock:
+        if _maintained_week == this_week or time.monotonic() < _retry_at:
+            return
+        try:
+            with get_db_connection() as conn:
+                maintain_partitions(conn)
+        except Exception as e:
+            print(f"[PARTITIONS] rate_limits partition maintenance failed: {e}")
+            _retry_at = time.monotonic() + _retry_interval
+            return
+        _maintained_week = this_week
+
+
+if __name__ == "__main__":
+    # Run the maintenance once, e.g. from a weekly cron job
+    logging.basicConfig(level=logging.INFO)
+    with get_db_connection() as connection:
+        print(maintain_partitions(connection))
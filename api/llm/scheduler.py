@@ -0,0 +1,223 @@
+"""
+Bounded concurrency for Replicate generations.
+
+Nothing limited how many replicate.run calls a process made at once, so a burst
+of users started as many generations as there were requests: each sync one held
+a thread for the whole run, and the provider throttled us. A process now runs at
+most REPLICATE_MAX_CONCURRENCY generations at a time. Further callers wait in a
+queue of at most REPLICATE_MAX_WAITING, and give up after waiting
+REPLICATE_QUEUE_TIMEOUT seconds. A caller that finds the queue full is turned
+away at once, so the tool can tell the user to retry shortly instead of hanging.
+
+The queue is fair between users: it holds one line per user and a freed slot
+goes to the users in turn, so one user's burst can't hold everyone else back.
+Waiters are concurrent.futures.Future objects handed their slot under a lock,
+so sync callers in worker threads and async callers on the event loop share
+the same slots.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, Optional
+
+_max_concurrency = int(os.getenv("REPLICATE_MAX_CONCURRENCY", "8"))
+_max_waiting = int(os.getenv("REPLICATE_MAX_WAITING", "32"))
+_queue_timeout = float(os.getenv("REPLICATE_QUEUE_TIMEOUT", "30"))
+
+
+class GenerationBusy(RuntimeError):
+    """Raised when no generation slot can be had: the queue is full or the wait timed out."""
+
+
+class GenerationScheduler:
+    """Limits concurrent generations, queueing further callers fairly by user."""
+
+    def __init__(self, max_concurrency: Optional[int] = None, max_waiting: Optional[int] = None, queue_timeout: Optional[float] = None):
+        self._max_concurrency = max(1, _max_concurrency if max_concurrency is None else max_concurrency)
+        self._max_waiting = max(0, _max_waiting if max_waiting is None else max_waiting)
+        self._queue_timeout = _queue_timeout if queue_timeout is None else queue_timeout
+        self._running = 0
+        # user_id -> that user's waiters, in the order users get the next free slot
+        self._lines: "OrderedDict[str, Deque[Future]]" = OrderedDict()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._stats = {"started": 0, "queued": 0, "rejected": 0, "timed_out": 0, "wait_seconds": 0.0}
+
+    def _enqueue(self, user_id: str) -> Optional[Future]:
+        """
+        Take a free slot, or join the user's line.
+
+        Returns:
+            None if a slot was taken, otherwise the Future resolved when one is handed over
+
+        Raises:
+            GenerationBusy: If every slot is taken and the queue is full
+        """
+        with self._lock:
+            if self._running < self._max_concurrency and not self._waiting:
+                self._running += 1
+                self._stats["started"] += 1
+                return None
+            if self._waiting >= self._max_waiting:
+                self._stats["rejected"] += 1
+                raise GenerationBusy(f"{self._running} generations running and {self._waiting} waiting")
+            waiter: Future = Future()
+            self._lines.setdefault(user_id, deque()).append(waiter)
+            self._waiting += 1
+            self._stats["queued"] += 1
+            return waiter
+
+    def _withdraw(self, user_id: str, waiter: Future, waited: float) -> bool:
+        """
+        Take a waiter that stopped waiting out of the queue.
+
+        Returns:
+            True if it had been handed a slot in the meantime, which it now holds
+        """
+        with self._lock:
+            self._stats["wait_seconds"] += waited
+            if waiter.done():
+                self._stats["started"] += 1
+                return True
+            line = self._lines[user_id]
+            line.remove(waiter)
+            if not line:
+                del self._lines[user_id]
+            self._waiting -= 1
+            return False
+
+    def _granted(self, waited: float) -> None:
+        with self._lock:
+            self._stats["started"] += 1
+            self._stats["wait_seconds"] += waited
+
+    def _busy(self, timeout: float) -> GenerationBusy:
+        with self._lock:
+            self._stats["timed_out"] += 1
+        print(f"[SCHEDULER] Gave up waiting for a generation slot after {timeout:.0f}s")
+        return GenerationBusy(f"No generation slot within {timeout:.0f}s")
+
+    def acquire(self, user_id: str, timeout: Optional[float] = None) -> None:
+        """
+        Wait for a generation slot, blocking the calling thread.
+
+        Args:
+            user_id: The user the generation is for, whose line the caller waits in
+            timeout: Seconds to wait in the queue, REPLICATE_QUEUE_TIMEOUT by default
+
+        Raises:
+            GenerationBusy: If the queue is full or no slot was free within the timeout
+        """
+        waiter = self._enqueue(user_id)
+        if waiter is None:
+            return
+        timeout = self._queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        try:
+            waiter.result(timeout=timeout)
+        except FutureTimeoutError:
+            if not self._withdraw(user_id, waiter, time.monotonic() - start):
+                raise self._busy(timeout)
+            return
+        self._granted(time.monotonic() - start)
+
+    async def aacquire(self, user_id: str, timeout: Optional[float] = None) -> None:
+        """
+        Wait for a generation slot without blocking the event loop.
+
+        A caller cancelled while waiting leaves the queue, or passes on the slot
+        it was just handed.
+
+        Raises:
+            GenerationBusy: If the queue is full or no slot was free within the timeout
+        """
+        waiter = self._enqueue(user_id)
+        if waiter is None:
+            return
+        timeout = self._queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        try:
+            # Shielded so a timeout or cancellation doesn't cancel the waiter before it is withdrawn
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter)), timeout)
+        except BaseException as e:
+            granted = self._withdraw(user_id, waiter, time.monotonic() - start)
+            if isinstance(e, asyncio.TimeoutError):
+                if granted:
+                    return
+                raise self._busy(timeout)
+            if granted:
+                self.release()
+            raise
+        self._granted(time.monotonic() - start)
+
+    def release(self) -> None:
+        """Free a slot, handing it to the next user in line if anyone is waiting."""
+        with self._lock:
+            if self._lines:
+                user_id, line = next(iter(self._lines.items()))
+                waiter = line.popleft()
+                if line:
+                    # The user goes to the back, behind everyone else waiting
+                    self._lines.move_to_end(user_id)
+                else:
+                    del self._lines[user_id]
+                self._waiting -= 1
+                # The slot passes straight to the waiter; _running is unchanged
+                waiter.set_result(None)
+                return
+            self._running -= 1
+
+    @contextmanager
+    def slot(self, user_id: str, timeout: Optional[float] = None) -> Iterator[None]:
+        """Hold a generation slot for the block; see acquire()."""
+        self.acquire(user_id, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, user_id: str, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """Hold a generation slot for the block; see aacquire()."""
+        await self.aacquire(user_id, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return the scheduler's counters and current load."""
+        with self._lock:
+            return {
+                **self._stats,
+                "wait_seconds": round(self._stats["wait_seconds"], 3),
+                "running": self._running,
+                "waiting": self._waiting,
+                "waiting_users": len(self._lines),
+                "max_concurrency": self._max_concurrency,
+                "max_waiting": self._max_waiting,
+            }
+
+
+_scheduler: Optional[GenerationScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_generation_scheduler() -> GenerationScheduler:
+    """Return this process's generation scheduler."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = GenerationScheduler()
+        return _scheduler
+
+
+def get_generation_scheduler_stats() -> Dict[str, Any]:
+    """Return this process's generation scheduler counters."""
+    return get_generation_scheduler().get_stats()
@@ -0,0 +1,246 @@
+"""
+Versioned schema bootstrap for the tables this app owns.
+
+Migrations run once per process: the first pool creation applies whatever is
+missing, records the version in app_schema_migrations, and later reconnects
+skip the bootstrap entirely. Deployments can instead run `python -m llm.schema`
+once as a release step and set DB_SKIP_SCHEMA_BOOTSTRAP=1 on the API processes.
+"""
+
+import logging
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_bootstrap_lock = threading.Lock()
+_bootstrapped = False
+# Arbitrary key for pg_advisory_lock so concurrent processes bootstrap one at a time
+_ADVISORY_LOCK_KEY = 7402113
+
+
+def _setup_checkpointer(conn):
+    """Create the LangGraph checkpoint tables."""
+    from langgraph.checkpoint.postgres import PostgresSaver
+
+    PostgresSaver(conn).setup()
+
+
+def _create_rate_limits(conn):
+    """Create the per-IP weekly generation counter table."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            id SERIAL PRIMARY KEY,
+            ip_address VARCHAR(45) NOT NULL,
+            week_start DATE NOT NULL,
+            generation_count INTEGER DEFAULT 0,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(ip_address, week_start)
+        )
+    """
+    )
+
+
+def _create_generation_jobs(conn):
+    """Create the durable queue of image generations claimed by llm.worker."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id UUID PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            client_ip VARCHAR(45) NOT NULL,
+            prompt TEXT NOT NULL,
+            image_url TEXT NOT NULL,
+            title TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_until TIMESTAMPTZ,
+            locked_by TEXT,
+            result JSONB,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """
+    )
+    # Workers only scan jobs that can still be claimed
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS generation_jobs_claimable_idx
+        ON generation_jobs (available_at) WHERE status IN ('queued', 'running')
+    """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS generation_jobs_user_idx ON generation_jobs (user_id, created_at DESC)")
+
+
+def _create_generation_cache(conn):
+    """Create the content-addressed generation cache and its daily hit tallies."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS generation_cache (
+            cache_key CHAR(64) PRIMARY KEY,
+            model TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            image_id TEXT NOT NULL,
+            content_type TEXT NOT NULL DEFAULT 'image/png',
+            variants TEXT[] NOT NULL DEFAULT '{}',
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_hit_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """
+    )
+    # Eviction removes the least recently used entries
+    conn.execute("CREATE INDEX IF NOT EXISTS generation_cache_last_hit_idx ON generation_cache (last_hit_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS generation_cache_stats (
+            day DATE PRIMARY KEY,
+            hits BIGINT NOT NULL DEFAULT 0,
+            misses BIGINT NOT NULL DEFAULT 0
+        )
+    """
+    )
+
+
+def _create_idempotency_keys(conn):
+    """Create the store of /chat responses replayed for retried Idempotency-Keys."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint CHAR(64) NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'in_progress',
+            response JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+    """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_expires_idx ON idempotency_keys (expires_at)")
+
+
+def _partition_rate_limits(conn):
+    """Move rate_limits to weekly range partitions on week_start, keeping the retained weeks."""
+    from llm.rate_limit_partitions import create_partitions, maintain_partitions, oldest_retained_week, week_start_of
+
+    with conn.transaction():
+        existing = conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('rate_limits')").fetchone()
+        if existing is not None and existing["relkind"] == "p":
+            return
+
+        # The serial id is dropped: a partitioned table's primary key has to include week_start
+        conn.execute(
+            """
+            CREATE TABLE rate_limits_partitioned (
+                ip_address VARCHAR(45) NOT NULL,
+                week_start DATE NOT NULL,
+                generation_count INTEGER NOT NULL DEFAULT 0,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                CONSTRAINT rate_limits_ip_week_pkey PRIMARY KEY (ip_address, week_start)
+            ) PARTITION BY RANGE (week_start)
+        """
+        )
+        oldest = oldest_retained_week()
+        weeks = [
+            week_start_of(row["week_start"]) for row in conn.execute("SELECT DISTINCT week_start FROM rate_limits WHERE week_start >= %s", (oldest,))
+        ]
+        create_partitions(conn, weeks, parent="rate_limits_partitioned")
+        conn.execute(
+            """
+            INSERT INTO rate_limits_partitioned (ip_address, week_start, generation_count, last_updated)
+            SELECT ip_address, week_start, COALESCE(generation_count, 0), last_updated FROM rate_limits WHERE week_start >= %s
+        """,
+            (oldest,),
+        )
+        conn.execute("DROP TABLE rate_limits")
+        conn.execute("ALTER TABLE rate_limits_partitioned RENAME TO rate_limits")
+        # This week's partition and the upcoming ones
+        maintain_partitions(conn)
+
+
+def _add_rate_limit_leases(conn):
+    """Track how many of a row's counted generations are leased out to processes and not yet settled."""
+    conn.execute("ALTER TABLE rate_limits ADD COLUMN IF NOT EXISTS leased_out INTEGER NOT NULL DEFAULT 0")
+
+
+# Ordered migrations; a migration's version is its position in this list, starting at 1.
+# Only append new entries. Upgrading langgraph-checkpoint-postgres to a release with new
+# checkpoint migrations needs a new entry that calls _setup_checkpointer again.
+MIGRATIONS = [
+    ("checkpointer_tables", _setup_checkpointer),
+    ("rate_limits_table", _create_rate_limits),
+    ("generation_jobs_table", _create_generation_jobs),
+    ("generation_cache_tables", _create_generation_cache),
+    ("idempotency_keys_table", _create_idempotency_keys),
+    ("rate_limits_partitioned", _partition_rate_limits),
+    ("rate_limits_leased_out", _add_rate_limit_leases),
+]
+
+
+def _current_version(conn) -> int:
+    """Return the highest applied migration version, creating the version table if needed."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+    )
+    row = conn.execute("SELECT MAX(version) AS version FROM app_schema_migrations").fetchone()
+    return row["version"] or 0
+
+
+def is_schema_bootstrapped() -> bool:
+    """Return True if this process has already bootstrapped the schema."""
+    return _bootstrapped
+
+
+def bootstrap_schema(pool) -> bool:
+    """
+    Apply pending migrations once per process.
+
+    Args:
+        pool: A psycopg ConnectionPool configured with autocommit and dict rows
+
+    Returns:
+        True if the bootstrap ran, False if this process had already done it
+    """
+    global _bootstrapped
+
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return False
+
+        start = time.perf_counter()
+        with pool.connection() as conn:
+            conn.execute("SELECT pg_advisory_lock(%s)", (_ADVISORY_LOCK_KEY,))
+            try:
+                version = _current_version(conn)
+                for next_version, (name, migrate) in enumerate(MIGRATIONS[version:], start=version + 1):
+                    logger.info(f"Applying schema migration {next_version}: {name}")
+                    migrate(conn)
+                    conn.execute("INSERT INTO app_schema_migrations (version, name) VALUES (%s, %s)", (next_version, name))
+            finally:
+                conn.execute("SELECT pg_advisory_unlock(%s)", (_ADVISORY_LOCK_KEY,))
+
+        _bootstrapped = True
+        logger.info(f"Schema is at version {len(MIGRATIONS)} (bootstrap took {time.perf_counter() - start:.3f}s)")
+        return True
+
+
+if __name__ == "__main__":
+    # Run the bootstrap once, e.g. as a deployment release step
+    from psycopg_pool import ConnectionPool
+
+    from llm.connection_manager import _connection_kwargs, _get_database_url
+
+    logging.basicConfig(level=logging.INFO)
+    with ConnectionPool(_get_database_url(), min_size=1, max_size=1, kwargs=_connection_kwargs) as pool:
+        bootstrap_schema(pool)
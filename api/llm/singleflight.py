@@ -0,0 +1,123 @@
+"""
+In-flight deduplication of identical work.
+
+Double-clicks, client retries and the agent calling a tool twice can start the
+same expensive call several times at once. A SingleFlight runs the first call for
+a key (the leader) and has every concurrent call with that key (the followers)
+wait for the leader's result instead of starting its own. Once the leader
+finishes the key is released, so later calls run again.
+
+Flights are tracked with concurrent.futures.Future under a lock, so sync callers
+in worker threads and async callers on any event loop share them.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class FlightAbandoned(Exception):
+    """Raised to followers when their leader was cancelled before producing a result."""
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution."""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {"leaders": 0, "coalesced": 0}
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        """Return the key's in-flight future and whether the caller is its leader."""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return future, False
+            future = self._flights[key] = Future()
+            self._stats["leaders"] += 1
+            return future, True
+
+    def _release(self, key: Hashable, future: Future) -> None:
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+
+    def _settle(self, key: Hashable, future: Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        """Release the key and hand the leader's outcome to its followers."""
+        self._release(key, future)
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            # Cancelled or interrupted: followers start over rather than fail
+            future.set_exception(FlightAbandoned())
+
+    def do(self, key: Hashable, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Call fn, or wait for the identical call already in flight for key.
+
+        Args:
+            key: Identifies calls that may share a result
+            fn: The work to run if no call for key is in flight
+
+        Returns:
+            fn's result, shared with every concurrent caller of the same key
+
+        Raises:
+            Exception: Whatever fn raised, in the leader and every follower
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    self._settle(key, future, error=e)
+                    raise
+                self._settle(key, future, result)
+                return result
+            try:
+                return future.result()
+            except FlightAbandoned:
+                continue
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Await fn(), or wait for the identical call already in flight for key.
+
+        A follower that is cancelled stops waiting without affecting the leader.
+        A leader that is cancelled hands the key to one of its followers.
+
+        Args:
+            key: Identifies calls that may share a result
+            fn: Returns the awaitable to run if no call for key is in flight
+
+        Returns:
+            The awaitable's result, shared with every concurrent caller of the same key
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = await fn()
+                except BaseException as e:
+                    self._settle(key, future, error=e)
+                    raise
+                self._settle(key, future, result)
+                return result
+            try:
+                # Shielded so a cancelled follower doesn't cancel the shared future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except FlightAbandoned:
+                continue
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return how many calls led a flight and how many joined one."""
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._flights)}
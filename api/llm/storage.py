@@ -0,0 +1,367 @@
+"""
+Process-wide S3 client and presigned URL cache.
+
+Building a boto3 client loads service models and creates a new connection pool,
+which costs tens of milliseconds per call. The client is created once, with a
+connection pool sized for concurrent uploads and presigns, TCP keep-alive and
+botocore's standard retry mode. boto3 clients are thread-safe once created, so
+worker threads and the event loop's thread pool all share it.
+
+Presigned GET URLs are cached per (bucket, key) so the upload, the chat response
+and gallery refreshes don't re-sign the same object while its URL is still fresh.
+"""
+
+import io
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import IO, Any, Dict, List, Optional, Protocol, Tuple, Union
+from urllib.parse import unquote, urlsplit
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+_s3_client: Optional[Any] = None
+_s3_client_lock = threading.Lock()
+
+# Presigned GET URLs keyed by (bucket, key), most recently used last
+PRESIGN_EXPIRES_IN = 7200  # 2 hours
+_presign_cache: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+_presign_cache_lock = threading.Lock()
+_presign_cache_size = int(os.getenv("PRESIGN_CACHE_SIZE", "10000"))
+# Cached URLs are handed out only while at least this many seconds of their lifetime remain
+_presign_min_remaining = int(os.getenv("PRESIGN_CACHE_MIN_REMAINING", "1800"))
+_presign_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _s3_config() -> Config:
+    """Build the botocore config for the shared client."""
+    return Config(
+        max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20")),
+        tcp_keepalive=True,
+        connect_timeout=float(os.getenv("S3_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(os.getenv("S3_READ_TIMEOUT", "60")),
+        retries={"mode": os.getenv("S3_RETRY_MODE", "standard"), "max_attempts": int(os.getenv("S3_MAX_ATTEMPTS", "3"))},
+    )
+
+
+def get_s3_client():
+    """
+    Get the shared S3 client, creating it on first use.
+
+    Returns:
+        A boto3 S3 client configured from the AWS_* environment variables
+    """
+    global _s3_client
+
+    if _s3_client is not None:
+        return _s3_client
+
+    with _s3_client_lock:
+        # Another thread may have created it while we waited
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                "s3",
+                region_name=os.environ.get("AWS_REGION", "us-east-1"),
+                aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+                config=_s3_config(),
+            )
+            print("[STORAGE] Created shared S3 client")
+        return _s3_client
+
+
+def get_transfer_config() -> TransferConfig:
+    """
+    Build the TransferConfig for streamed uploads.
+
+    Streams are uploaded in parts of S3_MULTIPART_CHUNK_MB (S3's minimum is 5 MB),
+    S3_UPLOAD_CONCURRENCY at a time. At most that many parts are held in memory, so
+    peak memory per upload is bounded by chunk size times concurrency, not image size.
+    """
+    chunk_size = int(os.getenv("S3_MULTIPART_CHUNK_MB", "8")) * 1024 * 1024
+    concurrency = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+    config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size, max_concurrency=concurrency)
+    # boto3 doesn't expose this s3transfer setting, which defaults to 10 buffered parts
+    config.max_in_memory_upload_chunks = concurrency
+    return config
+
+
+class ChunkPipe:
+    """
+    File-like object fed chunk by chunk from another thread or the event loop.
+
+    Lets an async download feed a blocking S3 upload running in a worker thread.
+    Only max_chunks chunks are buffered; the writer blocks until the reader catches up.
+    """
+
+    _EOF = object()
+
+    def __init__(self, max_chunks: int = 4):
+        self._chunks: queue.Queue = queue.Queue(maxsize=max_chunks)
+        self._current = memoryview(b"")
+        self._done = False
+        self.closed = False
+
+    def write_chunk(self, item: Union[bytes, BaseException, object]) -> None:
+        """
+        Queue a chunk, blocking while the buffer is full.
+
+        Raises:
+            BrokenPipeError: If the reader has closed the pipe
+        """
+        while True:
+            if self.closed:
+                raise BrokenPipeError("The reader closed the pipe")
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Signal the end of the stream, or make the reader raise error."""
+        try:
+            self.write_chunk(error if error is not None else self._EOF)
+        except BrokenPipeError:
+            pass
+
+    def read(self, size: int = -1) -> bytes:
+        """Read size bytes (all remaining if negative), blocking until they arrive or the stream ends."""
+        parts = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if not self._current:
+                if self._done:
+                    break
+                item = self._chunks.get()
+                if item is self._EOF:
+                    self._done = True
+                    break
+                if isinstance(item, BaseException):
+                    self._done = True
+                    raise item
+                self._current = memoryview(item)
+                continue
+            take = self._current if size < 0 else self._current[:remaining]
+            parts.append(bytes(take))
+            self._current = self._current[len(take) :]
+            remaining -= len(take)
+        return b"".join(parts)
+
+    def close(self) -> None:
+        """Stop reading; a blocked writer gets BrokenPipeError."""
+        self.closed = True
+
+
+class ReadableStream(Protocol):
+    """A stream an image can be uploaded from: a file, an HTTP response body, a ChunkPipe or a TeeReader."""
+
+    def read(self, size: int = -1, /) -> bytes: ...
+
+
+class TeeReader:
+    """
+    File-like wrapper that keeps a copy of what is read from a stream.
+
+    Lets an image be post-processed after it was streamed into S3 without
+    downloading it twice. The copy is held in memory up to spool_bytes and
+    spilled to a temporary file beyond that, so keeping it doesn't undo the
+    bounded memory of the streamed upload. Copying stops once more than limit
+    bytes have been read. Call discard() once the copy is no longer needed.
+    """
+
+    def __init__(self, stream: ReadableStream, limit: int, spool_bytes: int = 1024 * 1024):
+        self._stream = stream
+        self._limit = limit
+        self._spool_bytes = spool_bytes
+        self._size = 0
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._file: Optional[IO[bytes]] = None
+        self._discarded = False
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        if data and not self._discarded:
+            self._size += len(data)
+            if self._size > self._limit:
+                self.discard()
+            elif self._file is not None:
+                self._file.write(data)
+            elif self._buffer is not None and self._size > self._spool_bytes:
+                self._file = tempfile.NamedTemporaryFile(prefix="tee-", delete=False)
+                self._file.write(self._buffer.getvalue())
+                self._file.write(data)
+                self._buffer = None
+            elif self._buffer is not None:
+                self._buffer.write(data)
+        return data
+
+    def captured(self) -> Optional[Union[bytes, str]]:
+        """
+        Return everything read so far.
+
+        Returns:
+            The bytes, or the path of the temporary file they were spilled to,
+            or None if the stream outgrew the limit
+        """
+        if self._file is not None:
+            self._file.flush()
+            return self._file.name
+        return self._buffer.getvalue() if self._buffer is not None else None
+
+    def discard(self) -> None:
+        """Drop the copy, deleting its temporary file if it was spilled."""
+        self._discarded = True
+        self._buffer = None
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._file.name)
+            except OSError:
+                pass
+            self._file = None
+
+
+def reset_s3_client() -> None:
+    """Drop the shared client so the next call builds a new one (e.g. after credentials change)."""
+    global _s3_client
+
+    with _s3_client_lock:
+        _s3_client = None
+    # URLs signed with the old client's credentials may not outlive them
+    clear_presign_cache()
+
+
+def image_key(user_id: str, image_id: str) -> str:
+    """Return the S3 key of a user's image."""
+    return f"users/{user_id}/images/{image_id}"
+
+
+def image_variant_key(user_id: str, image_id: str, variant: str) -> str:
+    """Return the S3 key of a variant (e.g. "webp" or "thumb") stored next to a user's image."""
+    return f"{image_key(user_id, image_id)}.{variant}"
+
+
+# S3 endpoint hosts: s3.amazonaws.com, s3.<region>.amazonaws.com, s3-<region>.amazonaws.com and the like
+_S3_ENDPOINT_HOST = re.compile(r"^s3(?:[.-][a-z0-9-]+)*\.amazonaws\.com$")
+
+
+def user_object_key(url: str, user_id: str) -> Optional[str]:
+    """
+    Return the key of the object a URL points to, if it is one of the user's objects in our bucket.
+
+    Image URLs reach the tools from the model, so they can't be trusted: only an
+    https URL of the AWS_S3_BUCKET_NAME bucket, in virtual-hosted or path style,
+    with a key under users/{user_id}/ is accepted.
+
+    Args:
+        url: The URL to check, e.g. a presigned GET URL
+        user_id: The user the object must belong to
+
+    Returns:
+        The object key, or None if the URL is anything else
+    """
+    bucket = os.environ.get("AWS_S3_BUCKET_NAME")
+    if not bucket or not user_id:
+        return None
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return None
+    host = (parts.hostname or "").lower()
+    if parts.scheme != "https" or port is not None or parts.username is not None:
+        return None
+    if host.startswith(f"{bucket}.") and _S3_ENDPOINT_HOST.match(host[len(bucket) + 1 :]):
+        key = unquote(parts.path[1:])
+    elif _S3_ENDPOINT_HOST.match(host) and parts.path.startswith(f"/{bucket}/"):
+        key = unquote(parts.path[len(bucket) + 2 :])
+    else:
+        return None
+    if not key.startswith(f"users/{user_id}/") or any(segment in (".", "..") for segment in key.split("/")):
+        return None
+    return key
+
+
+def presign_get_url(bucket: str, key: str) -> str:
+    """
+    Return a presigned GET URL for an object, reusing a cached one while it is fresh.
+
+    A URL is served from the cache while more than PRESIGN_CACHE_MIN_REMAINING seconds
+    of its lifetime remain, so clients always get at least that long to use it, and is
+    re-signed once it gets closer to expiry. The cache keeps the PRESIGN_CACHE_SIZE
+    most recently used keys.
+
+    Args:
+        bucket: S3 bucket name
+        key: Object key
+
+    Returns:
+        A URL valid for PRESIGN_EXPIRES_IN seconds from when it was signed
+    """
+    return presign_get_urls(bucket, [key])[key]
+
+
+def get_presign_cache_stats() -> Dict[str, int]:
+    """Return presigned URL cache hit/miss/eviction counters and its current size."""
+    with _presign_cache_lock:
+        return {**_presign_stats, "size": len(_presign_cache), "max_size": _presign_cache_size}
+
+
+def clear_presign_cache() -> None:
+    """Empty the presigned URL cache (its counters are kept)."""
+    with _presign_cache_lock:
+        _presign_cache.clear()
+
+
+def presign_get_urls(bucket: str, keys: List[str]) -> Dict[str, str]:
+    """
+    Presign GET URLs for many keys at once, reusing fresh cached URLs.
+
+    boto3 signs locally, without a network round trip, so keys missing from the
+    cache are simply signed one by one.
+
+    Args:
+        bucket: S3 bucket name
+        keys: Object keys
+
+    Returns:
+        Dict mapping each key to its URL
+    """
+    now = time.time()
+    urls: Dict[str, str] = {}
+    missing: List[str] = []
+    with _presign_cache_lock:
+        for key in dict.fromkeys(keys):
+            cached = _presign_cache.get((bucket, key))
+            if cached and cached[1] - now > _presign_min_remaining:
+                _presign_cache.move_to_end((bucket, key))
+                urls[key] = cached[0]
+            else:
+                missing.append(key)
+        _presign_stats["hits"] += len(urls)
+        _presign_stats["misses"] += len(missing)
+
+    if not missing:
+        return urls
+
+    client = get_s3_client()
+    signed = {
+        key: client.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=PRESIGN_EXPIRES_IN) for key in missing
+    }
+    urls.update(signed)
+
+    with _presign_cache_lock:
+        for key, url in signed.items():
+            _presign_cache[(bucket, key)] = (url, now + PRESIGN_EXPIRES_IN)
+            _presign_cache.move_to_end((bucket, key))
+        while len(_presign_cache) > _presign_cache_size:
+            _presign_cache.popitem(last=False)
+            _presign_stats["evictions"] += 1
+    return urls
@@ -1,16 +1,77 @@
+import asyncio
 import uuid
-from typing import Dict, Optional
+from datetime import date
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 import replicate
 from dotenv import load_dotenv
+from langchain_core.callbacks import adispatch_custom_event
 from langchain_core.runnables import RunnableConfig, RunnableLambda
 from pydantic import BaseModel
 
-from llm.prompt import generate_image_tool_description
-from llm.utils import create_or_update_ip_generation_count, get_ip_generation_count, store_tool_result, upload_generated_image_to_s3
+from llm.edits import EditError, apply_edits, describe_edits
+from llm.generation_cache import (
+    forget_generation,
+    generation_cache_enabled,
+    generation_cache_key,
+    input_image_digest,
+    lookup_generation,
+    normalize_prompt,
+    record_cache_error,
+    store_generation,
+)
+from llm.http_client import get_async_http_client, get_http_session
+from llm.images import (
+    VARIANT_MAX_SOURCE_BYTES,
+    VARIANT_SPOOL_BYTES,
+    ImageSource,
+    ImageURLNotAllowed,
+    aprepare_input_image_url,
+    create_image_variants,
+    enabled_variants,
+    fetch_image,
+    prepare_input_image_url,
+)
+from llm.job_queue import enqueue_generation, to_job_snapshot
+from llm.jobs import JobQueueFull, get_generation_mode, submit_job
+from llm.prompt import edit_image_tool_description, generate_image_tool_description
+from llm.quota import QuotaHeld, get_quota_cache, quota_cache_enabled
+from llm.scheduler import GenerationBusy, get_generation_scheduler
+from llm.singleflight import SingleFlight
+from llm.storage import ChunkPipe, ReadableStream, TeeReader
+from llm.utils import (
+    copy_generated_image,
+    get_ip_generation_count,
+    refund_ip_generation,
+    reserve_ip_generation,
+    store_tool_result,
+    upload_generated_image_to_s3,
+    upload_image_variants,
+)
 
 load_dotenv()
 
+# True for testing purposes
+_USE_SDXL = False
+
+# Generations each IP can make per week
+GENERATION_LIMIT = 10
+
+# Tool reply when generations are backed up; the reserved generation is given back
+BUSY_MESSAGE = "Image generation is busy right now. Please try again in a minute."
+# Tool reply when the weekly limit is reached but other processes still hold some of it leased
+QUOTA_HELD_MESSAGE = "Image generation is temporarily unavailable. Please try again shortly."
+
+# Size of the chunks handed from the async download to the S3 upload
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+# Identical generations in flight for a user, shared by their concurrent callers
+_generation_flight = SingleFlight()
+
+# Tools that store an image result for the agent to return with its reply
+IMAGE_TOOL_NAMES = ("generate_image", "edit_image")
+
 
 # The generate_image tool's input schema
 class GenerateImageToolInput(BaseModel):
@@ -20,26 +81,90 @@ class GenerateImageToolInput(BaseModel):
     title: Optional[str] = "Generated Image"
 
 
-# The core function that generates an image of the tool
-def _generate_image_core(
-    prompt: str,
-    user_id: str,
-    image_url: str,
-    title: str,
-    client_ip: str,
-) -> str:
-    """
-    Generate an image based on a prompt.
-    """
-    print(f"[TOOL] generate_image called with prompt: {prompt[:50]}..., user_id: {user_id}, image_url: {image_url[:50]}...")
+# The edit_image tool's input schema: one step of the edit, with only its own parameters set
+class ImageEditOperation(BaseModel):
+    op: Literal["crop", "resize", "rotate", "flip", "grayscale", "brightness", "contrast", "blur", "sharpen"]
+    aspect_ratio: Optional[str] = None
+    left: Optional[float] = None
+    top: Optional[float] = None
+    right: Optional[float] = None
+    bottom: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    degrees: Optional[float] = None
+    direction: Optional[Literal["horizontal", "vertical"]] = None
+    factor: Optional[float] = None
+    radius: Optional[float] = None
+
+
+class EditImageToolInput(BaseModel):
+    user_id: str
+    image_url: str
+    operations: List[ImageEditOperation]
+    title: Optional[str] = "Edited Image"
+    output_format: Optional[Literal["png", "jpeg", "webp"]] = "png"
 
-    # Check if the user has exceeded the generation limit
-    if get_ip_generation_count(client_ip) >= 10:
-        print("[TOOL] User exceeded the generation limit of 10 this week.")
-        return "Failed as user exceeded the max generation limit of 10 this week."
 
-    use_sdxl = False  # True for testing purposes
-    if use_sdxl:
+def _limit_message() -> str:
+    print(f"[TOOL] User exceeded the generation limit of {GENERATION_LIMIT} this week.")
+    return f"Failed as user exceeded the max generation limit of {GENERATION_LIMIT} this week."
+
+
+def _check_generation_limit(client_ip: str) -> Optional[str]:
+    """Return a failure message if the IP has used up its weekly generations, else None."""
+    has_quota = get_quota_cache().has_quota(client_ip) if quota_cache_enabled() else None
+    if has_quota is None:
+        has_quota = get_ip_generation_count(client_ip) < GENERATION_LIMIT
+        # Generations leased to other processes may still come back
+        if not has_quota and quota_cache_enabled() and get_quota_cache().held_elsewhere(client_ip):
+            return QUOTA_HELD_MESSAGE
+    return None if has_quota else _limit_message()
+
+
+def _reserve_generation(client_ip: str) -> Tuple[Optional[Dict[str, Any]], Optional[date]]:
+    """
+    Take one of the IP's weekly generations before generating.
+
+    With the quota cache on (QUOTA_CACHE_ENABLED) the generation usually comes
+    out of a lease held in memory. If the counter can't be reached the
+    generation goes ahead uncounted, as it did when the count was only read.
+
+    Returns:
+        A tuple of (the failed tool result if no generation can be had, the
+        reserved week to refund if the generation doesn't save an image). The
+        result is marked limit_reached only when the limit is really used up;
+        while other processes hold some of it leased it is marked busy, so a
+        queued job is retried.
+    """
+    try:
+        if quota_cache_enabled():
+            week_start = get_quota_cache().reserve(client_ip, GENERATION_LIMIT)
+        else:
+            week_start = reserve_ip_generation(client_ip, GENERATION_LIMIT)
+    except QuotaHeld as e:
+        print(f"[TOOL] No generation free for IP {client_ip} yet: {e}")
+        return {"success": False, "message": QUOTA_HELD_MESSAGE, "busy": True}, None
+    except Exception as e:
+        print(f"[TOOL] Could not reserve a generation for IP {client_ip}, continuing uncounted: {e}")
+        return None, None
+    if week_start is None:
+        return {"success": False, "message": _limit_message(), "limit_reached": True}, None
+    return None, week_start
+
+
+def _refund_generation(client_ip: str, week_start: Optional[date]) -> None:
+    """Give back a reserved generation that didn't save a new image."""
+    if week_start is None:
+        return
+    if quota_cache_enabled():
+        get_quota_cache().refund(client_ip, week_start)
+    else:
+        refund_ip_generation(client_ip, week_start)
+
+
+def _build_replicate_request(prompt: str, image_url: str) -> Tuple[str, Dict[str, Any]]:
+    """Return the Replicate model reference and input for a generation."""
+    if _USE_SDXL:
         input = {
             "width": 768,
             "height": 768,
@@ -53,67 +178,85 @@ def _generate_image_core(
             "output_format": "png",
         }
         version = "stability-ai/sdxl:" "7762fd07cf82c948538e41f63f77d685e02b063e37e496e96eefd46c929f9bdc"
-        output = replicate.run(
-            version,
-            input=input,
-        )
-        generated_image_url = output[0] if isinstance(output, list) else output
-    else:  # Flux Kontext Pro
-        # Generate image using Replicate
-        input = {
-            "prompt": prompt,
-            "input_image": image_url,
-            "output_format": "png",
-        }
-        output = replicate.run(
-            "black-forest-labs/flux-kontext-pro",
-            input=input,
-        )
-        print(f"[TOOL] Replicate output: {output}")
-        print(f"[TOOL] Output type: {type(output)}")
-        print(f"[TOOL] Output length: {len(output) if hasattr(output, '__len__') else 'N/A'}")
+        return version, input
 
-        # Check if generation was successful
-        if not output or (hasattr(output, "__len__") and len(output) == 0):
-            print("[TOOL] Replicate generation failed - no output")
-            return "Failed to generate image. Please try again."
+    # Flux Kontext Pro
+    input = {
+        "prompt": prompt,
+        "input_image": image_url,
+        "output_format": "png",
+    }
+    return "black-forest-labs/flux-kontext-pro", input
 
-        # Flux Kontext Pro returns a string URL
-        generated_image_url = str(output)
-        print(f"[TOOL] Generated image URL: {generated_image_url}")
 
-    # Handle Flux Kontext Pro output format
-    image_data: Optional[bytes] = None
+def _extract_generated_image_url(output: Any) -> Optional[str]:
+    """Return the generated image URL from a Replicate output, or None if generation failed."""
+    print(f"[TOOL] Replicate output: {output}")
+    print(f"[TOOL] Output type: {type(output)}")
+    print(f"[TOOL] Output length: {len(output) if hasattr(output, '__len__') else 'N/A'}")
 
-    try:
-        # Download the image from the URL
-        import requests
+    # Check if generation was successful
+    if not output or (hasattr(output, "__len__") and len(output) == 0):
+        print("[TOOL] Replicate generation failed - no output")
+        return None
 
-        response = requests.get(generated_image_url)
-        response.raise_for_status()
-        image_data = response.content
-        print(f"[TOOL] Downloaded image data, size: {len(image_data)} bytes")
+    # SDXL returns a list of URLs, Flux Kontext Pro returns a single URL
+    generated_image_url = str(output[0] if isinstance(output, list) else output)
+    print(f"[TOOL] Generated image URL: {generated_image_url}")
+    return generated_image_url
 
-    except Exception as e:
-        print(f"[TOOL] Error processing output: {e}")
-        return f"Failed to process generated image: {str(e)}"
 
-    # Check if we successfully got image data
+def _store_image_variants(user_id: str, image_id: str, image_data: Optional[ImageSource], variants: List[str]) -> List[str]:
+    """Render and upload the image's gallery variants, returning the names stored (none on failure)."""
     if image_data is None:
-        return "Failed to get image data from generation output"
+        print(f"[TOOL] Image {image_id} is too large for variants, storing the original only")
+        return []
+    try:
+        rendered = create_image_variants(image_data, variants)
+        stored = upload_image_variants(user_id, image_id, rendered)
+    except Exception as e:
+        print(f"[TOOL] Failed to create variants for image {image_id}: {e}")
+        return []
+    sizes = ", ".join(f"{name} {len(rendered[name][0])}" for name in stored)
+    print(f"[TOOL] Stored variants of image {image_id}: {sizes}")
+    return stored
+
 
-    # Update or create a new generation count by + 1 for this ip address
-    create_or_update_ip_generation_count(client_ip)
+def _success_message(image_id: str, title: str) -> str:
+    """The tool's reply once a generated image is in the user's gallery."""
+    return f"Image generated successfully! User can find it his/her gallery. Image ID: {image_id}, Title: {title}"
 
+
+def _save_generated_image(
+    image_data: Union[bytes, ReadableStream], user_id: str, prompt: str, title: str, store_result: bool = True
+) -> Dict[str, Any]:
+    """
+    Upload the image and its variants to S3 and store the tool result.
+
+    Args:
+        image_data: The image bytes, or a stream of them that is uploaded while it is read
+
+    Returns:
+        A dict with "success" and the tool's "message", plus "image_id", "title",
+        "prompt" and the stored "variants" when the image was saved
+    """
     # Generate unique ID for the image
     image_id = str(uuid.uuid4())
 
+    # Keep a copy of a streamed image while it uploads, for rendering its variants; past
+    # IMAGE_VARIANT_SPOOL_BYTES it goes to a temporary file the variant pool reads
+    variants = enabled_variants()
+    tee: Optional[TeeReader] = None
+    if variants and not isinstance(image_data, bytes):
+        tee = TeeReader(image_data, VARIANT_MAX_SOURCE_BYTES, VARIANT_SPOOL_BYTES)
+
     # Upload to S3
     print(f"[TOOL] Uploading to S3 with image_id: {image_id}")
-    print(f"[TOOL] Image data size: {len(image_data)} bytes")
+    if isinstance(image_data, bytes):
+        print(f"[TOOL] Image data size: {len(image_data)} bytes")
     try:
         s3_result = upload_generated_image_to_s3(
-            image_data=image_data,
+            image_data=tee or image_data,
             image_id=image_id,
             user_id=user_id,
             prompt=prompt,
@@ -123,33 +266,357 @@ def _generate_image_core(
         print(f"[TOOL] S3 upload success: {s3_result.get('success', False)}")
 
         if s3_result["success"]:
+            stored_variants = []
+            if variants:
+                source: Optional[ImageSource] = tee.captured() if tee is not None else image_data if isinstance(image_data, bytes) else None
+                stored_variants = _store_image_variants(user_id, image_id, source, variants)
+
             # Store structured result for the agent to retrieve
-            tool_result = {"image_id": image_id, "title": title, "prompt": prompt, "success": True}
-            print(f"[TOOL] About to store tool result: {tool_result}")
-            store_tool_result(user_id, "generate_image", tool_result)
-            print("[TOOL] Tool result stored successfully")
+            tool_result = {"image_id": image_id, "title": title, "prompt": prompt, "variants": stored_variants, "success": True}
+            if store_result:
+                print(f"[TOOL] About to store tool result: {tool_result}")
+                store_tool_result(user_id, "generate_image", tool_result)
+                print("[TOOL] Tool result stored successfully")
 
-            result_msg = f"Image generated successfully! User can find it his/her gallery. \
-                Image ID: {image_id}, Title: {title}"
+            result_msg = _success_message(image_id, title)
             print(f"[TOOL] Returning success: {result_msg}")
-            return result_msg
+            return {**tool_result, "message": result_msg}
         else:
             error_msg = f"Image generated but failed to save: {s3_result.get('error', 'Unknown error')}"
             print(f"[TOOL] Returning error: {error_msg}")
-            return error_msg
+            return {"success": False, "message": error_msg}
 
     except Exception as e:
         error_msg = f"Image generated but failed to save to storage: {str(e)}"
         print(f"[TOOL] Exception during S3 upload: {error_msg}")
-        return error_msg
+        return {"success": False, "message": error_msg}
+    finally:
+        if tee is not None:
+            tee.discard()
+
+
+def _cache_key_for(model: str, model_input: Dict[str, Any]) -> Optional[str]:
+    """Return the generation cache key of a request, or None when the cache is off."""
+    return generation_cache_key(model, model_input) if generation_cache_enabled() else None
+
+
+def _serve_cached_generation(cache_key: str, user_id: str, prompt: str, title: str, store_result: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Copy a cached generation into the user's gallery instead of generating it again.
+
+    The copy doesn't use up a generation. A lookup that fails, or an
+    entry whose image can't be copied any more, is treated as a miss.
+
+    Returns:
+        A result shaped like _save_generated_image's, or None on a miss
+    """
+    try:
+        cached = lookup_generation(cache_key)
+    except Exception as e:
+        print(f"[TOOL] Generation cache lookup failed: {e}")
+        record_cache_error()
+        return None
+    if not cached:
+        return None
+
+    image_id = str(uuid.uuid4())
+    copy_result = copy_generated_image(
+        cached["user_id"], cached["image_id"], user_id, image_id, prompt, title, list(cached["variants"]), cached["content_type"]
+    )
+    if not copy_result["success"]:
+        print(f"[TOOL] Cached image {cached['image_id']} could not be copied, generating again: {copy_result.get('error')}")
+        try:
+            forget_generation(cache_key)
+        except Exception as e:
+            print(f"[TOOL] Could not drop generation cache entry: {e}")
+        return None
+
+    print(f"[TOOL] Served generation from cache: image {cached['image_id']} copied as {image_id}")
+    tool_result = {"image_id": image_id, "title": title, "prompt": prompt, "variants": copy_result["variants"], "success": True}
+    if store_result:
+        store_tool_result(user_id, "generate_image", tool_result)
+    return {**tool_result, "message": _success_message(image_id, title)}
+
+
+def _remember_generation(cache_key: Optional[str], model: str, user_id: str, result: Dict[str, Any]) -> None:
+    """Record a saved generation in the cache so identical requests can reuse it."""
+    if not cache_key or not result.get("success"):
+        return
+    try:
+        store_generation(cache_key, model, user_id, result["image_id"], result.get("variants") or [])
+    except Exception as e:
+        print(f"[TOOL] Could not record generation in the cache: {e}")
+        record_cache_error()
+
+
+async def _report_progress(stage: str, config: Optional[RunnableConfig], **details: Any) -> None:
+    """Emit a generation_progress custom event, surfaced by astream_events for streaming clients."""
+    if config is None:
+        return
+    try:
+        await adispatch_custom_event("generation_progress", {"stage": stage, **details}, config=config)
+    except Exception as e:
+        print(f"[TOOL] Could not report progress '{stage}': {e}")
+
+
+def _flight_key(user_id: str, prompt: str, image_url: str) -> Tuple[str, str, str]:
+    """Identify generations that are the same request, e.g. a double-click or a retried tool call."""
+    return user_id, normalize_prompt(prompt), input_image_digest(image_url)
+
+
+def _store_generation_result(user_id: str, result: Dict[str, Any]) -> None:
+    """Store a saved generation as the generate_image tool result of the user's current turn."""
+    if result.get("success"):
+        store_tool_result(user_id, "generate_image", {name: value for name, value in result.items() if name != "message"})
+
+
+def get_generation_flight_stats() -> Dict[str, int]:
+    """Return how many generations ran and how many joined an identical one in flight."""
+    return _generation_flight.get_stats()
+
+
+def _run_generation(
+    prompt: str,
+    user_id: str,
+    image_url: str,
+    title: str,
+    client_ip: str,
+    store_result: bool = True,
+) -> Dict[str, Any]:
+    """
+    Generate, download and save an image, returning a structured result.
+
+    An identical generation already running for the user, sync or async, is
+    joined instead of started again; every caller gets the one saved image.
+
+    Args:
+        store_result: Whether to store the tool result for the agent's current turn.
+            Background jobs report their image through the job instead.
+
+    Returns:
+        A dict with "success" and the tool's "message", plus "image_id", "title",
+        "prompt" and the stored "variants" when the image was saved
+    """
+    print(f"[TOOL] generate_image called with prompt: {prompt[:50]}..., user_id: {user_id}, image_url: {image_url[:50]}...")
+
+    result = _generation_flight.do(_flight_key(user_id, prompt, image_url), _generate_and_save, prompt, user_id, image_url, title, client_ip)
+    if store_result:
+        _store_generation_result(user_id, result)
+    return result
+
 
+def _generate_and_save(prompt: str, user_id: str, image_url: str, title: str, client_ip: str) -> Dict[str, Any]:
+    """Run one generation for _run_generation, without storing the tool result."""
+    # Generate image using Replicate, from a downscaled copy of the source image
+    model, model_input = _build_replicate_request(prompt, prepare_input_image_url(image_url, user_id))
+    # A cache hit doesn't use a generation, so it is looked up before the weekly limit is checked
+    cache_key = _cache_key_for(model, model_input)
+    cached = _serve_cached_generation(cache_key, user_id, prompt, title, store_result=False) if cache_key else None
+    if cached:
+        return cached
+
+    # Take one of the weekly generations before generating; it is given back unless a new image is saved
+    failure, reserved_week = _reserve_generation(client_ip)
+    if failure:
+        return failure
+
+    saved = False
+    try:
+        # At most REPLICATE_MAX_CONCURRENCY generations run at once; callers beyond the queue are turned away
+        try:
+            with get_generation_scheduler().slot(user_id):
+                output = replicate.run(model, input=model_input)
+        except GenerationBusy as e:
+            print(f"[TOOL] Generation not started: {e}")
+            return {"success": False, "message": BUSY_MESSAGE, "busy": True}
+        generated_image_url = _extract_generated_image_url(output)
+        if not generated_image_url:
+            return {"success": False, "message": "Failed to generate image. Please try again."}
+
+        try:
+            # Open the download; the body is streamed into S3 rather than read into memory
+            response = get_http_session().get(generated_image_url, stream=True)
+            response.raise_for_status()
+
+        except Exception as e:
+            print(f"[TOOL] Error processing output: {e}")
+            return {"success": False, "message": f"Failed to process generated image: {str(e)}"}
+
+        with response:
+            response.raw.decode_content = True
+            result = _save_generated_image(response.raw, user_id, prompt, title, store_result=False)
+        saved = result["success"]
+        _remember_generation(cache_key, model, user_id, result)
+        return result
     finally:
-        if image_data:
-            # Clear image data from memory
-            del image_data
+        if not saved:
+            _refund_generation(client_ip, reserved_week)
 
 
-def _generate_image_callable(inputs: Dict[str, str], config: RunnableConfig):
+# The core function that generates an image of the tool
+def _generate_image_core(
+    prompt: str,
+    user_id: str,
+    image_url: str,
+    title: str,
+    client_ip: str,
+) -> str:
+    """
+    Generate an image based on a prompt.
+    """
+    return _run_generation(prompt, user_id, image_url, title, client_ip)["message"]
+
+
+def _submit_generation_job(
+    prompt: str,
+    user_id: str,
+    image_url: str,
+    title: str,
+    client_ip: str,
+) -> str:
+    """
+    Queue the generation as a job and return the tool's reply at once.
+
+    GENERATION_MODE=queue stores the job in Postgres for llm.worker processes;
+    otherwise it runs on this process's background executor. The weekly limit is
+    checked up front so the agent can tell the user straight away; the generation
+    is only reserved when the job runs.
+    """
+    limit_error = _check_generation_limit(client_ip)
+    if limit_error:
+        return limit_error
+
+    try:
+        if get_generation_mode() == "queue":
+            job = to_job_snapshot(enqueue_generation(prompt, user_id, image_url, title, client_ip))
+        else:
+            job = submit_job(user_id, title, _run_generation, prompt, user_id, image_url, title, client_ip, False)
+    except JobQueueFull as e:
+        print(f"[TOOL] Could not queue generation: {e}")
+        return BUSY_MESSAGE
+
+    return f"Image generation started in the background. Job ID: {job['job_id']}, Title: {title}. \
+        The image will appear in the user's gallery when it is ready."
+
+
+async def _agenerate_image_core(
+    prompt: str,
+    user_id: str,
+    image_url: str,
+    title: str,
+    client_ip: str,
+    config: Optional[RunnableConfig] = None,
+) -> str:
+    """
+    Generate an image based on a prompt without blocking the event loop.
+
+    Replicate and the image download use their async clients. The database and
+    S3 steps have no async driver here, so they run in worker threads. When a
+    config is given, each stage is reported as a generation_progress event.
+    """
+    print(f"[TOOL] async generate_image called with prompt: {prompt[:50]}..., user_id: {user_id}, image_url: {image_url[:50]}...")
+
+    # Progress events go to the caller that runs the generation; joined callers just wait
+    result = await _generation_flight.ado(
+        _flight_key(user_id, prompt, image_url), lambda: _agenerate_and_save(prompt, user_id, image_url, title, client_ip, config)
+    )
+    _store_generation_result(user_id, result)
+    return result["message"]
+
+
+async def _agenerate_and_save(
+    prompt: str, user_id: str, image_url: str, title: str, client_ip: str, config: Optional[RunnableConfig]
+) -> Dict[str, Any]:
+    """Run one generation for _agenerate_image_core, without storing the tool result."""
+    # Generate image using Replicate
+    await _report_progress("generating", config)
+    model, model_input = _build_replicate_request(prompt, await aprepare_input_image_url(image_url, user_id))
+    # A cache hit doesn't use a generation, so it is looked up before the weekly limit is checked
+    cache_key = _cache_key_for(model, model_input)
+    cached = await asyncio.to_thread(_serve_cached_generation, cache_key, user_id, prompt, title, False) if cache_key else None
+    if cached:
+        return cached
+
+    # Take one of the weekly generations before generating; it is given back unless a new image is saved
+    failure, reserved_week = await asyncio.to_thread(_reserve_generation, client_ip)
+    if failure:
+        return failure
+
+    saved = False
+    try:
+        try:
+            async with get_generation_scheduler().aslot(user_id):
+                output = await replicate.async_run(model, input=model_input)
+        except GenerationBusy as e:
+            print(f"[TOOL] Generation not started: {e}")
+            return {"success": False, "message": BUSY_MESSAGE, "busy": True}
+        generated_image_url = _extract_generated_image_url(output)
+        if not generated_image_url:
+            return {"success": False, "message": "Failed to generate image. Please try again."}
+
+        await _report_progress("downloading", config)
+        result = await _astream_to_storage(generated_image_url, user_id, prompt, title, config)
+        saved = result["success"]
+        await asyncio.to_thread(_remember_generation, cache_key, model, user_id, result)
+        return result
+    finally:
+        if not saved:
+            await asyncio.to_thread(_refund_generation, client_ip, reserved_week)
+
+
+async def _astream_to_storage(
+    generated_image_url: str,
+    user_id: str,
+    prompt: str,
+    title: str,
+    config: Optional[RunnableConfig] = None,
+) -> Dict[str, Any]:
+    """
+    Stream the generated image into S3 while it downloads.
+
+    The async download feeds a ChunkPipe that a multipart upload in a worker thread
+    reads from, so only a few chunks are held in memory and both transfers overlap.
+    "uploading" is reported once the first chunk reaches the upload, with the
+    image size when Replicate sends a Content-Length.
+    """
+    pipe = ChunkPipe()
+
+    def save() -> Dict[str, Any]:
+        try:
+            return _save_generated_image(pipe, user_id, prompt, title, store_result=False)
+        finally:
+            # Unblocks the download if the upload stopped reading early
+            pipe.close()
+
+    save_task = asyncio.ensure_future(asyncio.to_thread(save))
+    size_bytes = 0
+    try:
+        async with get_async_http_client().stream("GET", generated_image_url) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("content-length")
+            async for chunk in response.aiter_bytes(_DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(pipe.write_chunk, chunk)
+                if not size_bytes:
+                    details = {"size_bytes": int(content_length)} if content_length and content_length.isdigit() else {}
+                    await _report_progress("uploading", config, **details)
+                size_bytes += len(chunk)
+        pipe.finish()
+        print(f"[TOOL] Downloaded image data, size: {size_bytes} bytes")
+
+    except BrokenPipeError:
+        # The upload ended without reading everything; its result says why
+        pass
+    except Exception as e:
+        print(f"[TOOL] Error processing output: {e}")
+        pipe.finish(e)
+        await asyncio.gather(save_task, return_exceptions=True)
+        return {"success": False, "message": f"Failed to process generated image: {str(e)}"}
+
+    return await save_task
+
+
+def _resolve_tool_inputs(inputs: Dict[str, str], config: RunnableConfig) -> Dict[str, str]:
+    """Normalize the tool inputs and attach the client IP from the per-invoke config."""
     # Normalize inputs whether dict or Pydantic
     if hasattr(inputs, "model_dump"):
         inputs = inputs.model_dump()
@@ -166,22 +633,99 @@ def _generate_image_callable(inputs: Dict[str, str], config: RunnableConfig):
 
     client_ip: str = ip
 
+    return {
+        "prompt": inputs["prompt"],
+        "user_id": inputs["user_id"],
+        "image_url": inputs["image_url"],
+        "title": inputs.get("title", "Generated Image"),
+        "client_ip": client_ip,
+    }
+
+
+def _generate_image_callable(inputs: Dict[str, str], config: RunnableConfig):
     # Call your core with the IP
-    return _generate_image_core(
-        prompt=inputs["prompt"],
-        user_id=inputs["user_id"],
-        image_url=inputs["image_url"],
-        title=inputs.get("title", "Generated Image"),
-        client_ip=client_ip,
+    if get_generation_mode() in ("background", "queue"):
+        return _submit_generation_job(**_resolve_tool_inputs(inputs, config))
+    return _generate_image_core(**_resolve_tool_inputs(inputs, config))
+
+
+async def _agenerate_image_callable(inputs: Dict[str, str], config: RunnableConfig):
+    # Used by the agent's ainvoke path
+    if get_generation_mode() in ("background", "queue"):
+        return await asyncio.to_thread(_submit_generation_job, **_resolve_tool_inputs(inputs, config))
+    return await _agenerate_image_core(**_resolve_tool_inputs(inputs, config), config=config)
+
+
+def _edit_image_core(user_id: str, image_url: str, operations: List[Dict[str, Any]], title: str, output_format: str = "png") -> str:
+    """
+    Apply deterministic edits to an image locally and save the result.
+
+    The edited image is uploaded and gets variants like a generated one, but no
+    model is called and the generation limit is neither checked nor counted.
+    """
+    print(f"[TOOL] edit_image called with operations: {operations}, user_id: {user_id}, image_url: {image_url[:50]}...")
+
+    try:
+        edited, content_type = apply_edits(fetch_image(image_url, user_id), operations, output_format)
+    except (EditError, ImageURLNotAllowed) as e:
+        return f"Could not apply the edit: {e}"
+    except Exception as e:
+        print(f"[TOOL] Error editing image: {e}")
+        return f"Failed to edit image: {str(e)}"
+
+    image_id = str(uuid.uuid4())
+    description = describe_edits(operations)
+    s3_result = upload_generated_image_to_s3(edited, image_id, user_id, description, title, content_type=content_type)
+    if not s3_result["success"]:
+        return f"Image edited but failed to save: {s3_result.get('error', 'Unknown error')}"
+
+    variants = enabled_variants()
+    stored_variants = _store_image_variants(user_id, image_id, edited, variants) if variants else []
+    store_tool_result(
+        user_id,
+        "edit_image",
+        {
+            "image_id": image_id,
+            "title": title,
+            "prompt": description,
+            "description": f"Edited image: {description}",
+            "variants": stored_variants,
+            "success": True,
+        },
     )
 
+    print(f"[TOOL] Edited image {image_id} ({len(edited)} bytes, {content_type})")
+    return f"Image edited successfully! User can find it in their gallery. Image ID: {image_id}, Title: {title}"
+
+
+def _resolve_edit_inputs(inputs: Any) -> Dict[str, Any]:
+    """Normalize the edit_image inputs, dropping unset operation parameters."""
+    if not isinstance(inputs, EditImageToolInput):
+        inputs = EditImageToolInput.model_validate(inputs)
+    return {
+        "user_id": inputs.user_id,
+        "image_url": inputs.image_url,
+        "operations": [operation.model_dump(exclude_none=True) for operation in inputs.operations],
+        "title": inputs.title or "Edited Image",
+        "output_format": inputs.output_format or "png",
+    }
+
+
+def _edit_image_callable(inputs: Dict[str, Any], config: RunnableConfig):
+    return _edit_image_core(**_resolve_edit_inputs(inputs))
+
+
+async def _aedit_image_callable(inputs: Dict[str, Any], config: RunnableConfig):
+    # Download, Pillow work and upload are all blocking; keep them off the event loop
+    return await asyncio.to_thread(_edit_image_core, **_resolve_edit_inputs(inputs))
+
 
 def initialize_tools():
     """Initialize the tools for the agent."""
     print("[TOOLS] building generate_image tool")
 
-    # A Runnable that receives (inputs, config) every invoke
-    generate_image_runnable = RunnableLambda(_generate_image_callable)
+    # A Runnable that receives (inputs, config) every invoke, with an async variant for ainvoke
+    generate_image_runnable = RunnableLambda(_generate_image_callable, afunc=_agenerate_image_callable)
 
     # As agent creation API expects "tools", convert the runnable to a Tool:
     generate_image_tool = generate_image_runnable.as_tool(
@@ -190,7 +734,14 @@ def initialize_tools():
         args_schema=GenerateImageToolInput,
     )
 
-    return [generate_image_tool]
+    print("[TOOLS] building edit_image tool")
+    edit_image_tool = RunnableLambda(_edit_image_callable, afunc=_aedit_image_callable).as_tool(
+        name="edit_image",
+        description=edit_image_tool_description,
+        args_schema=EditImageToolInput,
+    )
+
+    return [generate_image_tool, edit_image_tool]
 
 
 if __name__ == "__main__":
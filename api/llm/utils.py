@@ -1,12 +1,14 @@
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from threading import Lock
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
 
-import boto3
 from botocore.exceptions import ClientError
 
-from llm.connection_manager import get_checkpointer
+from llm.connection_manager import get_db_connection
+from llm.images import VARIANT_SPECS
+from llm.rate_limit_partitions import ensure_partitions, week_start_of
+from llm.storage import ReadableStream, get_s3_client, get_transfer_config, image_key, image_variant_key, presign_get_url
 
 # ------------------------- Agent's tool related utils -------------------------
 # User-specific storage for tool results (thread-safe)
@@ -55,6 +57,31 @@ def get_tool_result(user_id: str, tool_name: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+def get_latest_tool_result(user_id: str, tool_names: Sequence[str]) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+    """
+    Get and clear the most recently stored result among several tools.
+
+    The other tools' results are left in place for the user's next turn.
+
+    Args:
+        user_id: Unique identifier for the user
+        tool_names: Names of the tools whose results compete
+
+    Returns:
+        A tuple of (the newest result or None, names of the tools whose results were kept)
+    """
+    with _storage_lock:
+        results = _user_tool_results.get(user_id, {})
+        present = [tool_name for tool_name in tool_names if tool_name in results]
+        if not present:
+            return None, []
+        latest = max(present, key=lambda tool_name: _result_timestamps.get(f"{user_id}:{tool_name}", datetime.min))
+        result = results.pop(latest)
+        _result_timestamps.pop(f"{user_id}:{latest}", None)
+        print(f"[STORAGE] Retrieved {latest} result for user {user_id}: {result}")
+        return result, [tool_name for tool_name in present if tool_name != latest]
+
+
 def clear_user_tool_results(user_id: str) -> None:
     """
     Clear all tool results for a specific user.
@@ -102,58 +129,70 @@ def cleanup_old_tool_results(max_age_hours: int = 24) -> None:
 
 
 # ------------------------- S3 Upload of images -------------------------
-def upload_generated_image_to_s3(image_data: bytes, image_id: str, user_id: str, prompt: str, title: str = "Generated Image") -> Dict[str, Any]:
+def _image_metadata(image_id: str, user_id: str, prompt: str, title: str) -> Dict[str, str]:
+    """Return the S3 user metadata of a gallery image."""
+    return {
+        "title": title,
+        "imageId": image_id,
+        "userId": user_id,
+        "uploadedAt": datetime.now().isoformat(),
+        "type": "generated",
+        "generationPrompt": prompt,
+    }
+
+
+def upload_generated_image_to_s3(
+    image_data: Union[bytes, ReadableStream],
+    image_id: str,
+    user_id: str,
+    prompt: str,
+    title: str = "Generated Image",
+    content_type: str = "image/png",
+) -> Dict[str, Any]:
     """
     Upload a generated image to S3.
 
     Args:
-        image_data: The image data as bytes
+        image_data: The image data as bytes, or a readable stream that is uploaded
+            in parts while it is still being read
         image_id: Unique identifier for the image
         user_id: User identifier
         prompt: The prompt used to generate the image
         title: Custom title for the image
+        content_type: MIME type of the image
 
     Returns:
         Dict with success status, URL, and metadata or error message
     """
     try:
-        # Initialize S3 client
-        s3_client = boto3.client(
-            "s3",
-            region_name=os.environ.get("AWS_REGION", "us-east-1"),
-            aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-        )
+        # Shared, pooled S3 client
+        s3_client = get_s3_client()
 
         # Generate S3 key with userId and imageId for organization
-        key = f"users/{user_id}/images/{image_id}"
+        key = image_key(user_id, image_id)
         bucket_name = os.environ.get("AWS_S3_BUCKET_NAME")
 
         if not bucket_name:
             return {"success": False, "error": "AWS_S3_BUCKET_NAME environment variable is not set"}
 
+        metadata = _image_metadata(image_id, user_id, prompt, title)
+
         # Upload to S3
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=key,
-            Body=image_data,
-            ContentType="image/png",
-            Metadata={
-                "title": title,
-                "imageId": image_id,
-                "userId": user_id,
-                "uploadedAt": datetime.now().isoformat(),
-                "type": "generated",
-                "generationPrompt": prompt,
-            },
-        )
+        if isinstance(image_data, (bytes, bytearray)):
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=image_data, ContentType=content_type, Metadata=metadata)
+        else:
+            # Multipart upload with bounded memory that starts before the stream ends
+            s3_client.upload_fileobj(
+                image_data,
+                bucket_name,
+                key,
+                ExtraArgs={"ContentType": content_type, "Metadata": metadata},
+                Config=get_transfer_config(),
+            )
 
-        # Generate presigned URL for reading the uploaded file (valid for 2 hours)
-        presigned_url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": key},
-            ExpiresIn=7200,  # 2 hours
-        )
+        # Generate presigned URL for reading the uploaded file (valid for 2 hours).
+        # It is cached, so the agent's presign for the chat response reuses it.
+        presigned_url = presign_get_url(bucket_name, key)
 
         return {"success": True, "url": presigned_url, "image_id": image_id}
 
@@ -163,9 +202,111 @@ def upload_generated_image_to_s3(image_data: bytes, image_id: str, user_id: str,
         return {"success": False, "error": str(e)}
 
 
+def upload_image_variants(user_id: str, image_id: str, variants: Dict[str, Tuple[bytes, str]]) -> List[str]:
+    """
+    Upload rendered variants next to a generated image.
+
+    A variant that fails to upload is skipped; the original image is unaffected.
+
+    Args:
+        user_id: User identifier
+        image_id: The generated image's identifier
+        variants: Variant name to (encoded bytes, content type)
+
+    Returns:
+        The names of the variants that were stored
+    """
+    bucket_name = os.environ.get("AWS_S3_BUCKET_NAME")
+    if not bucket_name:
+        return []
+
+    s3_client = get_s3_client()
+    stored = []
+    for name, (data, content_type) in variants.items():
+        try:
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=image_variant_key(user_id, image_id, name),
+                Body=data,
+                ContentType=content_type,
+                Metadata={"imageId": image_id, "userId": user_id, "variant": name},
+            )
+            stored.append(name)
+        except Exception as e:
+            print(f"[UTILS] Failed to upload {name} variant of image {image_id}: {e}")
+    return stored
+
+
+def copy_generated_image(
+    source_user_id: str,
+    source_image_id: str,
+    user_id: str,
+    image_id: str,
+    prompt: str,
+    title: str,
+    variants: List[str],
+    content_type: str = "image/png",
+) -> Dict[str, Any]:
+    """
+    Copy a stored image and its variants into a user's gallery under a new id.
+
+    The copy happens inside S3, so no image bytes pass through this process.
+
+    Args:
+        source_user_id: Owner of the image to copy
+        source_image_id: Identifier of the image to copy
+        user_id: User receiving the copy
+        image_id: Identifier of the copy
+        prompt: The prompt recorded in the copy's metadata
+        title: Custom title for the copy
+        variants: Variant names stored next to the source image
+        content_type: MIME type of the image
+
+    Returns:
+        Dict with success status and the "variants" copied, or an error message
+    """
+    bucket_name = os.environ.get("AWS_S3_BUCKET_NAME")
+    if not bucket_name:
+        return {"success": False, "error": "AWS_S3_BUCKET_NAME environment variable is not set"}
+
+    s3_client = get_s3_client()
+    try:
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=image_key(user_id, image_id),
+            CopySource={"Bucket": bucket_name, "Key": image_key(source_user_id, source_image_id)},
+            ContentType=content_type,
+            Metadata=_image_metadata(image_id, user_id, prompt, title),
+            MetadataDirective="REPLACE",
+        )
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+    copied = []
+    for name in variants:
+        try:
+            s3_client.copy_object(
+                Bucket=bucket_name,
+                Key=image_variant_key(user_id, image_id, name),
+                CopySource={"Bucket": bucket_name, "Key": image_variant_key(source_user_id, source_image_id, name)},
+                ContentType=VARIANT_SPECS[name][1],
+                Metadata={"imageId": image_id, "userId": user_id, "variant": name},
+                MetadataDirective="REPLACE",
+            )
+            copied.append(name)
+        except Exception as e:
+            print(f"[UTILS] Failed to copy {name} variant of image {source_image_id}: {e}")
+    return {"success": True, "image_id": image_id, "variants": copied}
+
+
 # ------------------------- IP Generation Count and Guardrails -------------------------
 
 
+def current_week_start() -> date:
+    """Return the Monday the current rate limit week started on."""
+    return week_start_of(datetime.now().date())
+
+
 def get_ip_generation_count(ip_address: str) -> int:
     """
     Query the database for IP address generation count for the current week.
@@ -178,23 +319,18 @@ def get_ip_generation_count(ip_address: str) -> int:
         If no data found, returns 0
     """
     try:
-        checkpointer = get_checkpointer()
-
-        # Get the start of the current week (Monday)
-        now = datetime.now()
-        start_of_week = now - timedelta(days=now.weekday())
-        start_of_week = start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
+        start_of_week = current_week_start()
 
         # Query the rate_limits table for this IP in current week
         # Using a simple SQL query to get the data
-        with checkpointer.conn.cursor() as cursor:
+        with get_db_connection() as conn, conn.cursor() as cursor:
             cursor.execute(
                 """
                 SELECT generation_count
                 FROM rate_limits
                 WHERE ip_address = %s AND week_start = %s
             """,
-                (ip_address, start_of_week.date()),
+                (ip_address, start_of_week),
             )
 
             row = cursor.fetchone()
@@ -212,35 +348,6 @@ def get_ip_generation_count(ip_address: str) -> int:
         return 0
 
 
-def create_rate_limits_table():
-    """
-    Create the rate_limits table if it doesn't exist.
-    """
-    try:
-        from llm.connection_manager import get_checkpointer
-
-        checkpointer = get_checkpointer()
-
-        with checkpointer.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS rate_limits (
-                    id SERIAL PRIMARY KEY,
-                    ip_address VARCHAR(45) NOT NULL,
-                    week_start DATE NOT NULL,
-                    generation_count INTEGER DEFAULT 0,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(ip_address, week_start)
-                )
-            """
-            )
-            checkpointer.conn.commit()
-            print("[UTILS] Rate limits table created/verified successfully")
-
-    except Exception as e:
-        print(f"[UTILS] Error creating rate limits table: {e}")
-
-
 def create_or_update_ip_generation_count(ip_address: str) -> bool:
     """
     Update the generation count for an IP address, or create a new one if it doesn't exist.
@@ -252,16 +359,11 @@ def create_or_update_ip_generation_count(ip_address: str) -> bool:
         True if successful, False otherwise
     """
     try:
-        from llm.connection_manager import get_checkpointer
-
-        checkpointer = get_checkpointer()
-
-        # Get the start of the current week (Monday)
         now = datetime.now()
-        start_of_week = now - timedelta(days=now.weekday())
-        start_of_week = start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
+        start_of_week = current_week_start()
+        ensure_partitions()
 
-        with checkpointer.conn.cursor() as cursor:
+        with get_db_connection() as conn, conn.cursor() as cursor:
             # Use UPSERT to either insert new record or update existing one
             cursor.execute(
                 """
@@ -272,13 +374,209 @@ def create_or_update_ip_generation_count(ip_address: str) -> bool:
                     generation_count = rate_limits.generation_count + 1,
                     last_updated = EXCLUDED.last_updated
             """,
-                (ip_address, start_of_week.date(), now.isoformat()),
+                (ip_address, start_of_week, now.isoformat()),
             )
 
-            checkpointer.conn.commit()
             print(f"[UTILS] Created or Updated generation count for IP {ip_address}")
             return True
 
     except Exception as e:
         print(f"[UTILS] Error updating IP generation count: {e}")
         return False
+
+
+def reserve_ip_generation(ip_address: str, limit: int) -> Optional[date]:
+    """
+    Count a generation for an IP address if it is still under the weekly limit.
+
+    The check and the increment are one conditional upsert, so concurrent
+    generations from the same IP can't all pass the check and go over the limit.
+
+    Args:
+        ip_address: The IP address generating
+        limit: The number of generations allowed per week
+
+    Returns:
+        The week the generation was counted in, to pass to refund_ip_generation
+        if it doesn't produce an image, or None if the limit was already reached
+
+    Raises:
+        psycopg.Error: If the database can't be reached
+    """
+    if limit <= 0:
+        return None
+    week_start = current_week_start()
+    ensure_partitions()
+    with get_db_connection() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO rate_limits (ip_address, week_start, generation_count, last_updated)
+            VALUES (%s, %s, 1, %s)
+            ON CONFLICT (ip_address, week_start) DO UPDATE SET
+                generation_count = rate_limits.generation_count + 1,
+                last_updated = EXCLUDED.last_updated
+            WHERE rate_limits.generation_count < %s
+            RETURNING generation_count
+        """,
+            (ip_address, week_start, datetime.now().isoformat(), limit),
+        ).fetchone()
+
+    if row is None:
+        print(f"[UTILS] IP {ip_address}: weekly limit of {limit} generations reached")
+        return None
+    print(f"[UTILS] IP {ip_address}: reserved generation {row['generation_count']} of {limit} this week")
+    return week_start
+
+
+def refund_ip_generation(ip_address: str, week_start: date) -> bool:
+    """
+    Give back a generation reserved by reserve_ip_generation that produced no image.
+
+    Args:
+        ip_address: The IP address the generation was reserved for
+        week_start: The week reserve_ip_generation returned
+
+    Returns:
+        True if a generation was given back, False otherwise
+    """
+    try:
+        with get_db_connection() as conn:
+            refunded = conn.execute(
+                """
+                UPDATE rate_limits
+                SET generation_count = generation_count - 1, last_updated = %s
+                WHERE ip_address = %s AND week_start = %s AND generation_count > 0
+            """,
+                (datetime.now().isoformat(), ip_address, week_start),
+            ).rowcount
+    except Exception as e:
+        print(f"[UTILS] Error refunding generation for IP {ip_address}: {e}")
+        return False
+
+    if refunded:
+        print(f"[UTILS] Refunded a generation for IP {ip_address}")
+    return bool(refunded)
+
+
+def lease_ip_generations(
+    ip_address: str, week_start: date, count: int, limit: int, own_leased: int = 0, lease_horizon: float = 600.0
+) -> Tuple[int, int]:
+    """
+    Take up to count of an IP's remaining generations for a week in one go.
+
+    The row is locked while the remainder is worked out, so concurrent leases
+    from several processes never hand out more than the limit between them. A
+    lease gets at most half of what remains (rounded up), so the last few
+    generations aren't all stranded in one process.
+
+    Args:
+        ip_address: The IP address generating
+        week_start: The week to lease from
+        count: How many generations to take
+        limit: The number of generations allowed per week
+        own_leased: Generations the caller already holds leased for the IP and week
+        lease_horizon: Seconds after the row's last update within which its
+            leases are still held; older ones belong to processes that died
+
+    Returns:
+        A tuple of (how many generations were granted, how many other
+        processes still hold leased)
+
+    Raises:
+        psycopg.Error: If the database can't be reached
+    """
+    now = datetime.now()
+    ensure_partitions()
+    with get_db_connection() as conn, conn.transaction():
+        # A no-op update still locks an existing row, and returns its count either way
+        row = conn.execute(
+            """
+            INSERT INTO rate_limits (ip_address, week_start, generation_count, last_updated)
+            VALUES (%s, %s, 0, %s)
+            ON CONFLICT (ip_address, week_start) DO UPDATE SET last_updated = rate_limits.last_updated
+            RETURNING generation_count, leased_out, last_updated
+        """,
+            (ip_address, week_start, now.isoformat()),
+        ).fetchone()
+        remaining = limit - row["generation_count"]
+        granted = max(0, min(count, (remaining + 1) // 2))
+        if granted:
+            conn.execute(
+                """
+                UPDATE rate_limits
+                SET generation_count = generation_count + %s, leased_out = leased_out + %s, last_updated = %s
+                WHERE ip_address = %s AND week_start = %s
+            """,
+                (granted, granted, now.isoformat(), ip_address, week_start),
+            )
+
+    held = 0
+    if row["last_updated"] is not None and now - row["last_updated"] < timedelta(seconds=lease_horizon):
+        held = max(0, row["leased_out"] - own_leased)
+    print(
+        f"[UTILS] IP {ip_address}: leased {granted} of {count} generations "
+        f"({row['generation_count']} of {limit} already taken, {held} leased elsewhere)"
+    )
+    return granted, held
+
+
+def get_ip_leased_generations(ip_address: str, week_start: date, lease_horizon: float = 600.0) -> int:
+    """
+    Query how many of an IP's generations for a week are leased out to processes.
+
+    Args:
+        ip_address: The IP address to query
+        week_start: The week to query
+        lease_horizon: Seconds after the row's last update within which its leases are still held
+
+    Returns:
+        The leased generations not yet settled, 0 if there are none or they are stale
+
+    Raises:
+        psycopg.Error: If the database can't be reached
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT leased_out, last_updated FROM rate_limits WHERE ip_address = %s AND week_start = %s",
+            (ip_address, week_start),
+        ).fetchone()
+    if row is None or row["last_updated"] is None or datetime.now() - row["last_updated"] >= timedelta(seconds=lease_horizon):
+        return 0
+    return row["leased_out"]
+
+
+def return_ip_generations(unused: Mapping[Tuple[str, date], int], released: Optional[Mapping[Tuple[str, date], int]] = None) -> None:
+    """
+    Give back leased generations that weren't used, for many IPs in one statement.
+
+    Args:
+        unused: How many generations to give back per (ip_address, week_start)
+        released: How many leased generations each (ip_address, week_start) settles,
+            used or not, so they no longer count as held by a process
+
+    Raises:
+        psycopg.Error: If the database can't be reached
+    """
+    released = released or {}
+    keys = [key for key in {**unused, **released} if unused.get(key, 0) > 0 or released.get(key, 0) > 0]
+    if not keys:
+        return
+    with get_db_connection() as conn:
+        conn.execute(
+            """
+            UPDATE rate_limits AS r
+            SET generation_count = GREATEST(r.generation_count - v.unused, 0),
+                leased_out = GREATEST(r.leased_out - v.released, 0),
+                last_updated = %s
+            FROM unnest(%s::varchar[], %s::date[], %s::int[], %s::int[]) AS v(ip_address, week_start, unused, released)
+            WHERE r.ip_address = v.ip_address AND r.week_start = v.week_start
+        """,
+            (
+                datetime.now().isoformat(),
+                [ip for ip, _ in keys],
+                [week for _, week in keys],
+                [unused.get(key, 0) for key in keys],
+                [released.get(key, 0) for key in keys],
+            ),
+        )
+    print(f"[UTILS] Returned {sum(unused.values())} unused generations for {len(keys)} IPs")
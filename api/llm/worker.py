@@ -0,0 +1,151 @@
+"""
+Standalone worker for the durable generation queue.
+
+Run with `python -m llm.worker [--concurrency N]`. Each worker thread claims a job
+from generation_jobs, runs the same generation as the inline tool, and records the
+outcome. Workers need the same DATABASE_URL, Replicate and AWS settings as the API,
+and can be scaled independently of the FastAPI processes.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import uuid
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+from llm.images import shutdown_variant_executor
+from llm.job_queue import JOB_DEAD, claim_job, complete_job, extend_lock, fail_job
+from llm.jobs import JOB_SUCCEEDED
+from llm.quota import start_quota_flusher, stop_quota_flusher
+from llm.tools import _run_generation
+
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before polling again when the queue is empty
+_poll_interval = float(os.getenv("GENERATION_WORKER_POLL_INTERVAL", "2"))
+
+
+def _make_worker_id() -> str:
+    """Return an id naming the host, process and a random suffix."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _heartbeat(job_id: uuid.UUID, worker_id: str, interval: float, stop_event: threading.Event) -> None:
+    """Keep extending the job's visibility timeout until stopped."""
+    while not stop_event.wait(interval):
+        try:
+            if not extend_lock(job_id, worker_id):
+                print(f"[WORKER] Lost the lock on job {job_id}")
+                return
+        except Exception as e:
+            print(f"[WORKER] Heartbeat failed for job {job_id}: {e}")
+
+
+def process_job(job: Dict[str, Any], worker_id: str, heartbeat_interval: Optional[float] = None) -> Optional[str]:
+    """
+    Run one claimed job and record its outcome.
+
+    Args:
+        job: The claimed generation_jobs row
+        worker_id: The id the job was claimed with
+        heartbeat_interval: Seconds between visibility timeout extensions, or None to disable
+
+    Returns:
+        The job's new status, or None if another worker took the job over
+    """
+    job_id = job["id"]
+    print(f"[WORKER] Processing job {job_id} (attempt {job['attempts']} of {job['max_attempts']})")
+
+    # A job whose worker died on its last attempt is dead-lettered instead of run again
+    if job["attempts"] > job["max_attempts"]:
+        return fail_job(job_id, worker_id, "Visibility timeout expired on the final attempt")
+
+    stop_heartbeat = threading.Event()
+    if heartbeat_interval:
+        threading.Thread(target=_heartbeat, args=(job_id, worker_id, heartbeat_interval, stop_heartbeat), daemon=True).start()
+    try:
+        result = _run_generation(job["prompt"], job["user_id"], job["image_url"], job["title"], job["client_ip"], False)
+    except Exception as e:
+        logger.exception(f"Job {job_id} raised")
+        result = {"success": False, "message": f"Failed to generate image: {str(e)}"}
+    finally:
+        stop_heartbeat.set()
+
+    if result.get("success"):
+        if not complete_job(job_id, worker_id, result):
+            print(f"[WORKER] Job {job_id} was taken over by another worker, dropping result")
+            return None
+        print(f"[WORKER] Job {job_id} succeeded")
+        return JOB_SUCCEEDED
+
+    # Retrying can't help a job whose IP has used up its weekly generations
+    status = fail_job(job_id, worker_id, result.get("message") or "Unknown error", retryable=not result.get("limit_reached"))
+    if status == JOB_DEAD:
+        print(f"[WORKER] Job {job_id} dead-lettered after {job['attempts']} attempts: {result.get('message')}")
+    else:
+        print(f"[WORKER] Job {job_id} attempt failed, now {status}: {result.get('message')}")
+    return status
+
+
+def run_worker(stop_event: threading.Event, visibility_timeout: int, poll_interval: float = _poll_interval) -> None:
+    """Claim and process jobs until the stop event is set."""
+    worker_id = _make_worker_id()
+    print(f"[WORKER] Worker {worker_id} started")
+    while not stop_event.is_set():
+        try:
+            job = claim_job(worker_id, visibility_timeout)
+        except Exception as e:
+            print(f"[WORKER] Failed to claim a job: {e}")
+            job = None
+
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+
+        try:
+            process_job(job, worker_id, heartbeat_interval=visibility_timeout / 3)
+        except Exception as e:
+            # Leave the job to be reclaimed once its visibility timeout expires
+            print(f"[WORKER] Failed to record the outcome of job {job['id']}: {e}")
+    print(f"[WORKER] Worker {worker_id} stopped")
+
+
+def main() -> None:
+    from llm.job_queue import _visibility_timeout
+
+    parser = argparse.ArgumentParser(description="Process queued image generations.")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("GENERATION_WORKER_CONCURRENCY", "2")))
+    parser.add_argument("--visibility-timeout", type=int, default=_visibility_timeout)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stop_event = threading.Event()
+    # Container runtimes stop with SIGTERM; finish the current jobs like on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    start_quota_flusher()
+    threads = [threading.Thread(target=run_worker, args=(stop_event, args.visibility_timeout), name=f"worker-{i}") for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        print("[WORKER] Stopping after the current jobs finish...")
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+    stop_quota_flusher()
+    shutdown_variant_executor()
+
+
+if __name__ == "__main__":
+    main()
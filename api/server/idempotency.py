@@ -0,0 +1,291 @@
+"""
+Idempotency-Key support for POST /chat.
+
+A client that times out and retries used to run the whole agent turn again: another
+model call, possibly another generation, and another entry in the checkpoint
+thread. With an Idempotency-Key header the first request claims the key, and its
+ChatResponse is kept for IDEMPOTENCY_TTL_SECONDS and replayed to any retry with
+the same key and body. A retry that arrives while the first request is still
+running waits for it: in the same process it attaches to the running turn, and
+across processes (with the Postgres store) it polls until the response is stored.
+
+Keys are scoped to the user. Reusing a key with a different body is rejected, and
+a request that fails releases its key so the retry runs again. IDEMPOTENCY_STORE
+selects the memory store (one process) or the Postgres store (shared).
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from llm.connection_manager import get_db_connection
+from llm.singleflight import SingleFlight
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_COMPLETED = "completed"
+
+# How long a completed response is replayed; kept under the 2 hour life of the presigned URLs it contains
+_ttl = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+# How long an unfinished claim holds its key, so a process that died mid-turn doesn't block retries forever
+_lock_timeout = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "300"))
+# How long a retry waits for the original request running in another process
+_wait_timeout = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "120"))
+_poll_interval = 0.5
+
+# {"fingerprint": ..., "status": ..., "response": ...}
+IdempotencyRecord = Dict[str, Any]
+
+
+class IdempotencyKeyConflict(Exception):
+    """Raised when a key is reused with a different request body."""
+
+
+class IdempotencyKeyInProgress(Exception):
+    """Raised when the original request is still running after the retry's wait."""
+
+
+def request_fingerprint(payload: Dict[str, Any]) -> str:
+    """Hash a request body so a key reused for a different request can be told apart."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class MemoryIdempotencyStore:
+    """Keys held in this process, bounded to max_entries."""
+
+    def __init__(self, max_entries: int = 10000):
+        self._records: "OrderedDict[str, Tuple[IdempotencyRecord, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+
+    def claim(self, key: str, fingerprint: str) -> Optional[IdempotencyRecord]:
+        """
+        Claim a key for a new request.
+
+        Returns:
+            None if the caller now owns the key, otherwise the key's live record
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None and entry[1] > now:
+                return dict(entry[0])
+            self._records[key] = ({"fingerprint": fingerprint, "status": STATUS_IN_PROGRESS, "response": None}, now + _lock_timeout)
+            self._records.move_to_end(key)
+            while len(self._records) > self._max_entries:
+                self._records.popitem(last=False)
+            return None
+
+    def lookup(self, key: str) -> Optional[IdempotencyRecord]:
+        """Return the key's live record without claiming it, or None."""
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return dict(entry[0])
+
+    def complete(self, key: str, fingerprint: str, response: Dict[str, Any]) -> None:
+        """Store the response of the request that owns the key."""
+        with self._lock:
+            self._records[key] = ({"fingerprint": fingerprint, "status": STATUS_COMPLETED, "response": response}, time.monotonic() + _ttl)
+
+    def release(self, key: str) -> None:
+        """Free the key of a request that failed, so a retry runs again."""
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None and entry[0]["status"] == STATUS_IN_PROGRESS:
+                del self._records[key]
+
+
+class PostgresIdempotencyStore:
+    """Keys in the idempotency_keys table, shared by every API process."""
+
+    def __init__(self, purge_every: int = 100):
+        self._purge_every = purge_every
+        self._claims = 0
+        self._claims_lock = threading.Lock()
+
+    def claim(self, key: str, fingerprint: str) -> Optional[IdempotencyRecord]:
+        """
+        Claim a key for a new request, taking over an expired one.
+
+        Returns:
+            None if the caller now owns the key, otherwise the key's live record
+        """
+        self._maybe_purge()
+        with get_db_connection() as conn:
+            while True:
+                claimed = conn.execute(
+                    """
+                    INSERT INTO idempotency_keys (key, fingerprint, status, expires_at)
+                    VALUES (%s, %s, %s, now() + make_interval(secs => %s))
+                    ON CONFLICT (key) DO UPDATE SET
+                        fingerprint = EXCLUDED.fingerprint,
+                        status = EXCLUDED.status,
+                        response = NULL,
+                        created_at = now(),
+                        expires_at = EXCLUDED.expires_at
+                    WHERE idempotency_keys.expires_at <= now()
+                    RETURNING key
+                """,
+                    (key, fingerprint, STATUS_IN_PROGRESS, _lock_timeout),
+                ).fetchone()
+                if claimed:
+                    return None
+                record = conn.execute("SELECT fingerprint, status, response FROM idempotency_keys WHERE key = %s", (key,)).fetchone()
+                # The row can be released between the two statements; then claim again
+                if record is not None:
+                    return record
+
+    def lookup(self, key: str) -> Optional[IdempotencyRecord]:
+        """Return the key's live record without claiming it, or None."""
+        with get_db_connection() as conn:
+            return conn.execute(
+                "SELECT fingerprint, status, response FROM idempotency_keys WHERE key = %s AND expires_at > now()",
+                (key,),
+            ).fetchone()
+
+    def complete(self, key: str, fingerprint: str, response: Dict[str, Any]) -> None:
+        """Store the response of the request that owns the key."""
+        with get_db_connection() as conn:
+            conn.execute(
+                """
+                UPDATE idempotency_keys
+                SET status = %s, response = %s, expires_at = now() + make_interval(secs => %s)
+                WHERE key = %s AND fingerprint = %s
+            """,
+                (STATUS_COMPLETED, json.dumps(response), _ttl, key, fingerprint),
+            )
+
+    def release(self, key: str) -> None:
+        """Free the key of a request that failed, so a retry runs again."""
+        with get_db_connection() as conn:
+            conn.execute("DELETE FROM idempotency_keys WHERE key = %s AND status = %s", (key, STATUS_IN_PROGRESS))
+
+    def purge_expired(self) -> int:
+        """Delete expired keys, returning how many were removed."""
+        with get_db_connection() as conn:
+            return conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= now()").rowcount
+
+    def _maybe_purge(self) -> None:
+        with self._claims_lock:
+            self._claims += 1
+            due = self._claims % self._purge_every == 0
+        if due:
+            try:
+                self.purge_expired()
+            except Exception as e:
+                print(f"[IDEMPOTENCY] Could not purge expired keys: {e}")
+
+
+IdempotencyStore = Union[MemoryIdempotencyStore, PostgresIdempotencyStore]
+
+_store: Optional[IdempotencyStore] = None
+_store_lock = threading.Lock()
+# Requests running in this process, so a retry attaches instead of polling the store
+_flight = SingleFlight()
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Return the store selected by IDEMPOTENCY_STORE ("memory", the default, or "postgres")."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            kind = os.getenv("IDEMPOTENCY_STORE", "memory").lower()
+            if kind == "postgres":
+                _store = PostgresIdempotencyStore()
+            else:
+                if kind != "memory":
+                    print(f"[IDEMPOTENCY] Unknown IDEMPOTENCY_STORE '{kind}', using memory")
+                _store = MemoryIdempotencyStore(int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000")))
+        return _store
+
+
+def reset_idempotency_store() -> None:
+    """Drop the store so the next request creates it again from the environment."""
+    global _store
+    with _store_lock:
+        _store = None
+
+
+def scoped_chat_key(user_id: Optional[str], key: str) -> str:
+    """Scope a /chat Idempotency-Key to its user; the client IP may differ between a request and its retry."""
+    return f"chat:{user_id or 'default'}:{key}"
+
+
+async def is_key_answered(key: str) -> bool:
+    """
+    Check whether a scoped key already has a stored response, so its request would be replayed.
+
+    A key that is only claimed doesn't count: its request may still fail and
+    release the key, and the retry then runs the request itself.
+
+    Returns:
+        False if the key is free, still in progress, or the store can't be reached
+    """
+    try:
+        record = await asyncio.to_thread(get_idempotency_store().lookup, key)
+        return record is not None and record["status"] == STATUS_COMPLETED
+    except Exception as e:
+        print(f"[IDEMPOTENCY] Could not look up key: {e}")
+        return False
+
+
+async def _run_once(key: str, fingerprint: str, handler: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Dict[str, Any], bool]:
+    store = get_idempotency_store()
+    deadline = asyncio.get_running_loop().time() + _wait_timeout
+    while True:
+        record = await asyncio.to_thread(store.claim, key, fingerprint)
+        if record is None:
+            try:
+                response = await handler()
+            except BaseException:
+                await asyncio.to_thread(store.release, key)
+                raise
+            await asyncio.to_thread(store.complete, key, fingerprint, response)
+            return response, False
+
+        if record["fingerprint"] != fingerprint:
+            raise IdempotencyKeyConflict(f"{IDEMPOTENCY_HEADER} was already used for a different request")
+        if record["status"] == STATUS_COMPLETED:
+            return record["response"], True
+        # Still running in another process: wait for its response, or for its claim to be released or expire
+        if asyncio.get_running_loop().time() >= deadline:
+            raise IdempotencyKeyInProgress(f"A request with this {IDEMPOTENCY_HEADER} is still being processed")
+        await asyncio.sleep(_poll_interval)
+
+
+async def run_idempotent(key: str, fingerprint: str, handler: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Dict[str, Any], bool]:
+    """
+    Run a request once per key, replaying its response to retries.
+
+    Args:
+        key: The client's Idempotency-Key, already scoped (e.g. to the user)
+        fingerprint: request_fingerprint() of the request body
+        handler: Runs the request and returns its JSON-serializable response
+
+    Returns:
+        A tuple of (response, whether it was replayed rather than produced by this call)
+
+    Raises:
+        IdempotencyKeyConflict: If the key was used for a different request body
+        IdempotencyKeyInProgress: If the original request is still running elsewhere
+    """
+    ran = False
+
+    async def run() -> Tuple[Dict[str, Any], bool]:
+        nonlocal ran
+        ran = True
+        return await _run_once(key, fingerprint, handler)
+
+    # Retries with a different body get their own flight and are rejected by the store
+    response, replayed = await _flight.ado((key, fingerprint), run)
+    return response, replayed or not ran
@@ -1,22 +1,70 @@
+import asyncio
+import json
+import math
+import os
 import time
 from contextlib import asynccontextmanager
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Literal, Optional
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 
-from llm.agent import chat_with_agent
-from llm.connection_manager import _test_connection, get_checkpointer
-from llm.utils import create_rate_limits_table
+from llm.agent import _process_generated_image, achat_with_agent, astream_chat_with_agent
+from llm.connection_manager import _test_connection, get_checkpointer, get_connection_stats
+from llm.generation_cache import get_generation_cache_stats
+from llm.http_client import aclose_async_http_client
+from llm.images import shutdown_variant_executor
+from llm.job_queue import get_queued_job, list_queued_user_jobs, to_job_snapshot
+from llm.jobs import JOB_SUCCEEDED, add_completion_listener, get_generation_mode, get_job, list_user_jobs, remove_completion_listener
+from llm.quota import get_quota_cache_stats, start_quota_flusher, stop_quota_flusher
+from llm.scheduler import get_generation_scheduler_stats
+from llm.storage import PRESIGN_EXPIRES_IN, get_presign_cache_stats, image_key, image_variant_key, presign_get_urls
+from llm.tools import get_generation_flight_stats
+from server.idempotency import (
+    IDEMPOTENCY_HEADER,
+    MAX_KEY_LENGTH,
+    REPLAYED_HEADER,
+    IdempotencyKeyConflict,
+    IdempotencyKeyInProgress,
+    is_key_answered,
+    request_fingerprint,
+    run_idempotent,
+    scoped_chat_key,
+)
+from server.rate_limit import get_chat_limiter, get_chat_rate_limit_stats
+from server.sessions import MAX_MESSAGE_BYTES, ChatSession, close_session, get_session, open_session, push_to_user
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for FastAPI app startup and shutdown."""
-    # Startup
-    create_rate_limits_table()
+    # Startup: open the pool, which bootstraps the schema once per process
+    try:
+        await asyncio.to_thread(get_checkpointer)
+    except Exception as e:
+        print(f"[FASTAPI] Database bootstrap failed, retrying on first request: {e}")
+
+    # Push finished background generations to the user's /ws/chat session
+    loop = asyncio.get_running_loop()
+
+    def push_finished_job(job: dict):
+        if get_session(job["user_id"]) is None:
+            return
+        job_status = _build_job_status(job)
+        if job_status.generated_image:
+            asyncio.run_coroutine_threadsafe(push_to_user(job["user_id"], "generated_image", job_status.generated_image.model_dump()), loop)
+        asyncio.run_coroutine_threadsafe(push_to_user(job["user_id"], "job_finished", job_status.model_dump()), loop)
+
+    add_completion_listener(push_finished_job)
+    start_quota_flusher()
     yield
     # Shutdown (if needed)
+    remove_completion_listener(push_finished_job)
+    # Hand the generations this process leased but didn't use back to the other processes
+    await asyncio.to_thread(stop_quota_flusher)
+    await aclose_async_http_client()
+    await asyncio.to_thread(shutdown_variant_executor)
     print("[FASTAPI] App shutting down...")
 
 
@@ -42,6 +90,8 @@ class GeneratedImage(BaseModel):
     description: str
     timestamp: str
     type: str = "generated"
+    # Lighter copies by variant name, e.g. "webp" and "thumb" (a small WebP for gallery cards)
+    variants: Dict[str, str] = {}
 
 
 class ChatResponse(BaseModel):
@@ -50,6 +100,124 @@ class ChatResponse(BaseModel):
     generated_image: Optional[GeneratedImage] = None
 
 
+def _build_chat_response(response: str, generated_image_data: Optional[Dict[str, Any]]) -> ChatResponse:
+    """Build the ChatResponse for an agent reply and optional generated image metadata."""
+    chat_response = ChatResponse(response=response, status="success")
+    if generated_image_data:
+        chat_response.generated_image = GeneratedImage(**generated_image_data)
+    return chat_response
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str
+    title: str
+    message: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+    generated_image: Optional[GeneratedImage] = None
+
+
+def _build_job_status(job: dict) -> JobStatus:
+    """Build the JobStatus for a job snapshot, presigning the image URL once it has succeeded."""
+    job_status = JobStatus(**{field: job[field] for field in ("job_id", "status", "title", "message", "error", "created_at", "updated_at")})
+    if job["status"] == JOB_SUCCEEDED and job["image"]:
+        generated_image_data = _process_generated_image(job["user_id"], job["image"])
+        if generated_image_data:
+            job_status.generated_image = GeneratedImage(**generated_image_data)
+    return job_status
+
+
+# Names of the stored image variants, the keys of VARIANT_SPECS
+VariantName = Literal["webp", "avif", "thumb"]
+
+# Upper bound on image ids per /images/presign request
+MAX_PRESIGN_BATCH = 5000
+
+
+class PresignRequest(BaseModel):
+    user_id: str
+    image_ids: List[str] = Field(max_length=MAX_PRESIGN_BATCH)
+    # Presign a stored variant (e.g. "thumb") instead of the original image
+    variant: Optional[VariantName] = None
+
+
+class PresignResponse(BaseModel):
+    urls: Dict[str, str]
+    expires_in: int = PRESIGN_EXPIRES_IN
+
+
+# POST endpoints whose messages count against the per-IP chat rate limit
+RATE_LIMITED_PATHS = ("/chat", "/chat/stream")
+
+
+async def _chat_body(request: Request) -> Dict[str, Any]:
+    """Return the parsed ChatRequest body, or {} if it isn't a JSON object."""
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+def _rate_limit_key(request: Request, body: Dict[str, Any]) -> str:
+    """Return the ChatRequest's client_ip, or the peer address if the body doesn't have one."""
+    client_ip = body.get("client_ip")
+    if isinstance(client_ip, str) and client_ip:
+        return client_ip
+    return request.client.host if request.client else "unknown"
+
+
+async def _is_retry(request: Request, body: Dict[str, Any]) -> bool:
+    """Whether a /chat request's Idempotency-Key already has a response, so it is replayed rather than running a turn."""
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+    if request.url.path != "/chat" or not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+        return False
+    user_id = body.get("user_id")
+    return await is_key_answered(scoped_chat_key(user_id if isinstance(user_id, str) else None, idempotency_key))
+
+
+def _retry_after(wait: float) -> str:
+    return str(max(1, math.ceil(wait)))
+
+
+@app.middleware("http")
+async def chat_rate_limit_middleware(request: Request, call_next):
+    """
+    Turn away chat messages from an IP that has used up its rate limit with a 429.
+
+    A retry whose Idempotency-Key already has a stored response doesn't take a
+    token: it gets that response replayed instead of running another turn. A
+    retry of a request still in progress is charged, since it runs the turn
+    itself if the original fails.
+    """
+    limiter = get_chat_limiter()
+    if limiter is None or request.method != "POST" or request.url.path not in RATE_LIMITED_PATHS:
+        return await call_next(request)
+
+    body = await _chat_body(request)
+    if await _is_retry(request, body):
+        return await call_next(request)
+    client_ip = _rate_limit_key(request, body)
+    wait = limiter.acquire(client_ip)
+    if wait:
+        print(f"[FASTAPI] Rate limited chat from {client_ip}, retry in {wait:.1f}s")
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too many messages, please slow down"},
+            headers={"Retry-After": _retry_after(wait)},
+        )
+    return await call_next(request)
+
+
+class ChatTurn(BaseModel):
+    """One message sent by the client over /ws/chat."""
+
+    message: str
+    selected_images: Optional[List[Dict[str, str]]] = []
+
+
 @app.get("/")
 async def root():
     return {"message": "AI Image Editor API is running!"}
@@ -59,30 +227,77 @@ async def root():
 async def health_check():
     """Enhanced health check that includes database connection status."""
     try:
-        # Test database connection
-        checkpointer = get_checkpointer()
-        db_healthy = _test_connection(checkpointer)
+        # Test database connection (blocking driver, so off the event loop)
+        checkpointer = await asyncio.to_thread(get_checkpointer)
+        db_healthy = await asyncio.to_thread(_test_connection, checkpointer)
 
         return {
             "status": "healthy" if db_healthy else "degraded",
             "service": "ai-image-editor-api",
-            "database": {"status": "connected" if db_healthy else "disconnected", "timestamp": time.time()},
+            "database": {
+                "status": "connected" if db_healthy else "disconnected",
+                "timestamp": time.time(),
+                "stats": get_connection_stats(),
+            },
         }
     except Exception as e:
         return {"status": "unhealthy", "service": "ai-image-editor-api", "database": {"status": "error", "error": str(e), "timestamp": time.time()}}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Report in-process cache and connection pool counters."""
+    return {
+        "presign_cache": get_presign_cache_stats(),
+        "generation_cache": get_generation_cache_stats(),
+        "generation_flights": get_generation_flight_stats(),
+        "generation_scheduler": get_generation_scheduler_stats(),
+        "quota_cache": get_quota_cache_stats(),
+        "chat_rate_limit": get_chat_rate_limit_stats(),
+        "database": get_connection_stats(),
+    }
+
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, response: Response, idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
     """
     Chat endpoint that receives user messages and returns AI responses.
 
+    With an Idempotency-Key header, a retry of the same request gets the first
+    response replayed (marked with an Idempotent-Replayed header) instead of
+    running the agent turn again.
+
     Args:
         request: ChatRequest containing message, selected_images, and user_id
+        idempotency_key: Optional client-chosen key identifying this message
 
     Returns:
         ChatResponse with AI response, status, and optional generated image metadata.
     """
+    if not idempotency_key:
+        return await _chat_turn(request)
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters")
+
+    async def run_turn() -> dict:
+        return (await _chat_turn(request)).model_dump()
+
+    scoped_key = scoped_chat_key(request.user_id, idempotency_key)
+    try:
+        data, replayed = await run_idempotent(scoped_key, request_fingerprint(request.model_dump(exclude={"client_ip"})), run_turn)
+    except IdempotencyKeyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyKeyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if replayed:
+        print(f"[FASTAPI] Replayed /chat response for {IDEMPOTENCY_HEADER} {idempotency_key}")
+        response.headers[REPLAYED_HEADER] = "true"
+    return ChatResponse(**data)
+
+
+async def _chat_turn(request: ChatRequest) -> ChatResponse:
+    """Run one agent turn for a /chat request."""
     try:
         # Extract client IP
         print(request)
@@ -93,7 +308,7 @@ async def chat_endpoint(request: ChatRequest):
 
         # Use the LLM agent to get a response
         user_id = request.user_id or "default"
-        response, generated_image_data = chat_with_agent(
+        response, generated_image_data = await achat_with_agent(
             message=request.message,
             client_ip=client_ip,
             user_id=user_id,
@@ -101,15 +316,204 @@ async def chat_endpoint(request: ChatRequest):
         )
 
         # Create response with optional generated image
-        chat_response = ChatResponse(response=response, status="success")
+        return _build_chat_response(response, generated_image_data)
 
-        if generated_image_data:
-            chat_response.generated_image = GeneratedImage(**generated_image_data)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job_endpoint(job_id: str):
+    """
+    Report the status of a background generation job.
+
+    Args:
+        job_id: The id returned by the generate_image tool
+
+    Returns:
+        JobStatus, including the generated image metadata once the job has succeeded.
+    """
+    job = get_job(job_id)
+    if job is None and get_generation_mode() == "queue":
+        row = await asyncio.to_thread(get_queued_job, job_id)
+        job = to_job_snapshot(row) if row else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return await asyncio.to_thread(_build_job_status, job)
+
+
+@app.get("/jobs", response_model=List[JobStatus])
+async def list_jobs_endpoint(user_id: str):
+    """
+    List a user's background generation jobs, newest first.
+
+    Args:
+        user_id: The user whose jobs to list
 
-        return chat_response
+    Returns:
+        A list of JobStatus.
+    """
+    jobs = list_user_jobs(user_id)
+    if get_generation_mode() == "queue":
+        rows = await asyncio.to_thread(list_queued_user_jobs, user_id)
+        jobs = sorted(jobs + [to_job_snapshot(row) for row in rows], key=lambda job: job["created_at"], reverse=True)
+    return await asyncio.to_thread(lambda: [_build_job_status(job) for job in jobs])
+
+
+@app.post("/images/presign", response_model=PresignResponse)
+async def presign_images_endpoint(request: PresignRequest):
+    """
+    Refresh the URLs of many of a user's images in one call.
+
+    Args:
+        request: PresignRequest with the user_id, up to MAX_PRESIGN_BATCH image ids and
+            optionally the variant to presign
 
+    Returns:
+        PresignResponse mapping each image id to a presigned GET URL. URLs are signed
+        locally (no S3 round trips) and reused while they are still fresh.
+    """
+    bucket_name = os.environ.get("AWS_S3_BUCKET_NAME")
+    if not bucket_name:
+        raise HTTPException(status_code=500, detail="AWS_S3_BUCKET_NAME environment variable is not set")
+
+    if request.variant:
+        keys = {image_id: image_variant_key(request.user_id, image_id, request.variant) for image_id in request.image_ids}
+    else:
+        keys = {image_id: image_key(request.user_id, image_id) for image_id in request.image_ids}
+    try:
+        urls = await asyncio.to_thread(presign_get_urls, bucket_name, list(keys.values()))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error presigning images: {str(e)}")
+    return PresignResponse(urls={image_id: urls[key] for image_id, key in keys.items()})
+
+
+def _format_sse(event: str, data: dict) -> str:
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Streaming chat endpoint using Server-Sent Events.
+
+    Args:
+        request: ChatRequest containing message, selected_images, and user_id
+
+    Returns:
+        A text/event-stream of token, generation_started, generation_progress and
+        generation_finished events, ending with a "done" event whose data is the
+        same ChatResponse that /chat returns (or an "error" event on failure).
+    """
+    client_ip = request.client_ip or "unknown"
+    user_id = request.user_id or "default"
+
+    async def event_stream():
+        if client_ip == "unknown":
+            yield _format_sse("done", ChatResponse(response="Error: Client IP not found", status="error").model_dump())
+            return
+
+        try:
+            async for event in astream_chat_with_agent(
+                message=request.message,
+                client_ip=client_ip,
+                user_id=user_id,
+                selected_images=request.selected_images,
+            ):
+                if event["event"] != "done":
+                    yield _format_sse(event["event"], event["data"])
+                    continue
+
+                # Final event: same shape as the /chat response
+                chat_response = _build_chat_response(event["data"]["agent_response"], event["data"]["generated_image_data"])
+                yield _format_sse("done", chat_response.model_dump())
+
+        except Exception as e:
+            yield _format_sse("error", {"detail": f"Error processing request: {str(e)}"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _run_session_turns(session: ChatSession):
+    """Process queued turns for a /ws/chat session one at a time."""
+    while True:
+        turn = await session.turns.get()
+        try:
+            async for event in astream_chat_with_agent(
+                message=turn.message,
+                client_ip=session.client_ip,
+                user_id=session.user_id,
+                selected_images=turn.selected_images,
+            ):
+                if event["event"] != "done":
+                    await session.send(event["event"], event["data"])
+                    continue
+
+                chat_response = _build_chat_response(event["data"]["agent_response"], event["data"]["generated_image_data"])
+                if chat_response.generated_image:
+                    await session.send("generated_image", chat_response.generated_image.model_dump())
+                await session.send("done", chat_response.model_dump())
+
+        except Exception as e:
+            await session.send("error", {"detail": f"Error processing request: {str(e)}"})
+
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket, user_id: str = "default", client_ip: Optional[str] = None):
+    """
+    WebSocket chat endpoint keeping one session per user open across turns.
+
+    Args:
+        websocket: The client connection
+        user_id: Query parameter identifying the user; a newer connection for the
+            same user replaces this one
+        client_ip: Query parameter with the end user's IP, used for rate limiting
+
+    Each text message is a JSON ChatTurn. Turns are answered in order with the same
+    events as /chat/stream, sent as {"event": ..., "data": ...} objects; a finished
+    generation is also pushed as a "generated_image" event before "done".
+    """
+    await websocket.accept()
+    if not client_ip:
+        await websocket.send_json({"event": "done", "data": ChatResponse(response="Error: Client IP not found", status="error").model_dump()})
+        await websocket.close(code=1008)
+        return
+
+    session = await open_session(websocket, user_id, client_ip)
+    print(f"[WS] Session opened for user {user_id}")
+    turn_worker = asyncio.create_task(_run_session_turns(session))
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            if len(raw.encode()) > MAX_MESSAGE_BYTES:
+                await session.send("error", {"detail": f"Message exceeds {MAX_MESSAGE_BYTES} bytes"})
+                continue
+            try:
+                turn = ChatTurn.model_validate_json(raw)
+            except ValidationError as e:
+                await session.send("error", {"detail": f"Invalid message: {e.errors()[0]['msg']}"})
+                continue
+            limiter = get_chat_limiter()
+            wait = limiter.acquire(client_ip) if limiter else 0.0
+            if wait:
+                await session.send("error", {"detail": "Too many messages, please slow down", "retry_after": int(_retry_after(wait))})
+                continue
+            try:
+                session.turns.put_nowait(turn)
+            except asyncio.QueueFull:
+                await session.send("error", {"detail": "Too many pending messages, wait for a response"})
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the connection was closed on our side (superseded session)
+        pass
+    finally:
+        turn_worker.cancel()
+        close_session(session)
+        print(f"[WS] Session closed for user {user_id}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+"""
+Per-IP rate limit for chat messages.
+
+The weekly generation limit only counts image generations, so plain chat
+messages reached Gemini without any limit and one client could take all of the
+model concurrency. Each chat message (POST /chat, POST /chat/stream and every
+/ws/chat turn) now takes a token from its client IP's bucket. A bucket holds up
+to CHAT_RATE_LIMIT_BURST tokens and refills at CHAT_RATE_LIMIT_PER_MINUTE, so
+a client can send a short burst and then keeps the steady rate. A message that
+finds the bucket empty is turned away with the seconds until the next token.
+
+Buckets live in this process and each check is O(1). At most
+CHAT_RATE_LIMIT_MAX_IPS buckets are kept; the least recently seen IP is dropped
+beyond that, which at worst gives it a full bucket again. Setting
+CHAT_RATE_LIMIT_PER_MINUTE to 0 turns the limit off.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class TokenBucketLimiter:
+    """Token buckets by key, refilled continuously and bounded to max_keys."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 10000):
+        self._rate = per_minute / 60.0
+        self._burst = max(1, burst)
+        self._max_keys = max_keys
+        # key -> (tokens, time of the last update), least recently seen first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"allowed": 0, "limited": 0, "evicted": 0}
+
+    def acquire(self, key: str) -> float:
+        """
+        Take one token from a key's bucket.
+
+        Returns:
+            0.0 if the request may go ahead, otherwise the seconds until a token
+            will be available
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = float(self._burst)
+            else:
+                tokens = min(float(self._burst), bucket[0] + (now - bucket[1]) * self._rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+                self._stats["allowed"] += 1
+            else:
+                wait = (1 - tokens) / self._rate
+                self._stats["limited"] += 1
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+                self._stats["evicted"] += 1
+            return wait
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return the limiter's counters and settings."""
+        with self._lock:
+            return {
+                **self._stats,
+                "tracked_ips": len(self._buckets),
+                "per_minute": self._rate * 60,
+                "burst": self._burst,
+            }
+
+
+_limiter: Optional[TokenBucketLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_chat_limiter() -> Optional[TokenBucketLimiter]:
+    """Return the chat rate limiter, or None if CHAT_RATE_LIMIT_PER_MINUTE is 0."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            per_minute = float(os.getenv("CHAT_RATE_LIMIT_PER_MINUTE", "20"))
+            if per_minute <= 0:
+                return None
+            _limiter = TokenBucketLimiter(
+                per_minute,
+                int(os.getenv("CHAT_RATE_LIMIT_BURST", "10")),
+                int(os.getenv("CHAT_RATE_LIMIT_MAX_IPS", "10000")),
+            )
+        return _limiter
+
+
+def reset_chat_limiter() -> None:
+    """Forget every bucket and re-read the settings on next use (used by tests)."""
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
+
+
+def get_chat_rate_limit_stats() -> Dict[str, Any]:
+    """Return the chat rate limiter's counters, or {"enabled": False}."""
+    limiter = get_chat_limiter()
+    if limiter is None:
+        return {"enabled": False}
+    return {"enabled": True, **limiter.get_stats()}
@@ -0,0 +1,95 @@
+"""
+Registry of open /ws/chat sessions.
+
+Each user_id has at most one live WebSocket session, so results produced outside
+a chat turn (e.g. a finished image generation) can be pushed to the user. Sessions
+keep no conversation history (the checkpointer does) and bound what they buffer:
+incoming turns wait in a small queue and outgoing events are written directly.
+"""
+
+import asyncio
+from typing import Any, Dict, Optional
+
+from fastapi import WebSocket
+
+# Per-connection limits that keep session memory bounded
+MAX_PENDING_TURNS = 4
+MAX_MESSAGE_BYTES = 64 * 1024
+
+# Close code sent to a session replaced by a newer connection for the same user
+SUPERSEDED_CLOSE_CODE = 4000
+
+
+class ChatSession:
+    """One open /ws/chat connection for a user."""
+
+    def __init__(self, websocket: WebSocket, user_id: str, client_ip: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.client_ip = client_ip
+        self.turns: asyncio.Queue = asyncio.Queue(maxsize=MAX_PENDING_TURNS)
+        self._send_lock = asyncio.Lock()
+        self.closed = False
+
+    async def send(self, event: str, data: Dict[str, Any]) -> bool:
+        """Send one event to the client, returning False if the connection is gone."""
+        if self.closed:
+            return False
+        try:
+            # Turn output and pushed results may be sent from different tasks
+            async with self._send_lock:
+                await self.websocket.send_json({"event": event, "data": data})
+            return True
+        except Exception as e:
+            print(f"[WS] Failed to send {event} to user {self.user_id}: {e}")
+            self.closed = True
+            return False
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None) -> None:
+        """Close the connection, ignoring errors if it is already gone."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+
+_sessions: Dict[str, ChatSession] = {}
+
+
+async def open_session(websocket: WebSocket, user_id: str, client_ip: str) -> ChatSession:
+    """Register a session for the user, closing any previous session they had open."""
+    session = ChatSession(websocket, user_id, client_ip)
+    previous = _sessions.get(user_id)
+    _sessions[user_id] = session
+    if previous is not None:
+        print(f"[WS] Replacing existing session for user {user_id}")
+        await previous.close(code=SUPERSEDED_CLOSE_CODE, reason="Superseded by a newer session")
+    return session
+
+
+def close_session(session: ChatSession) -> None:
+    """Unregister a session if it is still the user's current one."""
+    session.closed = True
+    if _sessions.get(session.user_id) is session:
+        del _sessions[session.user_id]
+
+
+def get_session(user_id: str) -> Optional[ChatSession]:
+    """Return the user's open session, if any."""
+    return _sessions.get(user_id)
+
+
+async def push_to_user(user_id: str, event: str, data: Dict[str, Any]) -> bool:
+    """
+    Push an event to the user's open session.
+
+    Returns:
+        True if the event was sent, False if the user has no open session
+    """
+    session = _sessions.get(user_id)
+    if session is None:
+        return False
+    return await session.send(event, data)
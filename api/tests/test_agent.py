@@ -1,4 +1,5 @@
-from unittest.mock import Mock, patch
+import asyncio
+from unittest.mock import AsyncMock, Mock, patch
 
 import pytest
 
@@ -8,7 +9,7 @@ with patch("langchain_google_genai.ChatGoogleGenerativeAI"):
         with patch("langgraph.checkpoint.postgres.PostgresSaver"):
             with patch("llm.connection_manager.get_checkpointer"):
                 with patch("llm.connection_manager._test_connection", return_value=True):
-                    from llm.agent import chat_with_agent
+                    from llm.agent import _process_generated_image, achat_with_agent, astream_chat_with_agent, chat_with_agent
 
 
 class TestAgent:
@@ -74,6 +75,161 @@ class TestAgent:
         with pytest.raises(Exception, match="Agent error"):
             chat_with_agent("Hello", "127.0.0.1", "test_user")
 
+    @patch("llm.agent._build_agent")
+    @patch("llm.agent.get_checkpointer")
+    def test_get_agent_rebuilds_after_checkpointer_swap(self, mock_get_checkpointer, mock_build_agent):
+        """Test that the cached agent is rebuilt when the checkpointer is replaced."""
+        from llm import agent as agent_module
+
+        old_checkpointer, new_checkpointer = Mock(), Mock()
+        mock_get_checkpointer.side_effect = [old_checkpointer, old_checkpointer, new_checkpointer]
+        mock_build_agent.side_effect = lambda checkpointer: Mock(checkpointer=checkpointer)
+
+        with patch.object(agent_module, "_agent_executor", None), patch.object(agent_module, "_agent_checkpointer", None):
+            first = agent_module._get_agent()
+            second = agent_module._get_agent()
+            third = agent_module._get_agent()
+
+        assert first is second
+        assert third is not first
+        assert third.checkpointer is new_checkpointer
+
+
+class TestAsyncAgent:
+    """Test cases for the async agent path."""
+
+    @patch("llm.agent._aget_agent", new_callable=AsyncMock)
+    def test_achat_with_agent_basic_response(self, mock_aget_agent):
+        """Test that the async path awaits ainvoke and extracts the response."""
+        mock_agent = Mock()
+        mock_agent.ainvoke = AsyncMock(return_value={"messages": [{"role": "assistant", "content": "Hi there!"}]})
+        mock_aget_agent.return_value = mock_agent
+
+        response, generated_image = asyncio.run(achat_with_agent("Hello", "127.0.0.1", "test_user"))
+
+        assert response == "Hi there!"
+        assert generated_image is None
+        mock_agent.ainvoke.assert_awaited_once()
+        mock_agent.invoke.assert_not_called()
+        config = mock_agent.ainvoke.call_args[1]["config"]
+        assert config["configurable"] == {"thread_id": "test_user", "client_ip": "127.0.0.1"}
+
+    @patch("llm.agent._generate_presigned_url", return_value="https://test-url")
+    @patch("llm.agent._aget_agent", new_callable=AsyncMock)
+    def test_achat_with_agent_returns_generated_image(self, mock_aget_agent, mock_presign):
+        """Test that a tool result stored during the turn is returned as image data."""
+        from llm.utils import store_tool_result
+
+        async def ainvoke(agent_input, config):
+            store_tool_result("async_user", "generate_image", {"image_id": "img-123", "title": "Sunset", "prompt": "A sunset"})
+            return {"messages": [{"role": "assistant", "content": "Done!"}]}
+
+        mock_agent = Mock()
+        mock_agent.ainvoke = ainvoke
+        mock_aget_agent.return_value = mock_agent
+
+        response, generated_image = asyncio.run(achat_with_agent("Make a sunset", "127.0.0.1", "async_user"))
+
+        assert response == "Done!"
+        assert generated_image["id"] == "img-123"
+        assert generated_image["url"] == "https://test-url"
+        mock_presign.assert_called_once_with("async_user", "img-123")
+
+    @patch("llm.agent._generate_presigned_url", return_value="https://test-url")
+    @patch("llm.agent._aget_agent", new_callable=AsyncMock)
+    def test_achat_with_agent_returns_edited_image(self, mock_aget_agent, mock_presign):
+        """Test that an edit_image result is returned like a generated image."""
+        from llm.utils import store_tool_result
+
+        async def ainvoke(agent_input, config):
+            store_tool_result(
+                "edit_user", "edit_image", {"image_id": "img-456", "title": "Rotated", "description": "Edited image: rotate (degrees=90)"}
+            )
+            return {"messages": [{"role": "assistant", "content": "Rotated it!"}]}
+
+        mock_agent = Mock()
+        mock_agent.ainvoke = ainvoke
+        mock_aget_agent.return_value = mock_agent
+
+        _, generated_image = asyncio.run(achat_with_agent("Rotate it", "127.0.0.1", "edit_user"))
+
+        assert generated_image["id"] == "img-456"
+        assert generated_image["description"] == "Edited image: rotate (degrees=90)"
+
+    @patch("llm.agent._generate_presigned_url", return_value="https://test-url")
+    @patch("llm.agent._aget_agent", new_callable=AsyncMock)
+    def test_newest_image_is_returned_and_the_other_kept(self, mock_aget_agent, mock_presign):
+        """Test that a turn that generated and then edited an image returns the edit and keeps the generation."""
+        from llm.utils import get_tool_result, store_tool_result
+
+        async def ainvoke(agent_input, config):
+            store_tool_result("both_user", "generate_image", {"image_id": "img-gen", "title": "Sunset", "prompt": "A sunset"})
+            store_tool_result("both_user", "edit_image", {"image_id": "img-edit", "title": "Cropped"})
+            return {"messages": [{"role": "assistant", "content": "Done!"}]}
+
+        mock_agent = Mock()
+        mock_agent.ainvoke = ainvoke
+        mock_aget_agent.return_value = mock_agent
+
+        _, generated_image = asyncio.run(achat_with_agent("Make a sunset and crop it", "127.0.0.1", "both_user"))
+
+        assert generated_image["id"] == "img-edit"
+        assert get_tool_result("both_user", "generate_image")["image_id"] == "img-gen"
+
+    @patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+    @patch("llm.agent.presign_get_urls", side_effect=lambda bucket, keys: {key: f"https://{bucket}/{key}" for key in keys})
+    @patch("llm.agent._generate_presigned_url", return_value="https://test-url")
+    def test_generated_image_includes_variant_urls(self, mock_presign, mock_presign_urls):
+        """Test that stored variants are presigned at their keys next to the original."""
+        tool_result = {"image_id": "img-123", "title": "Sunset", "prompt": "A sunset", "variants": ["webp", "thumb"]}
+
+        generated_image = _process_generated_image("variant_user", tool_result)
+
+        assert generated_image["variants"] == {
+            "webp": "https://test-bucket/users/variant_user/images/img-123.webp",
+            "thumb": "https://test-bucket/users/variant_user/images/img-123.thumb",
+        }
+
+    @patch("llm.agent._aget_agent", new_callable=AsyncMock)
+    def test_astream_chat_with_agent_events(self, mock_aget_agent):
+        """Test that astream_events output is mapped to token, tool progress and done events."""
+        from langchain_core.messages import AIMessageChunk
+
+        async def astream_events(agent_input, config, version):
+            yield {"event": "on_chat_model_stream", "name": "model", "data": {"chunk": AIMessageChunk(content="Paint")}, "parent_ids": ["root"]}
+            yield {"event": "on_chat_model_stream", "name": "model", "data": {"chunk": AIMessageChunk(content="")}, "parent_ids": ["root"]}
+            yield {"event": "on_tool_start", "name": "generate_image", "data": {"input": {"title": "Sunset"}}, "parent_ids": ["root"]}
+            yield {"event": "on_custom_event", "name": "generation_progress", "data": {"stage": "uploading"}, "parent_ids": ["root"]}
+            yield {"event": "on_tool_end", "name": "generate_image", "data": {"output": "Image generated successfully!"}, "parent_ids": ["root"]}
+            yield {
+                "event": "on_chat_model_stream",
+                "name": "model",
+                "data": {"chunk": AIMessageChunk(content=[{"type": "text", "text": "ing!"}])},
+                "parent_ids": ["root"],
+            }
+            yield {
+                "event": "on_chain_end",
+                "name": "LangGraph",
+                "data": {"output": {"messages": [{"role": "assistant", "content": "Painting!"}]}},
+                "parent_ids": [],
+            }
+
+        mock_agent = Mock()
+        mock_agent.astream_events = astream_events
+        mock_aget_agent.return_value = mock_agent
+
+        async def collect():
+            return [event async for event in astream_chat_with_agent("Paint a sunset", "127.0.0.1", "stream_user")]
+
+        events = asyncio.run(collect())
+
+        assert [event["event"] for event in events] == ["token", "generation_started", "generation_progress", "generation_finished", "token", "done"]
+        assert events[0]["data"] == {"text": "Paint"}
+        assert events[1]["data"] == {"title": "Sunset"}
+        assert events[2]["data"] == {"stage": "uploading"}
+        assert events[4]["data"] == {"text": "ing!"}
+        assert events[-1]["data"] == {"agent_response": "Painting!", "generated_image_data": None}
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
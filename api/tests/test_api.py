@@ -1,5 +1,10 @@
-from unittest.mock import patch
+import asyncio
+import json
+import time
+from datetime import date
+from unittest.mock import AsyncMock, patch
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 
@@ -9,11 +14,21 @@ with patch("langchain_google_genai.ChatGoogleGenerativeAI"):
         with patch("langgraph.checkpoint.postgres.PostgresSaver"):
             with patch("llm.connection_manager.get_checkpointer"):
                 with patch("llm.connection_manager._test_connection", return_value=True):
+                    from llm.scheduler import GenerationScheduler
                     from server.main import app
+                    from server.rate_limit import reset_chat_limiter
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def fresh_chat_limiter():
+    """Give every test full chat rate limit buckets."""
+    reset_chat_limiter()
+    yield
+    reset_chat_limiter()
+
+
 class TestAPI:
     """Test cases for the API endpoints."""
 
@@ -25,6 +40,15 @@ class TestAPI:
         assert data["status"] in ["healthy", "degraded", "unhealthy"]
         assert data["service"] == "ai-image-editor-api"
 
+    def test_metrics_endpoint(self):
+        """Test that the metrics endpoint reports presigned URL cache counters."""
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert {"hits", "misses", "evictions", "size", "max_size"} <= set(response.json()["presign_cache"])
+        assert {"leaders", "coalesced", "in_flight"} == set(response.json()["generation_flights"])
+        assert {"local", "leases", "held", "pending_returns"} <= set(response.json()["quota_cache"])
+        assert {"running", "waiting", "rejected", "timed_out"} <= set(response.json()["generation_scheduler"])
+
     def test_root_endpoint(self):
         """Test the root endpoint."""
         response = client.get("/")
@@ -32,10 +56,10 @@ class TestAPI:
         data = response.json()
         assert "message" in data
 
-    @patch("server.main.chat_with_agent")
-    def test_chat_endpoint_basic(self, mock_chat_with_agent):
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock)
+    def test_chat_endpoint_basic(self, mock_achat_with_agent):
         """Test basic chat endpoint without image generation."""
-        mock_chat_with_agent.return_value = ("Hello! I can help you with image editing.", None)
+        mock_achat_with_agent.return_value = ("Hello! I can help you with image editing.", None)
 
         request_data = {"message": "Hello", "selected_images": [], "user_id": "test_user", "client_ip": "127.0.0.1"}
 
@@ -47,8 +71,49 @@ class TestAPI:
         assert data["status"] == "success"
         assert data["generated_image"] is None
 
-    @patch("server.main.chat_with_agent")
-    def test_chat_endpoint_with_image_generation(self, mock_chat_with_agent):
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock, return_value=("Hello!", None))
+    def test_chat_idempotency_key_replays_response(self, mock_achat_with_agent):
+        """Test that a retried request with the same Idempotency-Key gets the first response without a new turn."""
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "idempotent_user", "client_ip": "127.0.0.1"}
+        headers = {"Idempotency-Key": "retry-key-1"}
+
+        first = client.post("/chat", json=request_data, headers=headers)
+        retry = client.post("/chat", json={**request_data, "client_ip": "10.0.0.1"}, headers=headers)
+
+        assert first.json() == retry.json()
+        assert "Idempotent-Replayed" not in first.headers
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        mock_achat_with_agent.assert_awaited_once()
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock, return_value=("Hello!", None))
+    def test_chat_idempotency_key_conflicts(self, mock_achat_with_agent):
+        """Test that a key reused for another message is rejected and keys are scoped to the user."""
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "idempotent_user", "client_ip": "127.0.0.1"}
+        headers = {"Idempotency-Key": "retry-key-2"}
+
+        client.post("/chat", json=request_data, headers=headers)
+        reused = client.post("/chat", json={**request_data, "message": "Something else"}, headers=headers)
+        other_user = client.post("/chat", json={**request_data, "user_id": "another_user"}, headers=headers)
+
+        assert reused.status_code == 422
+        assert other_user.status_code == 200
+        assert mock_achat_with_agent.await_count == 2
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock)
+    def test_chat_idempotency_key_failed_turn_can_be_retried(self, mock_achat_with_agent):
+        """Test that a turn that failed runs again on retry."""
+        mock_achat_with_agent.side_effect = [Exception("model unavailable"), ("Hello!", None)]
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "idempotent_user", "client_ip": "127.0.0.1"}
+        headers = {"Idempotency-Key": "retry-key-3"}
+
+        assert client.post("/chat", json=request_data, headers=headers).status_code == 500
+        retry = client.post("/chat", json=request_data, headers=headers)
+
+        assert retry.status_code == 200
+        assert "Idempotent-Replayed" not in retry.headers
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock)
+    def test_chat_endpoint_with_image_generation(self, mock_achat_with_agent):
         """Test chat endpoint with image generation."""
         generated_image_data = {
             "id": "test-uuid-123",
@@ -59,7 +124,7 @@ class TestAPI:
             "type": "generated",
         }
 
-        mock_chat_with_agent.return_value = ("I've generated an image for you!", generated_image_data)
+        mock_achat_with_agent.return_value = ("I've generated an image for you!", generated_image_data)
 
         request_data = {"message": "Generate an image of a sunset", "selected_images": [], "user_id": "test_user", "client_ip": "127.0.0.1"}
 
@@ -72,10 +137,10 @@ class TestAPI:
         assert data["generated_image"] is not None
         assert data["generated_image"]["id"] == "test-uuid-123"
 
-    @patch("server.main.chat_with_agent")
-    def test_chat_endpoint_with_selected_images(self, mock_chat_with_agent):
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock)
+    def test_chat_endpoint_with_selected_images(self, mock_achat_with_agent):
         """Test chat endpoint with selected images."""
-        mock_chat_with_agent.return_value = ("I see your selected images!", None)
+        mock_achat_with_agent.return_value = ("I see your selected images!", None)
 
         request_data = {
             "message": "Edit these images",
@@ -96,17 +161,17 @@ class TestAPI:
         response = client.post("/chat", json=request_data)
         assert response.status_code == 200
 
-        # Verify that chat_with_agent was called with the correct data
-        mock_chat_with_agent.assert_called_once()
-        call_args = mock_chat_with_agent.call_args
+        # Verify that achat_with_agent was called with the correct data
+        mock_achat_with_agent.assert_called_once()
+        call_args = mock_achat_with_agent.call_args
         assert call_args[1]["message"] == "Edit these images"
         assert call_args[1]["user_id"] == "test_user"
         assert len(call_args[1]["selected_images"]) == 1
 
-    @patch("server.main.chat_with_agent")
-    def test_chat_endpoint_error_handling(self, mock_chat_with_agent):
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock)
+    def test_chat_endpoint_error_handling(self, mock_achat_with_agent):
         """Test chat endpoint error handling."""
-        mock_chat_with_agent.side_effect = Exception("Agent error")
+        mock_achat_with_agent.side_effect = Exception("Agent error")
 
         request_data = {"message": "Hello", "selected_images": [], "user_id": "test_user", "client_ip": "127.0.0.1"}
 
@@ -127,5 +192,493 @@ class TestAPI:
         assert "Client IP not found" in data["response"]
 
 
+def _parse_sse(body):
+    """Parse a text/event-stream body into (event, data) pairs."""
+    events = []
+    for message in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class TestChatStream:
+    """Test cases for the Server-Sent Events chat endpoint."""
+
+    @patch("server.main.astream_chat_with_agent")
+    def test_chat_stream_events_end_with_chat_response(self, mock_astream):
+        """Test that tokens and tool progress are streamed and the last event is the ChatResponse."""
+        generated_image_data = {
+            "id": "test-uuid-123",
+            "url": "https://test-bucket.s3.amazonaws.com/test-url",
+            "title": "Sunset",
+            "description": "AI-generated image: A sunset",
+            "timestamp": "2024-01-01T00:00:00Z",
+            "type": "generated",
+        }
+
+        async def fake_stream(**kwargs):
+            yield {"event": "token", "data": {"text": "On "}}
+            yield {"event": "token", "data": {"text": "it!"}}
+            yield {"event": "generation_started", "data": {"title": "Sunset"}}
+            yield {"event": "generation_progress", "data": {"stage": "downloading"}}
+            yield {"event": "generation_finished", "data": {"result": "Image generated successfully!"}}
+            yield {"event": "done", "data": {"agent_response": "On it!", "generated_image_data": generated_image_data}}
+
+        mock_astream.side_effect = fake_stream
+
+        request_data = {"message": "Make a sunset", "selected_images": [], "user_id": "test_user", "client_ip": "127.0.0.1"}
+        response = client.post("/chat/stream", json=request_data)
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = _parse_sse(response.text)
+        assert [name for name, _ in events] == ["token", "token", "generation_started", "generation_progress", "generation_finished", "done"]
+        done = events[-1][1]
+        assert done["response"] == "On it!"
+        assert done["status"] == "success"
+        assert done["generated_image"]["id"] == "test-uuid-123"
+        assert mock_astream.call_args[1]["user_id"] == "test_user"
+
+    @patch("server.main.astream_chat_with_agent")
+    def test_chat_stream_error_event(self, mock_astream):
+        """Test that a failure mid-stream is reported as an error event."""
+
+        async def failing_stream(**kwargs):
+            yield {"event": "token", "data": {"text": "Hmm"}}
+            raise Exception("Agent error")
+
+        mock_astream.side_effect = failing_stream
+
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "test_user", "client_ip": "127.0.0.1"}
+        events = _parse_sse(client.post("/chat/stream", json=request_data).text)
+
+        assert events[-1][0] == "error"
+        assert "Error processing request: Agent error" in events[-1][1]["detail"]
+
+    def test_chat_stream_missing_client_ip(self):
+        """Test that a missing client IP ends the stream with an error ChatResponse."""
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "test_user"}
+        events = _parse_sse(client.post("/chat/stream", json=request_data).text)
+
+        assert events == [("done", {"response": "Error: Client IP not found", "status": "error", "generated_image": None})]
+
+
+def _receive_until_done(websocket):
+    """Collect (event, data) pairs from a /ws/chat connection up to the next "done" event."""
+    events = []
+    while True:
+        message = websocket.receive_json()
+        events.append((message["event"], message["data"]))
+        if message["event"] == "done":
+            return events
+
+
+class TestChatWebSocket:
+    """Test cases for the /ws/chat WebSocket endpoint."""
+
+    @patch("server.main.astream_chat_with_agent")
+    def test_multiple_turns_over_one_session(self, mock_astream):
+        """Test that one connection answers several turns and pushes the generated image."""
+        generated_image_data = {
+            "id": "test-uuid-123",
+            "url": "https://test-bucket.s3.amazonaws.com/test-url",
+            "title": "Sunset",
+            "description": "AI-generated image: A sunset",
+            "timestamp": "2024-01-01T00:00:00Z",
+            "type": "generated",
+        }
+
+        async def fake_stream(message, **kwargs):
+            yield {"event": "token", "data": {"text": f"re: {message}"}}
+            image = generated_image_data if message == "Make a sunset" else None
+            yield {"event": "done", "data": {"agent_response": f"re: {message}", "generated_image_data": image}}
+
+        mock_astream.side_effect = fake_stream
+
+        with client.websocket_connect("/ws/chat?user_id=ws_user&client_ip=127.0.0.1") as websocket:
+            websocket.send_json({"message": "Hello"})
+            first = _receive_until_done(websocket)
+            websocket.send_json({"message": "Make a sunset", "selected_images": []})
+            second = _receive_until_done(websocket)
+
+        assert [name for name, _ in first] == ["token", "done"]
+        assert first[-1][1]["response"] == "re: Hello"
+        assert first[-1][1]["generated_image"] is None
+        assert [name for name, _ in second] == ["token", "generated_image", "done"]
+        assert second[1][1]["id"] == "test-uuid-123"
+        assert second[-1][1]["generated_image"]["id"] == "test-uuid-123"
+        assert mock_astream.call_count == 2
+        assert all(call[1]["user_id"] == "ws_user" for call in mock_astream.call_args_list)
+        assert all(call[1]["client_ip"] == "127.0.0.1" for call in mock_astream.call_args_list)
+
+    def test_new_connection_replaces_old_session(self):
+        """Test that a second connection for the same user closes the first one."""
+        from starlette.websockets import WebSocketDisconnect
+
+        from server.sessions import SUPERSEDED_CLOSE_CODE, get_session
+
+        with client.websocket_connect("/ws/chat?user_id=dup_user&client_ip=127.0.0.1") as first:
+            with client.websocket_connect("/ws/chat?user_id=dup_user&client_ip=127.0.0.1"):
+                with pytest.raises(WebSocketDisconnect) as exc_info:
+                    first.receive_json()
+                assert exc_info.value.code == SUPERSEDED_CLOSE_CODE
+                # The replaced session's cleanup must not unregister the live one
+                assert get_session("dup_user") is not None
+        assert get_session("dup_user") is None
+
+    @patch("server.main.astream_chat_with_agent")
+    def test_invalid_and_oversized_messages_are_rejected(self, mock_astream):
+        """Test that bad messages get an error event and never reach the agent."""
+        from server.sessions import MAX_MESSAGE_BYTES
+
+        with client.websocket_connect("/ws/chat?user_id=ws_user&client_ip=127.0.0.1") as websocket:
+            websocket.send_text("x" * (MAX_MESSAGE_BYTES + 1))
+            oversized = websocket.receive_json()
+            websocket.send_json({"selected_images": []})
+            invalid = websocket.receive_json()
+
+        assert oversized["event"] == "error"
+        assert "exceeds" in oversized["data"]["detail"]
+        assert invalid["event"] == "error"
+        assert "Invalid message" in invalid["data"]["detail"]
+        mock_astream.assert_not_called()
+
+    def test_push_to_user_reaches_open_session(self):
+        """Test that events produced outside a turn are pushed to the user's session."""
+        from server.sessions import get_session, push_to_user
+
+        with client.websocket_connect("/ws/chat?user_id=push_user&client_ip=127.0.0.1") as websocket:
+            session = get_session("push_user")
+            sent = websocket.portal.call(push_to_user, "push_user", "generated_image", {"id": "img-1"})
+            assert sent is True
+            assert websocket.receive_json() == {"event": "generated_image", "data": {"id": "img-1"}}
+            assert session.turns.maxsize > 0
+
+        assert asyncio.run(push_to_user("push_user", "generated_image", {"id": "img-2"})) is False
+
+    def test_missing_client_ip(self):
+        """Test that a connection without a client IP is refused with an error ChatResponse."""
+        with client.websocket_connect("/ws/chat?user_id=ws_user") as websocket:
+            message = websocket.receive_json()
+
+        assert message == {"event": "done", "data": {"response": "Error: Client IP not found", "status": "error", "generated_image": None}}
+
+
+class TestJobsAPI:
+    """Test cases for the background generation job endpoints."""
+
+    IMAGE_DATA = {
+        "id": "img-1",
+        "url": "https://test-bucket.s3.amazonaws.com/img-1",
+        "title": "Sunset",
+        "description": "AI-generated image: A sunset",
+        "timestamp": "2024-01-01T00:00:00Z",
+        "type": "generated",
+    }
+
+    @staticmethod
+    def _finished_job(user_id):
+        from llm import jobs
+
+        result = {
+            "success": True,
+            "message": "Image generated successfully!",
+            "image_id": "img-1",
+            "title": "Sunset",
+            "prompt": "A sunset",
+            "variants": ["thumb"],
+        }
+        job = jobs.submit_job(user_id, "Sunset", lambda: result)
+        deadline = time.monotonic() + 5
+        while jobs.get_job(job["job_id"])["status"] != jobs.JOB_SUCCEEDED and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return job["job_id"]
+
+    @patch("server.main._process_generated_image")
+    def test_get_job_reports_generated_image(self, mock_process):
+        """Test that a finished job reports its status and presigned image metadata."""
+        mock_process.return_value = self.IMAGE_DATA
+        job_id = self._finished_job("jobs_api_user")
+
+        response = client.get(f"/jobs/{job_id}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["job_id"] == job_id
+        assert data["status"] == "succeeded"
+        assert data["generated_image"]["id"] == "img-1"
+        mock_process.assert_called_once_with("jobs_api_user", {"image_id": "img-1", "title": "Sunset", "prompt": "A sunset", "variants": ["thumb"]})
+
+    @patch("server.main._process_generated_image")
+    def test_list_jobs_for_user(self, mock_process):
+        """Test that /jobs lists only the requested user's jobs."""
+        mock_process.return_value = self.IMAGE_DATA
+        job_id = self._finished_job("jobs_list_user")
+        self._finished_job("someone_else")
+
+        response = client.get("/jobs", params={"user_id": "jobs_list_user"})
+
+        assert response.status_code == 200
+        assert [job["job_id"] for job in response.json()] == [job_id]
+
+    def test_unknown_job(self):
+        """Test that an unknown job id returns 404."""
+        response = client.get("/jobs/does-not-exist")
+        assert response.status_code == 404
+
+    @patch("server.main._process_generated_image")
+    @patch("server.main.get_checkpointer")
+    def test_finished_job_is_pushed_to_websocket(self, mock_get_checkpointer, mock_process):
+        """Test that a job finishing in the background is pushed to the user's open session."""
+        mock_process.return_value = self.IMAGE_DATA
+
+        with TestClient(app) as lifespan_client:
+            with lifespan_client.websocket_connect("/ws/chat?user_id=push_job_user&client_ip=127.0.0.1") as websocket:
+                job_id = self._finished_job("push_job_user")
+                pushed = websocket.receive_json()
+                finished = websocket.receive_json()
+
+        assert pushed == {"event": "generated_image", "data": {**self.IMAGE_DATA, "variants": {}}}
+        assert finished["event"] == "job_finished"
+        assert finished["data"]["job_id"] == job_id
+        assert finished["data"]["status"] == "succeeded"
+
+
+@patch.dict("os.environ", {"AWS_ACCESS_KEY_ID": "AKIDEXAMPLE", "AWS_SECRET_ACCESS_KEY": "secret", "AWS_S3_BUCKET_NAME": "test-bucket"})
+class TestPresignImages:
+    """Test cases for the bulk presign endpoint."""
+
+    @pytest.fixture(autouse=True)
+    def fresh_s3_client(self):
+        from llm.storage import reset_s3_client
+
+        reset_s3_client()
+        yield
+        reset_s3_client()
+
+    def test_presign_many_images(self):
+        """Test that every requested image id gets a URL for the user's key."""
+        image_ids = [f"img-{i}" for i in range(2000)]
+
+        response = client.post("/images/presign", json={"user_id": "gallery_user", "image_ids": image_ids})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["expires_in"] == 7200
+        assert set(data["urls"]) == set(image_ids)
+        assert data["urls"]["img-7"].startswith("https://test-bucket.s3.amazonaws.com/users/gallery_user/images/img-7?")
+
+    def test_presign_variant(self):
+        """Test that a variant, e.g. gallery thumbnails, is presigned at its key next to the original."""
+        response = client.post("/images/presign", json={"user_id": "gallery_user", "image_ids": ["img-1", "img-2"], "variant": "thumb"})
+
+        assert response.status_code == 200
+        assert response.json()["urls"]["img-2"].startswith("https://test-bucket.s3.amazonaws.com/users/gallery_user/images/img-2.thumb?")
+
+    def test_presign_rejects_unknown_variant(self):
+        """Test that only known variants can be requested."""
+        response = client.post("/images/presign", json={"user_id": "gallery_user", "image_ids": ["img-1"], "variant": "gif"})
+
+        assert response.status_code == 422
+
+    def test_variant_names_match_the_variant_specs(self):
+        """Test that every stored variant, and only those, can be presigned."""
+        from typing import get_args
+
+        from llm.images import VARIANT_SPECS
+        from server.main import VariantName
+
+        assert set(get_args(VariantName)) == set(VARIANT_SPECS)
+
+    def test_presign_rejects_oversized_batch(self):
+        """Test that requests over the batch limit are rejected."""
+        from server.main import MAX_PRESIGN_BATCH
+
+        response = client.post("/images/presign", json={"user_id": "gallery_user", "image_ids": ["x"] * (MAX_PRESIGN_BATCH + 1)})
+
+        assert response.status_code == 422
+
+    def test_presign_missing_bucket(self):
+        """Test that a missing bucket setting is reported as a server error."""
+        with patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": ""}):
+            response = client.post("/images/presign", json={"user_id": "gallery_user", "image_ids": ["img-1"]})
+
+        assert response.status_code == 500
+
+
+@patch.dict("os.environ", {"CHAT_RATE_LIMIT_PER_MINUTE": "6", "CHAT_RATE_LIMIT_BURST": "2"})
+class TestChatRateLimit:
+    """Test cases for the per-IP chat rate limit."""
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock, return_value=("Hi!", None))
+    def test_chat_is_limited_per_ip(self, mock_chat):
+        """Test that an IP gets a 429 with Retry-After past its burst while other IPs are served."""
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "test_user", "client_ip": "203.0.113.7"}
+
+        statuses = [client.post("/chat", json=request_data).status_code for _ in range(3)]
+        limited = client.post("/chat/stream", json=request_data)
+        other = client.post("/chat", json={**request_data, "client_ip": "198.51.100.1"})
+
+        assert statuses == [200, 200, 429]
+        assert limited.status_code == 429
+        # One token every 10 seconds at 6 per minute
+        assert 1 <= int(limited.headers["Retry-After"]) <= 10
+        assert other.status_code == 200
+        assert mock_chat.call_count == 3
+        # The limited body was read by the middleware but still reached the endpoint intact
+        assert mock_chat.call_args.kwargs["message"] == "Hello"
+
+        stats = client.get("/metrics").json()["chat_rate_limit"]
+        assert (stats["enabled"], stats["allowed"], stats["limited"], stats["tracked_ips"]) == (True, 3, 2, 2)
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock, return_value=("Hi!", None))
+    def test_idempotent_retry_is_replayed_past_the_limit(self, mock_chat):
+        """Test that resending a completed Idempotency-Key gets its replay even with the bucket empty."""
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "retrying_user", "client_ip": "203.0.113.9"}
+        headers = {"Idempotency-Key": "limited-retry-key"}
+
+        first = client.post("/chat", json=request_data, headers=headers)
+        client.post("/chat", json={**request_data, "message": "Another"})
+        new_message = client.post("/chat", json={**request_data, "message": "One more"}, headers={"Idempotency-Key": "new-key"})
+        retry = client.post("/chat", json=request_data, headers=headers)
+
+        assert first.status_code == 200
+        assert new_message.status_code == 429
+        assert retry.status_code == 200
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert retry.json() == first.json()
+        assert mock_chat.await_count == 2
+        stats = client.get("/metrics").json()["chat_rate_limit"]
+        assert (stats["allowed"], stats["limited"]) == (2, 1)
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock, return_value=("Hi!", None))
+    def test_retry_of_an_unfinished_request_is_charged(self, mock_chat):
+        """Test that a key that is claimed but not answered takes a token, since the retry may run the turn itself."""
+        from server.idempotency import get_idempotency_store, scoped_chat_key
+
+        request_data = {"message": "Hello", "selected_images": [], "user_id": "racing_user", "client_ip": "203.0.113.10"}
+        store = get_idempotency_store()
+        key = scoped_chat_key("racing_user", "unfinished-key")
+        store.claim(key, "original-turn")
+        lookup = store.lookup
+
+        def lookup_then_fail(scoped_key):
+            # The original turn fails and releases its key right after the middleware's check
+            record = lookup(scoped_key)
+            store.release(scoped_key)
+            return record
+
+        with patch.object(store, "lookup", side_effect=lookup_then_fail):
+            statuses = [client.post("/chat", json=request_data, headers={"Idempotency-Key": "unfinished-key"}).status_code]
+        statuses += [client.post("/chat", json={**request_data, "message": f"More {i}"}).status_code for i in range(2)]
+
+        assert statuses == [200, 200, 429]
+        assert mock_chat.await_count == 2
+
+    @patch("server.main.achat_with_agent", new_callable=AsyncMock, return_value=("Hi!", None))
+    def test_invalid_body_is_still_validated(self, mock_chat):
+        """Test that a body the middleware can't parse is keyed on the peer address and rejected by the endpoint."""
+        response = client.post("/chat", content=b"not json", headers={"Content-Type": "application/json"})
+
+        assert response.status_code == 422
+        mock_chat.assert_not_called()
+
+    def test_limit_can_be_disabled(self):
+        """Test that a rate of 0 turns the limiter off."""
+        with patch.dict("os.environ", {"CHAT_RATE_LIMIT_PER_MINUTE": "0"}):
+            assert client.get("/metrics").json()["chat_rate_limit"] == {"enabled": False}
+
+    @patch("server.main.astream_chat_with_agent")
+    def test_websocket_turns_are_limited(self, mock_astream):
+        """Test that /ws/chat turns past the burst get an error event instead of running."""
+
+        async def fake_stream(**kwargs):
+            yield {"event": "done", "data": {"agent_response": "Hi!", "generated_image_data": None}}
+
+        mock_astream.side_effect = fake_stream
+        with client.websocket_connect("/ws/chat?user_id=limited_user&client_ip=203.0.113.8") as websocket:
+            for _ in range(2):
+                websocket.send_text(json.dumps({"message": "Hello"}))
+                assert websocket.receive_json()["event"] == "done"
+            websocket.send_text(json.dumps({"message": "Hello"}))
+            error = websocket.receive_json()
+
+        assert error["event"] == "error"
+        assert error["data"]["retry_after"] >= 1
+        assert mock_astream.call_count == 2
+
+
+class _StubAgent:
+    """Agent stand-in that runs the real async generate_image tool once per turn."""
+
+    def __init__(self):
+        from llm.tools import initialize_tools
+
+        self.tool = initialize_tools()[0]
+
+    async def ainvoke(self, agent_input, config):
+        user_id = config["configurable"]["thread_id"]
+        args = {"prompt": "A sunset", "user_id": user_id, "image_url": "https://example.com/in.png", "title": "Sunset"}
+        result = await self.tool.ainvoke(args, config=config)
+        return {"messages": [{"role": "assistant", "content": result}]}
+
+
+async def _fake_replicate_run(model, input):
+    await asyncio.sleep(0.3)  # Simulated remote generation latency
+    return "https://replicate.delivery/out.png"
+
+
+def _stub_async_client():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=b"png-bytes"))
+    return httpx.AsyncClient(transport=transport)
+
+
+@pytest.mark.benchmark
+@patch.dict(
+    "os.environ",
+    {
+        "IMAGE_INPUT_PREPROCESS": "false",
+        "IMAGE_VARIANTS": "",
+        "GENERATION_CACHE_ENABLED": "false",
+        "QUOTA_CACHE_ENABLED": "false",
+        "CHAT_RATE_LIMIT_PER_MINUTE": "0",
+    },
+)
+class TestChatConcurrency:
+    """Benchmark: concurrent /chat calls with stubbed remote calls should overlap instead of queueing."""
+
+    async def _post_chats(self, count):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            requests = [async_client.post("/chat", json={"message": "Edit", "user_id": f"user-{i}", "client_ip": "127.0.0.1"}) for i in range(count)]
+            start = time.perf_counter()
+            responses = await asyncio.gather(*requests)
+            elapsed = time.perf_counter() - start
+        return responses, elapsed
+
+    @patch("llm.agent._generate_presigned_url", return_value="https://test-bucket.s3.amazonaws.com/test-url")
+    @patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+    @patch("llm.tools.refund_ip_generation", return_value=True)
+    @patch("llm.tools.reserve_ip_generation", return_value=date(2026, 10, 12))
+    @patch("llm.tools.get_async_http_client", side_effect=_stub_async_client)
+    @patch("llm.tools.replicate.async_run", side_effect=_fake_replicate_run)
+    def test_concurrent_chats_finish_in_about_one_generation(self, mock_run, *mocks):
+        """N concurrent generations should take roughly as long as a single one."""
+        # Enough generation slots for every chat, so none of them waits in the queue
+        scheduler = GenerationScheduler(max_concurrency=10)
+        with (
+            patch("llm.agent._aget_agent", new_callable=AsyncMock, return_value=_StubAgent()),
+            patch("llm.tools.get_generation_scheduler", return_value=scheduler),
+        ):
+            _, single = asyncio.run(self._post_chats(1))
+            responses, concurrent = asyncio.run(self._post_chats(10))
+
+        print(f"\n[BENCH] 1 chat: {single:.3f}s, 10 concurrent chats: {concurrent:.3f}s")
+        assert all(r.status_code == 200 for r in responses)
+        assert all(r.json()["generated_image"] is not None for r in responses)
+        assert mock_run.call_count == 11
+        assert concurrent < single * 2
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,142 @@
+import io
+
+import pytest
+from PIL import Image
+
+from llm.edits import EditError, apply_edits, describe_edits
+
+
+def _image(size=(400, 200), mode="RGB", color=(200, 40, 40)) -> bytes:
+    """An image whose left half is the given color and right half is blue, so flips and rotations are visible."""
+    image = Image.new(mode, size, color)
+    image.paste((0, 0, 255) + ((255,) if mode == "RGBA" else ()), (size[0] // 2, 0, size[0], size[1]))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def _edit(operations, source=None, output_format="png") -> Image.Image:
+    data, _ = apply_edits(source or _image(), operations, output_format)
+    return Image.open(io.BytesIO(data))
+
+
+class TestEditOperations:
+    """Test cases for each local edit operation."""
+
+    def test_crop_to_aspect_ratio_is_centered(self):
+        """Test that a square crop of a landscape keeps the middle."""
+        image = _edit([{"op": "crop", "aspect_ratio": "1:1"}])
+
+        assert image.size == (200, 200)
+        # The middle of the 400px image straddles the red and blue halves
+        assert image.getpixel((0, 100))[:3] == (200, 40, 40)
+        assert image.getpixel((199, 100))[:3] == (0, 0, 255)
+
+    def test_crop_to_box(self):
+        """Test that a box of fractions keeps that part of the image."""
+        image = _edit([{"op": "crop", "left": 0.5, "right": 1.0, "top": 0.0, "bottom": 0.5}])
+
+        assert image.size == (200, 100)
+        assert image.getpixel((10, 10))[:3] == (0, 0, 255)
+
+    def test_resize_keeps_aspect_ratio(self):
+        """Test that giving only a width scales the height to match."""
+        assert _edit([{"op": "resize", "width": 100}]).size == (100, 50)
+        assert _edit([{"op": "resize", "width": 100, "height": 100}]).size == (100, 100)
+
+    def test_rotate_quarter_turn_clockwise(self):
+        """Test that a 90 degree rotation is clockwise: the left half ends up on top."""
+        image = _edit([{"op": "rotate", "degrees": 90}])
+
+        assert image.size == (200, 400)
+        assert image.getpixel((100, 10))[:3] == (200, 40, 40)
+        assert image.getpixel((100, 390))[:3] == (0, 0, 255)
+
+    def test_rotate_arbitrary_angle_expands_canvas(self):
+        """Test that other angles grow the canvas to fit the rotated image."""
+        image = _edit([{"op": "rotate", "degrees": 45}], source=_image(mode="RGBA", color=(200, 40, 40, 255)))
+
+        assert image.width > 400 and image.height > 200
+        # The new corners are transparent rather than black
+        assert image.getpixel((0, 0))[3] == 0
+
+    def test_flip(self):
+        """Test horizontal and vertical flips."""
+        assert _edit([{"op": "flip"}]).getpixel((10, 10))[:3] == (0, 0, 255)
+        assert _edit([{"op": "flip", "direction": "vertical"}]).getpixel((10, 10))[:3] == (200, 40, 40)
+
+    def test_grayscale_and_enhancements(self):
+        """Test grayscale, brightness, contrast, blur and sharpen in one chain."""
+        operations = [
+            {"op": "grayscale"},
+            {"op": "brightness", "factor": 0.5},
+            {"op": "contrast", "factor": 1.5},
+            {"op": "blur", "radius": 2},
+            {"op": "sharpen"},
+        ]
+        image = _edit(operations)
+        plain = _edit([{"op": "grayscale"}])
+
+        assert image.mode == "L"
+        assert image.getpixel((10, 10)) < plain.getpixel((10, 10))
+
+    def test_zero_factor_is_not_the_default(self):
+        """Test that factor 0 is applied as given: black for brightness, flat gray for contrast."""
+        dark = _edit([{"op": "brightness", "factor": 0}])
+        flat = _edit([{"op": "contrast", "factor": 0}])
+
+        assert dark.getpixel((10, 10)) == dark.getpixel((390, 10)) == (0, 0, 0)
+        gray = flat.getpixel((10, 10))
+        assert flat.getpixel((390, 10)) == gray
+        assert gray[0] == gray[1] == gray[2] > 0
+
+    def test_format_conversion(self):
+        """Test that transparent images convert to JPEG and WebP keeps alpha."""
+        source = _image(mode="RGBA", color=(200, 40, 40, 128))
+
+        jpeg_data, jpeg_type = apply_edits(source, [{"op": "flip"}], "jpeg")
+        webp = _edit([{"op": "flip"}], source=source, output_format="webp")
+
+        assert jpeg_type == "image/jpeg"
+        assert Image.open(io.BytesIO(jpeg_data)).mode == "RGB"
+        assert (webp.format, webp.mode) == ("WEBP", "RGBA")
+
+    def test_exif_orientation_is_applied_first(self):
+        """Test that edits apply to the image as it is displayed."""
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Displayed rotated 90 degrees clockwise
+        output = io.BytesIO()
+        Image.new("RGB", (400, 200)).save(output, format="JPEG", exif=exif.tobytes())
+
+        image = _edit([{"op": "resize", "width": 100}], source=output.getvalue())
+
+        assert image.size == (100, 200)
+        assert not image.getexif()
+
+    @pytest.mark.parametrize(
+        "operations, output_format",
+        [
+            ([{"op": "posterize"}], "png"),
+            ([{"op": "crop", "aspect_ratio": "square"}], "png"),
+            ([{"op": "crop", "aspect_ratio": "0:1"}], "png"),
+            ([{"op": "crop", "aspect_ratio": "1:0"}], "png"),
+            ([{"op": "crop", "aspect_ratio": "-16:9"}], "png"),
+            ([{"op": "crop", "aspect_ratio": "nan:1"}], "png"),
+            ([{"op": "crop", "left": 0.8, "right": 0.2}], "png"),
+            ([{"op": "resize", "width": 100000}], "png"),
+            ([{"op": "resize"}], "png"),
+            ([{"op": "brightness", "factor": 50}], "png"),
+            ([{"op": "blur", "radius": 0}], "png"),
+            ([{"op": "flip", "direction": "diagonal"}], "png"),
+            ([], "png"),
+            ([{"op": "flip"}], "gif"),
+        ],
+    )
+    def test_invalid_edits_raise(self, operations, output_format):
+        """Test that invalid operations are reported as EditError."""
+        with pytest.raises(EditError):
+            apply_edits(_image(), operations, output_format)
+
+    def test_describe_edits(self):
+        """Test the summary used as the edited image's description."""
+        assert describe_edits([{"op": "rotate", "degrees": 90}, {"op": "grayscale"}]) == "rotate (degrees=90), grayscale"
@@ -0,0 +1,134 @@
+import uuid
+from unittest.mock import patch
+
+import pytest
+from dotenv import load_dotenv
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm import generation_cache
+            from llm.connection_manager import get_db_connection
+            from llm.generation_cache import (
+                evict_generation_cache,
+                forget_generation,
+                generation_cache_key,
+                get_generation_cache_hit_rates,
+                lookup_generation,
+                store_generation,
+            )
+
+load_dotenv()
+
+MODEL = "black-forest-labs/flux-kontext-pro"
+DATA_URI = "data:image/jpeg;base64,/9j/AAAA"
+
+
+def _input(prompt="A sunset", image=DATA_URI, **params):
+    return {"prompt": prompt, "input_image": image, "output_format": "png", **params}
+
+
+class TestGenerationCacheKey:
+    """Test cases for the content-addressed cache key."""
+
+    def test_prompt_whitespace_and_case_are_normalized(self):
+        """Test that prompts differing only in spacing and case share a key."""
+        assert generation_cache_key(MODEL, _input("A sunset")) == generation_cache_key(MODEL, _input("  a   SUNSET\n"))
+
+    def test_each_part_of_the_request_changes_the_key(self):
+        """Test that the model, prompt, input image and parameters are all part of the key."""
+        base = generation_cache_key(MODEL, _input())
+
+        assert generation_cache_key("other/model", _input()) != base
+        assert generation_cache_key(MODEL, _input("A sunrise")) != base
+        assert generation_cache_key(MODEL, _input(image="data:image/jpeg;base64,/9j/BBBB")) != base
+        assert generation_cache_key(MODEL, _input(output_format="jpg")) != base
+
+    def test_presigned_url_signature_is_ignored(self):
+        """Test that re-signing the same source image keeps its key."""
+        first = _input(image="https://bucket.s3.amazonaws.com/users/u/images/img-1?X-Amz-Signature=aaa")
+        second = _input(image="https://bucket.s3.amazonaws.com/users/u/images/img-1?X-Amz-Signature=bbb")
+        other = _input(image="https://bucket.s3.amazonaws.com/users/u/images/img-2?X-Amz-Signature=aaa")
+
+        assert generation_cache_key(MODEL, first) == generation_cache_key(MODEL, second)
+        assert generation_cache_key(MODEL, first) != generation_cache_key(MODEL, other)
+
+
+@pytest.fixture
+def cache_key():
+    """A unique cache key whose entry is removed after the test."""
+    key = uuid.uuid4().hex * 2
+    yield key
+    forget_generation(key)
+
+
+def _today_tally():
+    rates = get_generation_cache_hit_rates(days=1)
+    return (rates[0]["hits"], rates[0]["misses"]) if rates else (0, 0)
+
+
+@pytest.mark.database
+class TestGenerationCacheStore:
+    """Test cases for the generation_cache table."""
+
+    def test_store_and_lookup(self, cache_key):
+        """Test that a stored generation is found, marked used and tallied as a hit."""
+        store_generation(cache_key, MODEL, "owner", "img-1", ["webp", "thumb"])
+        hits, misses = _today_tally()
+
+        row = lookup_generation(cache_key)
+
+        assert (row["user_id"], row["image_id"], row["variants"], row["hit_count"]) == ("owner", "img-1", ["webp", "thumb"], 1)
+        assert _today_tally() == (hits + 1, misses)
+
+    def test_miss_is_tallied(self, cache_key):
+        """Test that a lookup of an unknown key returns None and counts a miss."""
+        hits, misses = _today_tally()
+
+        assert lookup_generation(cache_key) is None
+        assert _today_tally() == (hits, misses + 1)
+
+    def test_first_stored_image_is_kept(self, cache_key):
+        """Test that a concurrent identical generation doesn't replace the cached image."""
+        store_generation(cache_key, MODEL, "owner", "img-1", [])
+        store_generation(cache_key, MODEL, "other", "img-2", [])
+
+        assert lookup_generation(cache_key)["image_id"] == "img-1"
+
+    def test_expired_entries_are_missed_and_evicted(self, cache_key):
+        """Test that an entry unused for longer than the TTL is no longer served, then evicted."""
+        store_generation(cache_key, MODEL, "owner", "img-1", [])
+        with get_db_connection() as conn:
+            conn.execute("UPDATE generation_cache SET last_hit_at = now() - interval '31 days' WHERE cache_key = %s", (cache_key,))
+
+        assert lookup_generation(cache_key) is None
+        assert evict_generation_cache(ttl_days=30) >= 1
+        with get_db_connection() as conn:
+            assert conn.execute("SELECT 1 FROM generation_cache WHERE cache_key = %s", (cache_key,)).fetchone() is None
+
+    def test_least_recently_used_entries_are_evicted_over_the_limit(self):
+        """Test that the size limit keeps the most recently used entries."""
+        keys = [uuid.uuid4().hex * 2 for _ in range(3)]
+        try:
+            for key in keys:
+                store_generation(key, MODEL, "owner", key[:8], [])
+            lookup_generation(keys[0])
+            with get_db_connection() as conn:
+                total = conn.execute("SELECT count(*) AS n FROM generation_cache").fetchone()["n"]
+
+            evict_generation_cache(max_entries=total - 2)
+
+            with get_db_connection() as conn:
+                remaining = {row["cache_key"] for row in conn.execute("SELECT cache_key FROM generation_cache WHERE cache_key = ANY(%s)", (keys,))}
+            assert remaining == {keys[0]}
+        finally:
+            for key in keys:
+                forget_generation(key)
+
+    def test_stores_trigger_periodic_eviction(self, cache_key):
+        """Test that an eviction pass runs every GENERATION_CACHE_EVICT_EVERY stores."""
+        with patch.object(generation_cache, "_evict_every", 1), patch.object(generation_cache, "evict_generation_cache") as mock_evict:
+            store_generation(cache_key, MODEL, "owner", "img-1", [])
+
+        mock_evict.assert_called_once()
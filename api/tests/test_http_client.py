@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import httpx
+import pytest
+import requests
+
+from llm.http_client import _http2_enabled, aclose_async_http_client, get_async_http_client, get_http_session, reset_http_session
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Keep-alive handler whose behaviour per path is driven by the server's state."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        state = self.server.state
+        with state["lock"]:
+            state["requests"] += 1
+            state["connections"].add(self.client_address)
+            attempt = state["requests"]
+
+        if self.path == "/slow":
+            time.sleep(0.5)
+        status = 503 if self.path == "/flaky" and attempt <= state["failures"] else 200
+        if self.path == "/down":
+            status = 503
+
+        body = b"ok"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.state = {"lock": threading.Lock(), "requests": 0, "connections": set(), "failures": 0}
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_port}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def http_env():
+    env = {"HTTP_READ_TIMEOUT": "0.2", "HTTP_CONNECT_TIMEOUT": "1", "HTTP_MAX_RETRIES": "2", "HTTP_RETRY_BACKOFF": "0"}
+    with patch.dict("os.environ", env):
+        reset_http_session()
+        yield
+        reset_http_session()
+
+
+class TestHTTPSession:
+    """Test cases for the shared requests session."""
+
+    def test_session_is_shared(self):
+        """Test that every caller gets the same session."""
+        assert get_http_session() is get_http_session()
+
+    def test_connections_are_reused(self, server):
+        """Test that sequential requests to one host share a kept-alive connection."""
+        for _ in range(5):
+            response = get_http_session().get(f"{server.url}/ok")
+            assert response.content == b"ok"
+
+        assert server.state["requests"] == 5
+        assert len(server.state["connections"]) == 1
+
+    def test_default_read_timeout_is_bounded_by_retries(self, server):
+        """Test that a stalled server times out and is retried a bounded number of times."""
+        start = time.perf_counter()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            get_http_session().get(f"{server.url}/slow")
+
+        # One attempt plus HTTP_MAX_RETRIES, each cut off by the 0.2s read timeout
+        assert server.state["requests"] == 3
+        assert time.perf_counter() - start < 2
+
+    def test_transient_errors_are_retried(self, server):
+        """Test that 5xx responses are retried until the server recovers."""
+        server.state["failures"] = 2
+
+        response = get_http_session().get(f"{server.url}/flaky")
+
+        assert response.status_code == 200
+        assert server.state["requests"] == 3
+
+    def test_exhausted_retries_return_the_error_response(self, server):
+        """Test that the last error response is returned for raise_for_status to report."""
+        response = get_http_session().get(f"{server.url}/down")
+
+        assert response.status_code == 503
+        assert server.state["requests"] == 3
+        with pytest.raises(requests.HTTPError):
+            response.raise_for_status()
+
+
+class TestAsyncHTTPClient:
+    """Test cases for the shared async client."""
+
+    def test_client_is_shared_within_a_loop(self):
+        """Test that one loop reuses its client and another loop gets its own."""
+
+        async def get_twice():
+            client = get_async_http_client()
+            assert get_async_http_client() is client
+            await aclose_async_http_client()
+            return client
+
+        first = asyncio.run(get_twice())
+        second = asyncio.run(get_twice())
+
+        assert first is not second
+        assert first.is_closed and second.is_closed
+
+    def test_connections_are_reused(self, server):
+        """Test that sequential requests reuse a pooled connection."""
+
+        async def fetch():
+            client = get_async_http_client()
+            for _ in range(5):
+                response = await client.get(f"{server.url}/ok")
+                assert response.content == b"ok"
+            await aclose_async_http_client()
+
+        asyncio.run(fetch())
+
+        assert server.state["requests"] == 5
+        assert len(server.state["connections"]) == 1
+
+    def test_default_read_timeout(self, server):
+        """Test that a stalled server raises a read timeout instead of hanging."""
+
+        async def fetch():
+            try:
+                await get_async_http_client().get(f"{server.url}/slow")
+            finally:
+                await aclose_async_http_client()
+
+        with pytest.raises(httpx.ReadTimeout):
+            asyncio.run(fetch())
+
+    def test_transport_uses_configured_retries(self):
+        """Test that failed connection attempts are retried HTTP_MAX_RETRIES times."""
+
+        async def build():
+            client = get_async_http_client()
+            retries = client._transport._pool._retries
+            await aclose_async_http_client()
+            return retries
+
+        assert asyncio.run(build()) == 2
+
+    @patch.dict("os.environ", {"HTTP2_ENABLED": "true"})
+    def test_http2_falls_back_without_h2(self):
+        """Test that HTTP/2 is only negotiated when the h2 package is importable."""
+        with patch.dict("sys.modules", {"h2": None}):
+            assert _http2_enabled() is False
+        with patch.dict("sys.modules", {"h2": object()}):
+            assert _http2_enabled() is True
@@ -0,0 +1,227 @@
+import asyncio
+import uuid
+from unittest.mock import patch
+
+import pytest
+from dotenv import load_dotenv
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm.connection_manager import get_db_connection
+            from server import idempotency
+            from server.idempotency import (
+                STATUS_COMPLETED,
+                IdempotencyKeyConflict,
+                IdempotencyKeyInProgress,
+                MemoryIdempotencyStore,
+                PostgresIdempotencyStore,
+                request_fingerprint,
+                run_idempotent,
+            )
+
+load_dotenv()
+
+RESPONSE = {"response": "Done!", "status": "success", "generated_image": None}
+
+
+class TestMemoryIdempotencyStore:
+    """Test cases for the in-process idempotency store."""
+
+    def test_claim_complete_and_replay(self):
+        """Test that the first claim owns the key and later claims see its response."""
+        store = MemoryIdempotencyStore()
+
+        assert store.claim("k", "fp") is None
+        assert store.claim("k", "fp")["status"] == "in_progress"
+        store.complete("k", "fp", RESPONSE)
+
+        assert store.claim("k", "fp") == {"fingerprint": "fp", "status": STATUS_COMPLETED, "response": RESPONSE}
+
+    def test_release_frees_an_unfinished_key(self):
+        """Test that a failed request's key can be claimed again, but a completed one can't be released."""
+        store = MemoryIdempotencyStore()
+        store.claim("failed", "fp")
+        store.release("failed")
+        store.claim("done", "fp")
+        store.complete("done", "fp", RESPONSE)
+        store.release("done")
+
+        assert store.claim("failed", "fp") is None
+        assert store.claim("done", "fp")["status"] == STATUS_COMPLETED
+
+    def test_expired_keys_can_be_claimed_again(self):
+        """Test that a claim whose request died is taken over after the lock timeout."""
+        store = MemoryIdempotencyStore()
+        with patch.object(idempotency, "_lock_timeout", -1):
+            store.claim("k", "fp")
+
+        assert store.claim("k", "fp") is None
+
+    def test_lookup_does_not_claim(self):
+        """Test that looking a key up reports its record without taking it."""
+        store = MemoryIdempotencyStore()
+        assert store.lookup("k") is None
+        assert store.claim("k", "fp") is None
+
+        store.complete("k", "fp", RESPONSE)
+        assert store.lookup("k")["status"] == STATUS_COMPLETED
+        with patch.object(idempotency, "_lock_timeout", -1):
+            store.claim("expired", "fp")
+        assert store.lookup("expired") is None
+
+    def test_store_is_bounded(self):
+        """Test that the oldest keys are dropped beyond max_entries."""
+        store = MemoryIdempotencyStore(max_entries=2)
+        for key in ("a", "b", "c"):
+            store.claim(key, "fp")
+
+        assert store.claim("a", "fp") is None
+        assert store.claim("c", "fp") is not None
+
+
+@pytest.fixture
+def memory_store():
+    store = MemoryIdempotencyStore()
+    with patch.object(idempotency, "get_idempotency_store", return_value=store):
+        yield store
+
+
+class TestRunIdempotent:
+    """Test cases for running a request once per key."""
+
+    def test_concurrent_duplicates_attach_to_the_running_request(self, memory_store):
+        """Test that retries arriving mid-turn wait for it and get its response, marked as replayed."""
+        calls = []
+
+        async def handler():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return RESPONSE
+
+        async def main():
+            return await asyncio.gather(*(run_idempotent("k", "fp", handler) for _ in range(3)))
+
+        results = asyncio.run(main())
+
+        assert len(calls) == 1
+        assert sorted(replayed for _, replayed in results) == [False, True, True]
+        assert all(response == RESPONSE for response, _ in results)
+
+    def test_later_retry_is_replayed_from_the_store(self, memory_store):
+        """Test that a retry after the request finished gets the stored response."""
+        calls = []
+
+        async def handler():
+            calls.append(1)
+            return RESPONSE
+
+        asyncio.run(run_idempotent("k", "fp", handler))
+
+        assert asyncio.run(run_idempotent("k", "fp", handler)) == (RESPONSE, True)
+        assert len(calls) == 1
+
+    def test_key_reused_for_a_different_request(self, memory_store):
+        """Test that a key can't be replayed for a different request body."""
+
+        async def handler():
+            return RESPONSE
+
+        asyncio.run(run_idempotent("k", "fp", handler))
+
+        with pytest.raises(IdempotencyKeyConflict):
+            asyncio.run(run_idempotent("k", "other-fp", handler))
+
+    def test_failed_request_releases_its_key(self, memory_store):
+        """Test that a retry of a failed request runs it again."""
+
+        async def fail():
+            raise RuntimeError("model unavailable")
+
+        async def succeed():
+            return RESPONSE
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(run_idempotent("k", "fp", fail))
+
+        assert asyncio.run(run_idempotent("k", "fp", succeed)) == (RESPONSE, False)
+
+    def test_waits_for_a_request_running_in_another_process(self, memory_store):
+        """Test that a retry polls a claim it doesn't own until the response is stored."""
+        memory_store.claim("k", "fp")
+
+        async def handler():
+            raise AssertionError("the retry must not run the request")
+
+        async def main():
+            retry = asyncio.ensure_future(run_idempotent("k", "fp", handler))
+            await asyncio.sleep(0.1)
+            memory_store.complete("k", "fp", RESPONSE)
+            return await retry
+
+        with patch.object(idempotency, "_poll_interval", 0.01):
+            assert asyncio.run(main()) == (RESPONSE, True)
+
+    def test_gives_up_waiting_after_the_timeout(self, memory_store):
+        """Test that a retry reports the request as still in progress after waiting."""
+        memory_store.claim("k", "fp")
+
+        async def handler():
+            return RESPONSE
+
+        with patch.object(idempotency, "_poll_interval", 0.01), patch.object(idempotency, "_wait_timeout", 0.05):
+            with pytest.raises(IdempotencyKeyInProgress):
+                asyncio.run(run_idempotent("k", "fp", handler))
+
+    def test_fingerprint_ignores_key_order(self):
+        """Test that equal bodies hash the same however they were serialized."""
+        assert request_fingerprint({"a": 1, "b": [1, 2]}) == request_fingerprint({"b": [1, 2], "a": 1})
+        assert request_fingerprint({"a": 1}) != request_fingerprint({"a": 2})
+
+
+@pytest.fixture
+def pg_key():
+    """A unique key whose row is removed after the test."""
+    key = f"test:{uuid.uuid4().hex}"
+    yield key
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+
+
+@pytest.mark.database
+class TestPostgresIdempotencyStore:
+    """Test cases for the idempotency_keys table."""
+
+    def test_claim_complete_and_replay(self, pg_key):
+        """Test that the response stored by the owner is returned to later claims."""
+        store = PostgresIdempotencyStore()
+
+        assert store.claim(pg_key, "fp") is None
+        assert store.claim(pg_key, "fp")["status"] == "in_progress"
+        store.complete(pg_key, "fp", RESPONSE)
+
+        record = store.claim(pg_key, "fp")
+        assert (record["status"], record["response"]) == (STATUS_COMPLETED, RESPONSE)
+
+    def test_lookup_does_not_claim(self, pg_key):
+        """Test that a key is reported once claimed and looking it up doesn't take it."""
+        store = PostgresIdempotencyStore()
+        assert store.lookup(pg_key) is None
+        assert store.claim(pg_key, "fp") is None
+
+        assert store.lookup(pg_key)["status"] == "in_progress"
+        store.release(pg_key)
+        assert store.lookup(pg_key) is None
+
+    def test_release_and_expiry(self, pg_key):
+        """Test that released and expired claims can be claimed again."""
+        store = PostgresIdempotencyStore()
+        store.claim(pg_key, "fp")
+        store.release(pg_key)
+        assert store.claim(pg_key, "fp") is None
+
+        with patch.object(idempotency, "_ttl", -1):
+            store.complete(pg_key, "fp", RESPONSE)
+        assert store.claim(pg_key, "other-fp") is None
+        assert store.purge_expired() >= 0
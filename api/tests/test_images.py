@@ -0,0 +1,284 @@
+import asyncio
+import base64
+import io
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+from PIL import Image, ImageDraw, ImageFilter, features
+
+from llm.images import (
+    VARIANT_SPECS,
+    aprepare_input_image_url,
+    create_image_variants,
+    enabled_variants,
+    prepare_input_image,
+    prepare_input_image_url,
+    render_variants,
+    shutdown_variant_executor,
+    to_data_uri,
+)
+
+SOURCE_URL = "https://test-bucket.s3.amazonaws.com/users/test_user/images/in.jpg"
+USER_ID = "test_user"
+
+
+def _photo(size=(4000, 3000), orientation=6) -> bytes:
+    """A noisy landscape JPEG tagged with an EXIF orientation and camera metadata, like a phone photo."""
+    image = Image.effect_noise(size, 64).convert("RGB")
+    exif = Image.Exif()
+    exif[0x0112] = orientation  # Orientation: rotate 90 degrees clockwise to display
+    exif[0x010F] = "PhoneMaker"  # Make
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95, exif=exif.tobytes())
+    return output.getvalue()
+
+
+def _decode_data_uri(uri: str) -> Image.Image:
+    header, payload = uri.split(",", 1)
+    assert header.startswith("data:image/") and header.endswith(";base64")
+    return Image.open(io.BytesIO(base64.b64decode(payload)))
+
+
+class TestPrepareInputImage:
+    """Test cases for orienting, downscaling and re-encoding input images."""
+
+    def test_photo_is_oriented_downscaled_and_stripped(self):
+        """Test that a rotated 12MP photo comes out upright, within the max side and without EXIF."""
+        source = _photo()
+
+        prepared, mime_type = prepare_input_image(source, max_side=1024)
+
+        image = Image.open(io.BytesIO(prepared))
+        assert mime_type == "image/jpeg"
+        assert image.format == "JPEG"
+        # Orientation 6 turns the 4000x3000 landscape into a portrait
+        assert image.size == (768, 1024)
+        assert not image.getexif()
+        assert "exif" not in image.info
+        print(f"\n[BENCH] input image {len(source)} bytes -> {len(prepared)} bytes")
+        assert len(prepared) < len(source) / 4
+
+    def test_transparency_is_kept_as_png(self):
+        """Test that images with an alpha channel are re-encoded as PNG."""
+        output = io.BytesIO()
+        Image.new("RGBA", (2048, 512), (255, 0, 0, 128)).save(output, format="PNG")
+
+        prepared, mime_type = prepare_input_image(output.getvalue(), max_side=1024)
+
+        image = Image.open(io.BytesIO(prepared))
+        assert mime_type == "image/png"
+        assert image.mode == "RGBA"
+        assert image.size == (1024, 256)
+
+    def test_small_images_are_not_upscaled(self):
+        """Test that an image already within the max side keeps its size."""
+        prepared, _ = prepare_input_image(_photo(size=(640, 480), orientation=1), max_side=1024)
+
+        assert Image.open(io.BytesIO(prepared)).size == (640, 480)
+
+
+@patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+class TestPrepareInputImageURL:
+    """Test cases for fetching the source image and handing the model a data URI."""
+
+    def test_sync_fetch_returns_data_uri(self):
+        """Test that the sync path downloads the source and returns a prepared data URI."""
+        session = MagicMock()
+        source = _photo()
+        session.get.return_value.__enter__.return_value = MagicMock(headers={}, iter_content=lambda chunk_size: iter([source]))
+
+        with patch("llm.images.get_http_session", return_value=session):
+            result = prepare_input_image_url(SOURCE_URL, USER_ID)
+
+        assert result.startswith("data:image/jpeg;base64,")
+        assert max(_decode_data_uri(result).size) == 1024
+
+    def test_async_fetch_returns_data_uri(self):
+        """Test that the async path downloads with the shared client and prepares off the event loop."""
+        source = _photo()
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=source))
+
+        with patch("llm.images.get_async_http_client", return_value=httpx.AsyncClient(transport=transport)):
+            result = asyncio.run(aprepare_input_image_url(SOURCE_URL, USER_ID))
+
+        assert _decode_data_uri(result).size == (768, 1024)
+
+    @pytest.mark.parametrize(
+        "response",
+        [
+            httpx.Response(404),
+            httpx.Response(200, content=b"not an image"),
+            httpx.Response(200, headers={"Content-Length": str(100 * 1024 * 1024)}, content=b""),
+        ],
+        ids=["fetch-error", "undecodable", "too-large"],
+    )
+    def test_falls_back_to_source_url(self, response):
+        """Test that the original URL is used whenever the source can't be prepared."""
+        transport = httpx.MockTransport(lambda request: response)
+
+        with patch("llm.images.get_async_http_client", return_value=httpx.AsyncClient(transport=transport)):
+            assert asyncio.run(aprepare_input_image_url(SOURCE_URL, USER_ID)) == SOURCE_URL
+
+    def test_chunked_download_stops_at_the_limit(self):
+        """Test that a response without Content-Length is read only until it passes IMAGE_INPUT_MAX_BYTES."""
+        sent = []
+
+        def chunks():
+            # Endless, so reading the whole body would never finish
+            while True:
+                sent.append(1)
+                yield b"x" * 1024
+
+        async def achunks():
+            for chunk in chunks():
+                yield chunk
+
+        session = MagicMock()
+        session.get.return_value.__enter__.return_value = MagicMock(headers={}, iter_content=lambda chunk_size: chunks())
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=achunks()))
+
+        with patch("llm.images._max_source_bytes", 10 * 1024), patch("llm.images._download_chunk_bytes", 1024):
+            with patch("llm.images.get_http_session", return_value=session):
+                assert prepare_input_image_url(SOURCE_URL, USER_ID) == SOURCE_URL
+            assert len(sent) == 11
+            with patch("llm.images.get_async_http_client", return_value=httpx.AsyncClient(transport=transport)):
+                assert asyncio.run(aprepare_input_image_url(SOURCE_URL, USER_ID)) == SOURCE_URL
+            assert len(sent) == 22
+
+    def test_non_http_inputs_and_disabled_preprocessing_pass_through(self):
+        """Test that data URIs, and every URL with IMAGE_INPUT_PREPROCESS=false, are left alone."""
+        data_uri = to_data_uri(b"png", "image/png")
+
+        with patch("llm.images.get_http_session") as mock_session:
+            assert prepare_input_image_url(data_uri, USER_ID) == data_uri
+            with patch.dict("os.environ", {"IMAGE_INPUT_PREPROCESS": "false"}):
+                assert prepare_input_image_url(SOURCE_URL, USER_ID) == SOURCE_URL
+
+        mock_session.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "image_url",
+        [
+            "http://169.254.169.254/latest/meta-data/iam/security-credentials/",
+            "https://internal.example/users/test_user/images/in.jpg",
+            "https://test-bucket.s3.amazonaws.com/users/someone_else/images/in.jpg",
+        ],
+        ids=["metadata-endpoint", "other-host", "other-user"],
+    )
+    def test_urls_outside_the_users_images_are_not_fetched(self, image_url):
+        """Test that URLs the model made up are handed on unchanged instead of downloaded by the server."""
+        with patch("llm.images.get_http_session") as mock_session, patch("llm.images.get_async_http_client") as mock_client:
+            assert prepare_input_image_url(image_url, USER_ID) == image_url
+            assert asyncio.run(aprepare_input_image_url(image_url, USER_ID)) == image_url
+
+        mock_session.assert_not_called()
+        mock_client.assert_not_called()
+
+
+def _png(image: Image.Image) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def _sample_corpus(size=1024):
+    """Synthetic stand-ins for model output at its usual 1024x1024, plus the repo's diagram."""
+    smooth = Image.merge(
+        "RGB",
+        [
+            Image.radial_gradient("L").resize((size, size)),
+            Image.linear_gradient("L").resize((size, size)),
+            Image.effect_noise((size, size), 24).filter(ImageFilter.GaussianBlur(3)),
+        ],
+    )
+
+    illustration = Image.new("RGB", (size, size), (245, 240, 230))
+    draw = ImageDraw.Draw(illustration)
+    for i in range(40):
+        draw.ellipse((i * 20, i * 13 % size, i * 20 + 200, i * 13 % size + 160), fill=(i * 6 % 255, 120, 255 - i * 6 % 255))
+
+    noisy = Image.merge("RGB", [Image.effect_noise((size, size), 48) for _ in range(3)])
+
+    transparent = smooth.convert("RGBA")
+    transparent.putalpha(Image.radial_gradient("L").resize((size, size)))
+
+    corpus = {"smooth": _png(smooth), "illustration": _png(illustration), "noisy": _png(noisy), "transparent": _png(transparent)}
+    diagram = Path(__file__).resolve().parents[2] / "assets" / "architecture.png"
+    if diagram.exists():
+        corpus["diagram"] = diagram.read_bytes()
+    return corpus
+
+
+class TestImageVariants:
+    """Test cases for the gallery variants of generated images."""
+
+    def test_render_variants(self):
+        """Test that each variant is encoded in its format, with the thumbnail downscaled."""
+        source = _sample_corpus()["illustration"]
+
+        rendered = render_variants(source, ["webp", "thumb"])
+
+        webp, thumb = (Image.open(io.BytesIO(rendered[name])) for name in ("webp", "thumb"))
+        assert (webp.format, webp.size) == ("WEBP", (1024, 1024))
+        assert thumb.format == "WEBP"
+        assert max(thumb.size) == VARIANT_SPECS["thumb"][2]
+
+    @pytest.mark.skipif(not features.check("avif"), reason="Pillow was built without AVIF support")
+    def test_render_avif_variant(self):
+        """Test the optional AVIF variant."""
+        rendered = render_variants(_sample_corpus()["illustration"], ["avif"])
+
+        avif = Image.open(io.BytesIO(rendered["avif"]))
+        assert (avif.format, avif.size) == ("AVIF", (1024, 1024))
+
+    def test_transparency_is_kept(self):
+        """Test that variants of an image with alpha keep the alpha channel."""
+        rendered = render_variants(_sample_corpus()["transparent"], ["webp"])
+
+        assert Image.open(io.BytesIO(rendered["webp"])).mode == "RGBA"
+
+    def test_create_image_variants_uses_the_process_pool(self):
+        """Test that variants are rendered in a separate process and tagged with their content type."""
+        try:
+            variants = create_image_variants(_sample_corpus(256)["smooth"], ["webp", "thumb"])
+        finally:
+            shutdown_variant_executor()
+
+        assert {name: content_type for name, (_, content_type) in variants.items()} == {"webp": "image/webp", "thumb": "image/webp"}
+
+    def test_enabled_variants(self):
+        """Test that IMAGE_VARIANTS selects known variants and can disable them."""
+        assert enabled_variants() == ["webp", "thumb"]
+        with patch.dict("os.environ", {"IMAGE_VARIANTS": "webp, avif,thumb,gif"}):
+            assert enabled_variants() == ["webp", "avif", "thumb"]
+        with patch.dict("os.environ", {"IMAGE_VARIANTS": ""}):
+            assert enabled_variants() == []
+
+
+@pytest.mark.benchmark
+class TestImageVariantsBenchmark:
+    """Benchmark: encode time and size of each variant against the PNG original."""
+
+    def test_variant_encode_time_and_savings(self):
+        corpus = _sample_corpus()
+        totals = {name: 0 for name in VARIANT_SPECS}
+        print()
+        for label, png in corpus.items():
+            row = []
+            for name in VARIANT_SPECS:
+                if name == "avif" and not features.check("avif"):
+                    continue
+                start = time.perf_counter()
+                data = render_variants(png, [name])[name]
+                elapsed = time.perf_counter() - start
+                totals[name] += len(data)
+                row.append(f"{name} {len(data) / 1024:.0f} KB in {elapsed * 1000:.0f} ms")
+            print(f"[BENCH] {label}: png {len(png) / 1024:.0f} KB | " + " | ".join(row))
+
+        png_total = sum(len(png) for png in corpus.values())
+        print("[BENCH] corpus savings vs PNG: " + ", ".join(f"{name} {1 - size / png_total:.0%}" for name, size in totals.items()))
+        assert totals["webp"] < png_total / 2
+        assert totals["thumb"] < png_total / 20
@@ -0,0 +1,172 @@
+import io
+import threading
+import time
+from datetime import date, datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm import jobs
+            from llm.tools import QUOTA_HELD_MESSAGE, _generate_image_callable
+
+
+def _wait_for(job_id, status, timeout=5.0):
+    """Poll a job until it reaches the status."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get_job(job_id)
+        if job["status"] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not reach {status}: {jobs.get_job(job_id)}")
+
+
+class TestJobs:
+    """Test cases for the background generation job executor."""
+
+    def test_job_succeeds_and_notifies_listener(self):
+        """Test that a successful job records its image and calls completion listeners."""
+        finished = []
+        jobs.add_completion_listener(finished.append)
+        try:
+            result = {"success": True, "message": "done", "image_id": "img-1", "title": "Sunset", "prompt": "A sunset", "variants": ["webp"]}
+            job = jobs.submit_job("job_user", "Sunset", lambda: result)
+            assert job["status"] in (jobs.JOB_QUEUED, jobs.JOB_RUNNING)
+
+            job = _wait_for(job["job_id"], jobs.JOB_SUCCEEDED)
+        finally:
+            jobs.remove_completion_listener(finished.append)
+
+        assert job["image"] == {"image_id": "img-1", "title": "Sunset", "prompt": "A sunset", "variants": ["webp"]}
+        assert [j["job_id"] for j in finished] == [job["job_id"]]
+        assert jobs.list_user_jobs("job_user")[0]["job_id"] == job["job_id"]
+
+    def test_job_failure_is_recorded(self):
+        """Test that an exception or unsuccessful result marks the job failed."""
+
+        def boom():
+            raise RuntimeError("replicate down")
+
+        raised = jobs.submit_job("job_user", "Boom", boom)
+        unsuccessful = jobs.submit_job("job_user", "Nope", lambda: {"success": False, "message": "Failed to generate image."})
+
+        assert "replicate down" in _wait_for(raised["job_id"], jobs.JOB_FAILED)["error"]
+        assert _wait_for(unsuccessful["job_id"], jobs.JOB_FAILED)["error"] == "Failed to generate image."
+
+    def test_pending_jobs_are_bounded(self):
+        """Test that submissions beyond the pending limit are rejected while workers are busy."""
+        release = threading.Event()
+        with patch.object(jobs, "_max_pending", 2):
+            first = jobs.submit_job("job_user", "One", lambda: release.wait(5) and {"success": False, "message": "x"})
+            second = jobs.submit_job("job_user", "Two", lambda: release.wait(5) and {"success": False, "message": "x"})
+            with pytest.raises(jobs.JobQueueFull):
+                jobs.submit_job("job_user", "Three", lambda: {"success": False, "message": "x"})
+            release.set()
+            _wait_for(first["job_id"], jobs.JOB_FAILED)
+            _wait_for(second["job_id"], jobs.JOB_FAILED)
+
+    def test_finished_jobs_are_evicted_beyond_retention(self):
+        """Test that only the most recent jobs are kept."""
+        with patch.object(jobs, "_max_retained_jobs", 3):
+            submitted = [jobs.submit_job("evict_user", f"Image {i}", lambda: {"success": False, "message": "x"}) for i in range(5)]
+            _wait_for(submitted[-1]["job_id"], jobs.JOB_FAILED)
+            jobs.submit_job("evict_user", "Last", lambda: {"success": False, "message": "x"})
+
+        assert len(jobs._jobs) <= 3
+        assert jobs.get_job(submitted[0]["job_id"]) is None
+
+
+@patch.dict(
+    "os.environ",
+    {
+        "GENERATION_MODE": "background",
+        "IMAGE_INPUT_PREPROCESS": "false",
+        "IMAGE_VARIANTS": "",
+        "GENERATION_CACHE_ENABLED": "false",
+        "QUOTA_CACHE_ENABLED": "false",
+    },
+)
+class TestBackgroundGenerateImageTool:
+    """Test cases for the generate_image tool in background mode."""
+
+    TOOL_INPUTS = {"prompt": "A sunset", "user_id": "bg_user", "image_url": "https://example.com/in.png", "title": "Sunset"}
+    CONFIG = {"configurable": {"client_ip": "127.0.0.1"}}
+
+    @patch("llm.tools.store_tool_result")
+    @patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+    @patch("llm.tools.refund_ip_generation", return_value=True)
+    @patch("llm.tools.reserve_ip_generation", return_value=date(2026, 10, 12))
+    @patch("llm.tools.get_ip_generation_count", return_value=0)
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_tool_returns_job_id_and_job_completes(self, mock_run, mock_session, mock_count, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that the tool returns at once with a job id and the job finishes with the image."""
+        release = threading.Event()
+        mock_run.side_effect = lambda *args, **kwargs: release.wait(5) and "https://replicate.delivery/out.png"
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+        reply = _generate_image_callable(self.TOOL_INPUTS, self.CONFIG)
+
+        assert "started in the background" in reply
+        job = jobs.list_user_jobs("bg_user")[0]
+        assert job["job_id"] in reply
+        assert job["status"] in (jobs.JOB_QUEUED, jobs.JOB_RUNNING)
+
+        release.set()
+        job = _wait_for(job["job_id"], jobs.JOB_SUCCEEDED)
+        assert job["image"]["title"] == "Sunset"
+        # The image is reported through the job, not the agent's per-turn tool result
+        mock_store.assert_not_called()
+        # The up-front check only reads the count; the job reserves the generation when it runs
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+
+    @patch("llm.tools.get_ip_generation_count", return_value=10)
+    def test_limit_is_checked_before_queueing(self, mock_count):
+        """Test that an exhausted quota is reported without queueing a job."""
+        reply = _generate_image_callable({**self.TOOL_INPUTS, "user_id": "limited_user"}, self.CONFIG)
+
+        assert "max generation limit" in reply
+        assert jobs.list_user_jobs("limited_user") == []
+
+    @patch.dict("os.environ", {"QUOTA_CACHE_ENABLED": "true"})
+    @patch("llm.tools.get_quota_cache")
+    @patch("llm.tools.get_ip_generation_count", return_value=10)
+    def test_limit_held_elsewhere_asks_for_a_retry(self, mock_count, mock_cache):
+        """Test that a quota leased out to other processes is reported as a retry, not as the limit."""
+        mock_cache.return_value.has_quota.return_value = None
+        mock_cache.return_value.held_elsewhere.return_value = True
+
+        reply = _generate_image_callable({**self.TOOL_INPUTS, "user_id": "held_user"}, self.CONFIG)
+
+        assert reply == QUOTA_HELD_MESSAGE
+        assert jobs.list_user_jobs("held_user") == []
+
+    @patch.dict("os.environ", {"GENERATION_MODE": "queue"})
+    @patch("llm.tools.submit_job")
+    @patch("llm.tools.enqueue_generation")
+    @patch("llm.tools.get_ip_generation_count", return_value=0)
+    def test_queue_mode_enqueues_in_postgres(self, mock_count, mock_enqueue, mock_submit):
+        """Test that GENERATION_MODE=queue stores the job for llm.worker instead of running it here."""
+        row = {
+            "id": "6f1c1f1e-3a55-4c4e-9a55-0d1f3c4b5a6e",
+            "user_id": "bg_user",
+            "title": "Sunset",
+            "status": "queued",
+            "attempts": 0,
+            "result": None,
+            "last_error": None,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+        mock_enqueue.return_value = row
+
+        reply = _generate_image_callable(self.TOOL_INPUTS, self.CONFIG)
+
+        assert row["id"] in reply
+        mock_enqueue.assert_called_once_with("A sunset", "bg_user", "https://example.com/in.png", "Sunset", "127.0.0.1")
+        mock_submit.assert_not_called()
@@ -0,0 +1,254 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import ANY, patch
+
+import pytest
+from dotenv import load_dotenv
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm.connection_manager import get_db_connection
+            from llm.quota import QuotaCache, QuotaHeld
+            from llm.utils import current_week_start, get_ip_generation_count
+
+load_dotenv()
+
+IP = "203.0.113.7"
+
+
+@patch("llm.quota.return_ip_generations")
+@patch("llm.quota.lease_ip_generations", return_value=(5, 0))
+class TestQuotaCache:
+    """Test cases for handing out leased generations from memory."""
+
+    def test_generations_come_from_the_lease(self, mock_lease, mock_return):
+        """Test that one lease serves several reservations without the database."""
+        cache = QuotaCache(lease_size=5)
+
+        weeks = [cache.reserve(IP, 10) for _ in range(5)]
+
+        assert weeks == [current_week_start()] * 5
+        mock_lease.assert_called_once_with(IP, current_week_start(), 5, 10, 0, ANY)
+        assert cache.get_stats()["local"] == 4
+        # The lease is used up but the database hasn't refused more yet
+        assert cache.has_quota(IP) is None
+
+    def test_refusal_is_answered_from_memory(self, mock_lease, mock_return):
+        """Test that once the database grants nothing, further checks don't ask it again."""
+        mock_lease.return_value = (0, 0)
+        cache = QuotaCache(denial_seconds=60)
+
+        assert cache.reserve(IP, 10) is None
+        assert cache.reserve(IP, 10) is None
+        assert cache.has_quota(IP) is False
+        mock_lease.assert_called_once()
+        assert cache.get_stats()["denied_locally"] == 1
+
+    def test_refund_goes_back_into_the_lease(self, mock_lease, mock_return):
+        """Test that a refunded generation is handed out again without another lease."""
+        mock_lease.return_value = (1, 0)
+        cache = QuotaCache()
+        week = cache.reserve(IP, 10)
+        cache.refund(IP, week)
+
+        assert cache.has_quota(IP) is True
+        assert cache.reserve(IP, 10) == week
+        mock_lease.assert_called_once()
+
+    def test_flush_returns_idle_leases_in_one_batch(self, mock_lease, mock_return):
+        """Test that unused generations of idle leases go back in a single call."""
+        cache = QuotaCache(lease_size=5, idle_seconds=0)
+        cache.reserve(IP, 10)
+        cache.reserve("198.51.100.1", 10)
+
+        assert cache.flush() == 8
+        week = current_week_start()
+        mock_return.assert_called_once_with({(IP, week): 4, ("198.51.100.1", week): 4}, {(IP, week): 5, ("198.51.100.1", week): 5})
+        assert cache.get_stats()["ips"] == 0
+
+    def test_active_leases_are_kept_until_shutdown(self, mock_lease, mock_return):
+        """Test that a periodic flush leaves recently used leases alone and a final flush returns them."""
+        cache = QuotaCache(lease_size=5, idle_seconds=60)
+        cache.reserve(IP, 10)
+
+        assert cache.flush() == 0
+        mock_return.assert_not_called()
+        assert cache.flush(everything=True) == 4
+
+    def test_refund_after_the_lease_was_returned(self, mock_lease, mock_return):
+        """Test that a refund arriving after its lease was flushed is written back with the next flush."""
+        cache = QuotaCache(lease_size=5)
+        week = cache.reserve(IP, 10)
+        cache.flush(everything=True)
+        mock_return.reset_mock()
+
+        cache.refund(IP, week)
+
+        assert cache.get_stats()["pending_returns"] == 1
+        assert cache.flush() == 1
+        mock_return.assert_called_once_with({(IP, week): 1}, {})
+
+    def test_failed_flush_is_retried(self, mock_lease, mock_return):
+        """Test that generations that couldn't be returned are kept for the next flush."""
+        cache = QuotaCache(lease_size=5)
+        cache.reserve(IP, 10)
+        mock_return.side_effect = OSError("connection refused")
+
+        assert cache.flush(everything=True) == 0
+        assert cache.get_stats()["pending_returns"] == 4
+
+        mock_return.side_effect = None
+        assert cache.flush() == 4
+
+    def test_leases_of_past_weeks_are_returned(self, mock_lease, mock_return):
+        """Test that a lease from last week is returned even if it was used recently."""
+        cache = QuotaCache(lease_size=5, idle_seconds=60)
+        last_week = current_week_start() - timedelta(days=7)
+        with patch("llm.quota.current_week_start", return_value=last_week):
+            cache.reserve(IP, 10)
+
+        assert cache.flush() == 4
+        mock_return.assert_called_once_with({(IP, last_week): 4}, {(IP, last_week): 5})
+
+    def test_old_leases_are_returned(self, mock_lease, mock_return):
+        """Test that a lease older than the max age is returned even if it is in use."""
+        cache = QuotaCache(lease_size=5, idle_seconds=60, max_age=0)
+        cache.reserve(IP, 10)
+
+        assert cache.flush() == 4
+        assert cache.get_stats()["ips"] == 0
+
+    def test_used_up_lease_is_settled(self, mock_lease, mock_return):
+        """Test that a used-up lease stops counting as held by this process at the next flush."""
+        mock_lease.return_value = (2, 0)
+        cache = QuotaCache(lease_size=2, idle_seconds=60)
+        week = cache.reserve(IP, 10)
+        cache.reserve(IP, 10)
+
+        assert cache.flush() == 0
+        mock_return.assert_called_once_with({}, {(IP, week): 2})
+
+        # The next lease is asked for as if this process held nothing
+        cache.reserve(IP, 10)
+        assert mock_lease.call_args[0][4] == 0
+
+    def test_limit_held_elsewhere_is_not_remembered(self, mock_lease, mock_return):
+        """Test that a refusal while other processes hold leases asks the caller to retry and isn't cached."""
+        mock_lease.return_value = (0, 3)
+        cache = QuotaCache(denial_seconds=60)
+
+        with pytest.raises(QuotaHeld):
+            cache.reserve(IP, 10)
+        assert cache.has_quota(IP) is None
+
+        mock_lease.return_value = (1, 0)
+        assert cache.reserve(IP, 10) == current_week_start()
+        assert mock_lease.call_count == 2
+        assert cache.get_stats()["held_elsewhere"] == 1
+
+
+@pytest.fixture
+def quota_ip():
+    """A unique client IP whose rate_limits rows are removed after the test."""
+    client_ip = f"test-{uuid.uuid4().hex[:12]}"
+    yield client_ip
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM rate_limits WHERE ip_address = %s", (client_ip,))
+
+
+@pytest.mark.database
+class TestQuotaLeases:
+    """Test cases for leases taken from rate_limits by several processes."""
+
+    def _reserve(self, cache, client_ip):
+        try:
+            return cache.reserve(client_ip, 10)
+        except QuotaHeld:
+            return "held"
+
+    def test_processes_never_exceed_the_limit_together(self, quota_ip):
+        """Test that two caches, standing in for two processes, never grant more than the limit between them."""
+        caches = [QuotaCache(lease_size=3), QuotaCache(lease_size=3)]
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            results = list(executor.map(lambda n: self._reserve(caches[n % 2], quota_ip), range(50)))
+
+        granted = sum(result not in (None, "held") for result in results)
+        assert granted <= 10
+        for cache in caches:
+            cache.flush(everything=True)
+        assert get_ip_generation_count(quota_ip) == granted
+
+    def test_lease_takes_at_most_half_of_what_is_left(self, quota_ip):
+        """Test that one process can't lease all of an IP's last generations."""
+        first, second = QuotaCache(lease_size=10), QuotaCache(lease_size=10)
+        first.reserve(quota_ip, 10)
+        assert first.get_stats()["held"] == 4
+
+        second.reserve(quota_ip, 10)
+        assert second.get_stats()["held"] == 2
+        assert get_ip_generation_count(quota_ip) == 8
+
+    def test_limit_held_by_another_process_is_retried(self, quota_ip):
+        """Test that the limit reached while another process holds leases is a retry, not a refusal."""
+        first, second = QuotaCache(lease_size=10), QuotaCache(lease_size=10)
+        week = first.reserve(quota_ip, 1)
+        assert first.get_stats()["held"] == 0
+        first.refund(quota_ip, week)
+
+        with pytest.raises(QuotaHeld):
+            second.reserve(quota_ip, 1)
+        assert second.held_elsewhere(quota_ip)
+        assert not first.held_elsewhere(quota_ip)
+
+        # Once the first process returns its lease, the second gets the generation
+        assert first.flush(everything=True) == 1
+        assert second.reserve(quota_ip, 1) == week
+        assert not second.held_elsewhere(quota_ip)
+
+    def test_stale_leases_are_not_held(self, quota_ip):
+        """Test that leases of a process that died without flushing stop counting once the row is old."""
+        dead, alive = QuotaCache(lease_size=10), QuotaCache(lease_size=10, max_age=0)
+        dead.reserve(quota_ip, 1)
+        with get_db_connection() as conn:
+            conn.execute("UPDATE rate_limits SET last_updated = now() - interval '1 hour' WHERE ip_address = %s", (quota_ip,))
+
+        assert alive.reserve(quota_ip, 1) is None
+        assert not alive.held_elsewhere(quota_ip)
+
+    def test_unused_generations_are_returned_to_other_processes(self, quota_ip):
+        """Test that a flushed lease's unused generations can be leased by another process."""
+        first, second = QuotaCache(lease_size=10), QuotaCache(lease_size=10)
+        week = first.reserve(quota_ip, 2)
+        first.reserve(quota_ip, 2)
+        # The used-up lease still counts as held by the first process until a flush settles it
+        with pytest.raises(QuotaHeld):
+            second.reserve(quota_ip, 2)
+        assert first.flush() == 0
+        assert second.reserve(quota_ip, 2) is None
+
+        first.refund(quota_ip, week)
+        assert first.flush(everything=True) == 1
+
+        assert get_ip_generation_count(quota_ip) == 1
+        # A fresh process, as the second one remembers the refusal for QUOTA_DENIAL_SECONDS
+        second = QuotaCache(lease_size=10)
+        assert second.reserve(quota_ip, 2) == week
+
+    def test_batched_return_of_several_ips(self, quota_ip):
+        """Test that one flush returns the leases of several IPs."""
+        other_ip = f"{quota_ip}-b"
+        cache = QuotaCache(lease_size=4)
+        cache.reserve(quota_ip, 10)
+        cache.reserve(other_ip, 10)
+
+        try:
+            assert cache.flush(everything=True) == 6
+            assert get_ip_generation_count(quota_ip) == 1
+            assert get_ip_generation_count(other_ip) == 1
+        finally:
+            with get_db_connection() as conn:
+                conn.execute("DELETE FROM rate_limits WHERE ip_address = %s", (other_ip,))
@@ -0,0 +1,78 @@
+from unittest.mock import patch
+
+import pytest
+
+from server import rate_limit
+from server.rate_limit import TokenBucketLimiter, get_chat_rate_limit_stats, reset_chat_limiter
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucketLimiter:
+    """Test cases for the per-IP token buckets."""
+
+    def test_burst_then_steady_rate(self):
+        """Test that a key gets its burst at once and then one token per 60/per_minute seconds."""
+        clock = _Clock()
+        limiter = TokenBucketLimiter(per_minute=6, burst=3)
+        with patch.object(rate_limit.time, "monotonic", clock):
+            assert [limiter.acquire("ip") for _ in range(3)] == [0.0, 0.0, 0.0]
+            assert limiter.acquire("ip") == pytest.approx(10.0)
+
+            clock.now += 4
+            assert limiter.acquire("ip") == pytest.approx(6.0)
+            clock.now += 6
+            assert limiter.acquire("ip") == 0.0
+
+    def test_bucket_refills_up_to_the_burst(self):
+        """Test that an idle key doesn't save up more than its burst."""
+        clock = _Clock()
+        limiter = TokenBucketLimiter(per_minute=60, burst=2)
+        with patch.object(rate_limit.time, "monotonic", clock):
+            limiter.acquire("ip")
+            clock.now += 3600
+            assert [limiter.acquire("ip") for _ in range(3)] == [0.0, 0.0, 1.0]
+
+    def test_keys_are_independent(self):
+        """Test that one key running out leaves the others alone."""
+        limiter = TokenBucketLimiter(per_minute=1, burst=1)
+        limiter.acquire("noisy")
+
+        assert limiter.acquire("noisy") > 0
+        assert limiter.acquire("quiet") == 0.0
+
+    def test_least_recently_seen_keys_are_dropped(self):
+        """Test that at most max_keys buckets are kept."""
+        limiter = TokenBucketLimiter(per_minute=1, burst=1, max_keys=2)
+        for key in ("a", "b", "a", "c"):
+            limiter.acquire(key)
+
+        stats = limiter.get_stats()
+        assert (stats["tracked_ips"], stats["evicted"]) == (2, 1)
+        # "b" was dropped and starts over with a full bucket, "a" is still limited
+        assert limiter.acquire("b") == 0.0
+        assert limiter.acquire("c") > 0
+
+
+class TestChatLimiterSettings:
+    """Test cases for the process-wide chat limiter."""
+
+    def test_settings_come_from_the_environment(self):
+        """Test that the limiter is built from CHAT_RATE_LIMIT_* and can be turned off."""
+        try:
+            with patch.dict("os.environ", {"CHAT_RATE_LIMIT_PER_MINUTE": "30", "CHAT_RATE_LIMIT_BURST": "4"}):
+                reset_chat_limiter()
+                stats = get_chat_rate_limit_stats()
+            assert (stats["enabled"], stats["per_minute"], stats["burst"]) == (True, 30, 4)
+
+            with patch.dict("os.environ", {"CHAT_RATE_LIMIT_PER_MINUTE": "0"}):
+                reset_chat_limiter()
+                assert get_chat_rate_limit_stats() == {"enabled": False}
+        finally:
+            reset_chat_limiter()
@@ -0,0 +1,148 @@
+import json
+import uuid
+from datetime import date, timedelta
+from unittest.mock import patch
+
+import pytest
+from dotenv import load_dotenv
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm import rate_limit_partitions, schema
+            from llm.connection_manager import get_db_connection
+            from llm.rate_limit_partitions import (
+                create_partitions,
+                drop_expired_partitions,
+                maintain_partitions,
+                oldest_retained_week,
+                partition_name,
+                week_start_of,
+            )
+            from llm.utils import current_week_start
+
+load_dotenv()
+
+
+class TestWeeks:
+    """Test cases for the week arithmetic of the partitions."""
+
+    def test_week_start_of(self):
+        """Test that every day maps to the Monday of its week."""
+        assert week_start_of(date(2026, 10, 12)) == date(2026, 10, 12)
+        assert week_start_of(date(2026, 10, 18)) == date(2026, 10, 12)
+        assert week_start_of(date(2026, 10, 19)) == date(2026, 10, 19)
+
+    def test_partition_name_and_retention(self):
+        """Test the partition naming and the first retained week."""
+        assert partition_name(date(2026, 10, 12)) == "rate_limits_p20261012"
+        with patch.object(rate_limit_partitions, "_retention_weeks", 2):
+            assert oldest_retained_week(date(2026, 10, 14)) == date(2026, 9, 28)
+
+
+def _partitions(conn, parent="rate_limits"):
+    rows = conn.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+        (parent,),
+    ).fetchall()
+    return {row["relname"] for row in rows}
+
+
+@pytest.mark.database
+class TestRateLimitPartitions:
+    """Test cases for the partitioned rate_limits table."""
+
+    def test_table_is_partitioned_with_upcoming_weeks(self):
+        """Test that the migration left a partitioned table with this week's and the next partitions."""
+        with get_db_connection() as conn:
+            maintain_partitions(conn)
+            kind = conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('rate_limits')").fetchone()["relkind"]
+            partitions = _partitions(conn)
+
+        assert kind == "p"
+        this_week = current_week_start()
+        assert {partition_name(this_week + timedelta(weeks=n)) for n in range(rate_limit_partitions._weeks_ahead + 1)} <= partitions
+
+    def test_lookup_only_scans_the_current_partition(self):
+        """Test that the request path's query is pruned to this week's partition."""
+        with get_db_connection() as conn:
+            plan = conn.execute(
+                "EXPLAIN (FORMAT JSON) SELECT generation_count FROM rate_limits WHERE ip_address = %s AND week_start = %s",
+                ("203.0.113.7", current_week_start()),
+            ).fetchone()
+        scanned = set()
+
+        def collect(node):
+            if "Relation Name" in node:
+                scanned.add(node["Relation Name"])
+            for child in node.get("Plans", []):
+                collect(child)
+
+        plan = plan["QUERY PLAN"]
+        collect((json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"])
+        assert scanned == {partition_name(current_week_start())}
+
+    def test_expired_partitions_are_dropped(self):
+        """Test that partitions older than the retention are dropped with their counters."""
+        old_week = date(2001, 1, 1)
+        with get_db_connection() as conn:
+            create_partitions(conn, [old_week])
+            conn.execute("INSERT INTO rate_limits (ip_address, week_start, generation_count) VALUES ('203.0.113.7', %s, 3)", (old_week,))
+
+            assert drop_expired_partitions(conn, date(2001, 1, 8)) == [partition_name(old_week)]
+            assert partition_name(old_week) not in _partitions(conn)
+            assert conn.execute("SELECT count(*) AS n FROM rate_limits WHERE week_start = %s", (old_week,)).fetchone()["n"] == 0
+
+
+@pytest.fixture
+def scratch_schema():
+    """A connection whose search_path points at an empty schema, dropped after the test."""
+    name = f"test_{uuid.uuid4().hex[:8]}"
+    with get_db_connection() as conn:
+        conn.execute(f"CREATE SCHEMA {name}")
+        conn.execute(f"SET search_path TO {name}")
+        try:
+            yield conn
+        finally:
+            conn.execute("RESET search_path")
+            conn.execute(f"DROP SCHEMA {name} CASCADE")
+
+
+@pytest.mark.database
+class TestPartitionMigration:
+    """Test cases for moving an existing flat rate_limits table to partitions."""
+
+    def test_migration_keeps_retained_rows(self, scratch_schema):
+        """Test that retained counters are copied into weekly partitions and expired ones left behind."""
+        conn = scratch_schema
+        schema._create_rate_limits(conn)
+        this_week = current_week_start()
+        last_week = this_week - timedelta(weeks=1)
+        expired_week = oldest_retained_week() - timedelta(weeks=1)
+        for ip, week, count in [("a", this_week, 4), ("b", this_week, 10), ("a", last_week, 7), ("a", expired_week, 9)]:
+            conn.execute("INSERT INTO rate_limits (ip_address, week_start, generation_count) VALUES (%s, %s, %s)", (ip, week, count))
+
+        schema._partition_rate_limits(conn)
+        # Running it again is a no-op
+        schema._partition_rate_limits(conn)
+
+        assert conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('rate_limits')").fetchone()["relkind"] == "p"
+        rows = conn.execute("SELECT ip_address, week_start, generation_count FROM rate_limits ORDER BY week_start, ip_address").fetchall()
+        assert [(row["ip_address"], row["week_start"], row["generation_count"]) for row in rows] == [
+            ("a", last_week, 7),
+            ("a", this_week, 4),
+            ("b", this_week, 10),
+        ]
+        assert {partition_name(last_week), partition_name(this_week), partition_name(this_week + timedelta(weeks=1))} <= _partitions(conn)
+
+        # Upserts keep working against the partitioned table
+        conn.execute(
+            """
+            INSERT INTO rate_limits (ip_address, week_start, generation_count) VALUES ('a', %s, 1)
+            ON CONFLICT (ip_address, week_start) DO UPDATE SET generation_count = rate_limits.generation_count + 1
+        """,
+            (this_week,),
+        )
+        row = conn.execute("SELECT generation_count FROM rate_limits WHERE ip_address = 'a' AND week_start = %s", (this_week,)).fetchone()
+        assert row["generation_count"] == 5
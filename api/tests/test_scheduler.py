@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm.scheduler import GenerationBusy, GenerationScheduler
+
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the scheduler"
+        time.sleep(0.005)
+
+
+class TestGenerationScheduler:
+    """Test cases for the bounded, fair generation queue."""
+
+    def test_runs_at_most_max_concurrency(self):
+        """Test that callers beyond the limit wait until a slot is released."""
+        scheduler = GenerationScheduler(max_concurrency=2, max_waiting=4)
+        scheduler.acquire("a")
+        scheduler.acquire("b")
+        started = threading.Event()
+
+        def third():
+            scheduler.acquire("c")
+            started.set()
+
+        thread = threading.Thread(target=third)
+        thread.start()
+        _wait_until(lambda: scheduler.get_stats()["waiting"] == 1)
+        assert not started.is_set()
+
+        scheduler.release()
+        thread.join(timeout=5)
+        assert started.is_set()
+        stats = scheduler.get_stats()
+        assert (stats["running"], stats["waiting"], stats["started"], stats["queued"]) == (2, 0, 3, 1)
+
+    def test_full_queue_is_rejected_at_once(self):
+        """Test that a caller finding the queue full gets GenerationBusy without waiting."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=0, queue_timeout=60)
+        scheduler.acquire("a")
+
+        start = time.monotonic()
+        with pytest.raises(GenerationBusy):
+            scheduler.acquire("b")
+
+        assert time.monotonic() - start < 1
+        assert scheduler.get_stats()["rejected"] == 1
+
+    def test_wait_is_bounded_by_the_queue_timeout(self):
+        """Test that a waiter gives up after its deadline and leaves the queue."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=4)
+        scheduler.acquire("a")
+
+        with pytest.raises(GenerationBusy):
+            scheduler.acquire("b", timeout=0.05)
+
+        stats = scheduler.get_stats()
+        assert (stats["timed_out"], stats["waiting"], stats["waiting_users"]) == (1, 0, 0)
+        # The slot isn't handed to the waiter that left
+        scheduler.release()
+        assert scheduler.get_stats()["running"] == 0
+
+    def test_users_take_turns(self):
+        """Test that freed slots go round the waiting users rather than to one user's whole burst."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=10)
+        scheduler.acquire("holder")
+        order = []
+
+        async def wait(user_id):
+            await scheduler.aacquire(user_id)
+            order.append(user_id)
+            scheduler.release()
+
+        async def main():
+            tasks = []
+            for user_id in ["burst", "burst", "burst", "a", "b"]:
+                tasks.append(asyncio.ensure_future(wait(user_id)))
+                await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(main())
+
+        assert order == ["burst", "a", "b", "burst", "burst"]
+        assert scheduler.get_stats()["running"] == 0
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        """Test that an async caller cancelled while waiting doesn't take a slot later."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=4)
+        scheduler.acquire("a")
+
+        async def main():
+            task = asyncio.ensure_future(scheduler.aacquire("b"))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+        assert scheduler.get_stats()["waiting"] == 0
+        scheduler.release()
+        assert scheduler.get_stats()["running"] == 0
+
+    def test_sync_and_async_callers_share_the_slots(self):
+        """Test that a slot released by a thread is handed to an async waiter."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=4)
+        scheduler.acquire("a")
+        timer = threading.Timer(0.05, scheduler.release)
+
+        async def main():
+            timer.start()
+            async with scheduler.aslot("b"):
+                return scheduler.get_stats()["running"]
+
+        assert asyncio.run(main()) == 1
+        assert scheduler.get_stats()["running"] == 0
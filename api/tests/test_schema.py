@@ -0,0 +1,75 @@
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+
+from llm import schema
+
+
+def _mock_pool(current_version):
+    """Build a pool whose connection reports the given applied schema version."""
+    conn = Mock()
+    conn.execute.return_value.fetchone.return_value = {"version": current_version}
+    pool = Mock()
+    pool.connection.return_value = MagicMock(__enter__=Mock(return_value=conn))
+    return pool, conn
+
+
+def _recorded_versions(conn):
+    """Return the (version, name) pairs inserted into app_schema_migrations."""
+    return [call.args[1] for call in conn.execute.call_args_list if "INSERT INTO app_schema_migrations" in call.args[0]]
+
+
+class TestSchemaBootstrap:
+    """Test cases for the versioned schema bootstrap."""
+
+    def test_bootstrap_applies_all_migrations_on_empty_database(self):
+        """Test that a fresh database gets every migration, recorded in order."""
+        pool, conn = _mock_pool(None)
+        first, second = Mock(), Mock()
+
+        with patch.object(schema, "_bootstrapped", False), patch.object(schema, "MIGRATIONS", [("first", first), ("second", second)]):
+            assert schema.bootstrap_schema(pool) is True
+            assert schema.is_schema_bootstrapped() is True
+
+        first.assert_called_once_with(conn)
+        second.assert_called_once_with(conn)
+        assert _recorded_versions(conn) == [(1, "first"), (2, "second")]
+
+    def test_bootstrap_only_applies_pending_migrations(self):
+        """Test that migrations already recorded in the version table are skipped."""
+        pool, conn = _mock_pool(1)
+        first, second = Mock(), Mock()
+
+        with patch.object(schema, "_bootstrapped", False), patch.object(schema, "MIGRATIONS", [("first", first), ("second", second)]):
+            schema.bootstrap_schema(pool)
+
+        first.assert_not_called()
+        second.assert_called_once_with(conn)
+        assert _recorded_versions(conn) == [(2, "second")]
+
+    def test_bootstrap_runs_once_per_process(self):
+        """Test that later calls (e.g. reconnects) skip the bootstrap without touching the database."""
+        pool, conn = _mock_pool(2)
+
+        with patch.object(schema, "_bootstrapped", False), patch.object(schema, "MIGRATIONS", [("first", Mock()), ("second", Mock())]):
+            assert schema.bootstrap_schema(pool) is True
+            assert schema.bootstrap_schema(pool) is False
+
+        pool.connection.assert_called_once()
+
+    def test_bootstrap_releases_advisory_lock_on_failure(self):
+        """Test that a failing migration still releases the advisory lock and is not recorded."""
+        pool, conn = _mock_pool(0)
+        broken = Mock(side_effect=Exception("migration failed"))
+
+        with patch.object(schema, "_bootstrapped", False), patch.object(schema, "MIGRATIONS", [("broken", broken)]):
+            with pytest.raises(Exception, match="migration failed"):
+                schema.bootstrap_schema(pool)
+            assert schema.is_schema_bootstrapped() is False
+
+        assert _recorded_versions(conn) == []
+        assert "pg_advisory_unlock" in conn.execute.call_args_list[-1].args[0]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from llm.singleflight import SingleFlight
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for followers"
+        time.sleep(0.005)
+
+
+class TestSingleFlight:
+    """Test cases for coalescing concurrent calls by key."""
+
+    def test_concurrent_calls_share_one_execution(self):
+        """Test that callers joining while the leader runs get its result without running fn."""
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return {"image_id": "img-1"}
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [executor.submit(flight.do, "key", work) for _ in range(5)]
+            _wait_for(lambda: flight.get_stats()["coalesced"] == 4)
+            release.set()
+            results = [future.result() for future in futures]
+
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert flight.get_stats() == {"leaders": 1, "coalesced": 4, "in_flight": 0}
+
+    def test_key_is_released_after_the_leader_finishes(self):
+        """Test that only overlapping calls are coalesced; a later call runs again."""
+        flight = SingleFlight()
+
+        assert flight.do("key", lambda: 1) == 1
+        assert flight.do("key", lambda: 2) == 2
+        assert flight.do("other", lambda: 3) == 3
+        assert flight.get_stats()["leaders"] == 3
+
+    def test_leader_error_is_raised_to_followers(self):
+        """Test that every waiting caller sees the leader's exception."""
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError("replicate is down")
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(flight.do, "key", fail) for _ in range(3)]
+            _wait_for(lambda: flight.get_stats()["coalesced"] == 2)
+            release.set()
+            for future in futures:
+                with pytest.raises(ValueError, match="replicate is down"):
+                    future.result()
+
+    def test_async_callers_share_one_execution(self):
+        """Test coalescing of coroutines on one event loop."""
+        flight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def main():
+            return await asyncio.gather(*(flight.ado("key", work) for _ in range(5)))
+
+        assert asyncio.run(main()) == ["done"] * 5
+        assert len(calls) == 1
+
+    def test_cancelled_follower_leaves_the_leader_running(self):
+        """Test that a follower giving up doesn't cancel the shared work."""
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def main():
+            leader = asyncio.ensure_future(flight.ado("key", work))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.ado("key", work))
+            await asyncio.sleep(0.01)
+            follower.cancel()
+            return await leader, follower.cancelled()
+
+        assert asyncio.run(main()) == ("done", True)
+
+    def test_cancelled_leader_hands_over_to_a_follower(self):
+        """Test that followers of a cancelled leader run the work themselves rather than fail."""
+        flight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def main():
+            leader = asyncio.ensure_future(flight.ado("key", work))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(flight.ado("key", work)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await asyncio.gather(*followers)
+
+        assert asyncio.run(main()) == ["done", "done"]
+        assert len(calls) == 2
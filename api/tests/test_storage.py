@@ -0,0 +1,256 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import boto3
+import pytest
+
+from llm import storage
+
+
+@pytest.fixture(autouse=True)
+def fresh_s3_client():
+    """Start and end each test without a cached client."""
+    storage.reset_s3_client()
+    yield
+    storage.reset_s3_client()
+
+
+class TestS3Client:
+    """Test cases for the shared S3 client."""
+
+    @patch("llm.storage.boto3.client")
+    def test_client_is_created_once_across_threads(self, mock_boto3_client):
+        """Test that concurrent callers share a single client."""
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: storage.get_s3_client(), range(32)))
+
+        assert all(client is clients[0] for client in clients)
+        mock_boto3_client.assert_called_once()
+
+    @patch.dict("os.environ", {"S3_MAX_POOL_CONNECTIONS": "32", "S3_RETRY_MODE": "adaptive"})
+    @patch("llm.storage.boto3.client")
+    def test_client_config(self, mock_boto3_client):
+        """Test that the client gets a sized pool, keep-alive and the retry mode."""
+        storage.get_s3_client()
+
+        config = mock_boto3_client.call_args[1]["config"]
+        assert config.max_pool_connections == 32
+        assert config.tcp_keepalive is True
+        assert config.retries["mode"] == "adaptive"
+
+    @patch("llm.storage.boto3.client")
+    def test_reset_builds_a_new_client(self, mock_boto3_client):
+        """Test that reset_s3_client drops the cached client."""
+        storage.get_s3_client()
+        storage.reset_s3_client()
+        storage.get_s3_client()
+
+        assert mock_boto3_client.call_count == 2
+
+
+@patch("llm.storage.boto3.client")
+class TestPresignCache:
+    """Test cases for the presigned URL cache."""
+
+    @staticmethod
+    def _sign_counter(mock_boto3_client):
+        """Make the mocked client return a new URL on every signature."""
+        signatures = iter(range(1_000_000))
+        mock_boto3_client.return_value.generate_presigned_url.side_effect = lambda *args, **kwargs: f"https://signed/{next(signatures)}"
+        return mock_boto3_client.return_value.generate_presigned_url
+
+    def test_fresh_url_is_reused(self, mock_boto3_client):
+        """Test that a second presign of the same key is a cache hit."""
+        sign = self._sign_counter(mock_boto3_client)
+        before = storage.get_presign_cache_stats()
+
+        first = storage.presign_get_url("bucket", "users/u/images/1")
+        second = storage.presign_get_url("bucket", "users/u/images/1")
+        other = storage.presign_get_url("bucket", "users/u/images/2")
+
+        stats = storage.get_presign_cache_stats()
+        assert first == second != other
+        assert sign.call_count == 2
+        sign.assert_any_call("get_object", Params={"Bucket": "bucket", "Key": "users/u/images/1"}, ExpiresIn=7200)
+        assert stats["hits"] - before["hits"] == 1
+        assert stats["misses"] - before["misses"] == 2
+
+    def test_url_near_expiry_is_resigned(self, mock_boto3_client):
+        """Test that a URL with less than the minimum lifetime left is signed again."""
+        sign = self._sign_counter(mock_boto3_client)
+
+        with patch.object(storage, "_presign_min_remaining", 1800), patch("llm.storage.time.time", return_value=1_000_000.0):
+            first = storage.presign_get_url("bucket", "key")
+        # 5000s later 2200s remain, which is still enough
+        with patch("llm.storage.time.time", return_value=1_005_000.0):
+            assert storage.presign_get_url("bucket", "key") == first
+        # 5500s later only 1700s remain
+        with patch("llm.storage.time.time", return_value=1_005_500.0):
+            assert storage.presign_get_url("bucket", "key") != first
+
+        assert sign.call_count == 2
+
+    def test_cache_is_bounded_lru(self, mock_boto3_client):
+        """Test that the least recently used key is evicted once the cache is full."""
+        sign = self._sign_counter(mock_boto3_client)
+
+        with patch.object(storage, "_presign_cache_size", 2):
+            a = storage.presign_get_url("bucket", "a")
+            storage.presign_get_url("bucket", "b")
+            storage.presign_get_url("bucket", "a")  # a is now the most recently used
+            storage.presign_get_url("bucket", "c")  # evicts b
+
+            assert storage.get_presign_cache_stats()["size"] == 2
+            assert storage.presign_get_url("bucket", "a") == a
+            storage.presign_get_url("bucket", "b")
+
+        assert sign.call_count == 4
+
+    def test_batch_uses_cache_and_dedupes(self, mock_boto3_client):
+        """Test that a batch reuses cached keys and signs each missing key once."""
+        sign = self._sign_counter(mock_boto3_client)
+        keys = ["users/u/images/1", "users/u/images/2", "users/u/images/3"]
+        first = storage.presign_get_url("bucket", keys[0])
+        before = storage.get_presign_cache_stats()
+
+        urls = storage.presign_get_urls("bucket", keys + keys[1:2])
+
+        stats = storage.get_presign_cache_stats()
+        assert urls[keys[0]] == first
+        assert set(urls) == set(keys)
+        assert sign.call_count == 3
+        assert stats["hits"] - before["hits"] == 1
+        assert stats["misses"] - before["misses"] == 2
+        assert storage.presign_get_urls("bucket", keys) == urls
+        assert sign.call_count == 3
+
+
+FAKE_CREDENTIALS = {"AWS_ACCESS_KEY_ID": "AKIDEXAMPLE", "AWS_SECRET_ACCESS_KEY": "secret", "AWS_REGION": "us-east-1"}
+
+
+@patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+class TestUserObjectKey:
+    """Test cases for recognizing URLs of a user's objects in our bucket."""
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "https://test-bucket.s3.amazonaws.com/users/u1/images/a?X-Amz-Signature=abc",
+            "https://test-bucket.s3.eu-west-1.amazonaws.com/users/u1/images/a",
+            "https://s3.eu-west-1.amazonaws.com/test-bucket/users/u1/images/a",
+        ],
+        ids=["virtual-hosted", "regional", "path-style"],
+    )
+    def test_users_objects_are_accepted(self, url):
+        assert storage.user_object_key(url, "u1") == "users/u1/images/a"
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "http://test-bucket.s3.amazonaws.com/users/u1/images/a",
+            "https://test-bucket.s3.amazonaws.com:8443/users/u1/images/a",
+            "https://user@test-bucket.s3.amazonaws.com/users/u1/images/a",
+            "https://other-bucket.s3.amazonaws.com/users/u1/images/a",
+            "https://test-bucket.s3.amazonaws.com.evil.example/users/u1/images/a",
+            "https://test-bucket.s3.amazonaws.com/users/u2/images/a",
+            "https://test-bucket.s3.amazonaws.com/users/u1/../u2/images/a",
+            "http://169.254.169.254/latest/meta-data/",
+            "https://localhost/users/u1/images/a",
+            "data:image/png;base64,AAAA",
+        ],
+    )
+    def test_other_urls_are_refused(self, url):
+        assert storage.user_object_key(url, "u1") is None
+
+
+class TestTeeReader:
+    """Test cases for copying a stream while it is uploaded."""
+
+    def test_copies_what_is_read(self):
+        """Test that the copy matches the stream read in parts."""
+        tee = storage.TeeReader(io.BytesIO(b"0123456789"), limit=16)
+
+        assert tee.read(4) + tee.read() == b"0123456789"
+        assert tee.captured() == b"0123456789"
+
+    def test_stops_copying_past_the_limit(self):
+        """Test that a stream larger than the limit is passed through without being kept."""
+        tee = storage.TeeReader(io.BytesIO(b"0123456789"), limit=8)
+
+        assert tee.read(6) + tee.read(6) == b"0123456789"
+        assert tee.captured() is None
+
+    def test_large_copies_spill_to_a_file(self):
+        """Test that a copy past spool_bytes is kept in a temporary file, which discard() deletes."""
+        tee = storage.TeeReader(io.BytesIO(b"0123456789"), limit=16, spool_bytes=4)
+
+        assert tee.read(3) + tee.read(3) + tee.read() == b"0123456789"
+        path = tee.captured()
+        with open(path, "rb") as copy:
+            assert copy.read() == b"0123456789"
+
+        tee.discard()
+        assert not os.path.exists(path)
+        assert tee.captured() is None
+
+
+@pytest.mark.benchmark
+@patch.dict(os.environ, FAKE_CREDENTIALS)
+class TestBatchPresignBenchmark:
+    """Throughput of presigning a cold batch against serving it from the cache."""
+
+    COUNT = 5000
+
+    def test_batch_presign_throughput(self):
+        """Test that a cached batch of thousands of keys is much faster than signing it."""
+        keys = [f"users/bench/images/{i}" for i in range(self.COUNT)]
+        storage.get_s3_client()
+
+        start = time.perf_counter()
+        urls = storage.presign_get_urls("bucket", keys)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        storage.presign_get_urls("bucket", keys)
+        cached = time.perf_counter() - start
+
+        print(f"\n[BENCH] {self.COUNT} keys: signed {self.COUNT / cold:,.0f}/s, cached {self.COUNT / cached:,.0f}/s")
+        assert len(urls) == self.COUNT
+        assert cached * 5 < cold
+
+
+@pytest.mark.benchmark
+class TestS3ClientBenchmark:
+    """Benchmark of per-call client creation against the shared client, on moto's in-memory S3."""
+
+    UPLOADS = 50
+
+    @staticmethod
+    def _upload_and_presign(s3_client, i):
+        key = f"users/bench/images/{i}"
+        s3_client.put_object(Bucket="bench-bucket", Key=key, Body=b"x" * 1024, ContentType="image/png")
+        return s3_client.generate_presigned_url("get_object", Params={"Bucket": "bench-bucket", "Key": key}, ExpiresIn=7200)
+
+    def test_shared_client_is_faster_than_per_call_clients(self):
+        """Test that reusing the client beats building one per upload."""
+        moto = pytest.importorskip("moto")
+
+        env = {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_REGION": "us-east-1"}
+        with patch.dict(os.environ, env), moto.mock_aws():
+            boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="bench-bucket")
+
+            start = time.perf_counter()
+            for i in range(self.UPLOADS):
+                self._upload_and_presign(boto3.client("s3", region_name="us-east-1"), i)
+            per_call = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(self.UPLOADS):
+                self._upload_and_presign(storage.get_s3_client(), i)
+            shared = time.perf_counter() - start
+
+        print(f"\n[BENCH] {self.UPLOADS} uploads+presigns: per-call clients {per_call:.3f}s, shared client {shared:.3f}s ({per_call / shared:.1f}x)")
+        assert shared < per_call
@@ -0,0 +1,705 @@
+import asyncio
+import io
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+
+import httpx
+import pytest
+from PIL import Image
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm.connection_manager import get_db_connection
+            from llm.images import fetch_image
+            from llm.quota import QuotaCache, QuotaHeld
+            from llm.scheduler import GenerationScheduler
+            from llm.storage import get_s3_client, reset_s3_client
+            from llm.tools import (
+                BUSY_MESSAGE,
+                QUOTA_HELD_MESSAGE,
+                _aedit_image_callable,
+                _agenerate_image_core,
+                _astream_to_storage,
+                _edit_image_core,
+                _generate_image_core,
+                _run_generation,
+                get_generation_flight_stats,
+            )
+            from llm.utils import get_ip_generation_count
+
+
+def _stub_async_client():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=b"png-bytes"))
+    return httpx.AsyncClient(transport=transport)
+
+
+GENERATION_ARGS = {
+    "prompt": "A sunset",
+    "user_id": "test_user",
+    "image_url": "https://example.com/in.png",
+    "title": "Sunset",
+    "client_ip": "127.0.0.1",
+}
+
+# The week reserve_ip_generation counted a mocked generation in
+WEEK = date(2026, 10, 12)
+
+
+@patch.dict(
+    "os.environ", {"IMAGE_INPUT_PREPROCESS": "false", "IMAGE_VARIANTS": "", "GENERATION_CACHE_ENABLED": "false", "QUOTA_CACHE_ENABLED": "false"}
+)
+@patch("llm.tools.store_tool_result")
+@patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+@patch("llm.tools.refund_ip_generation", return_value=True)
+class TestGenerateImageCore:
+    """Test cases for the generate_image tool core."""
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_generate_image_success(self, mock_run, mock_session, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test the sync path streams the output into the upload and counts the generation."""
+        mock_get = mock_session.return_value.get
+        mock_get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+        result = _generate_image_core(**GENERATION_ARGS)
+
+        assert "Image generated successfully" in result
+        mock_get.assert_called_once_with("https://replicate.delivery/out.png", stream=True)
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+        assert mock_upload.call_args[1]["image_data"].read() == b"png-bytes"
+        mock_store.assert_called_once()
+
+    @patch.dict("os.environ", {"IMAGE_VARIANTS": "webp,thumb"})
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.upload_image_variants", return_value=["webp", "thumb"])
+    @patch("llm.tools.create_image_variants", return_value={"webp": (b"w", "image/webp"), "thumb": (b"t", "image/webp")})
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_generate_image_stores_variants(
+        self, mock_run, mock_session, mock_render, mock_upload_variants, mock_reserve, mock_refund, mock_upload, mock_store
+    ):
+        """Test that variants are rendered from the streamed copy of the image and recorded in the tool result."""
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+        mock_upload.side_effect = lambda image_data, **kwargs: image_data.read() and {"success": True}
+
+        _generate_image_core(**GENERATION_ARGS)
+
+        mock_render.assert_called_once_with(b"png-bytes", ["webp", "thumb"])
+        assert mock_upload_variants.call_args[0][2] == mock_render.return_value
+        assert mock_store.call_args[0][2]["variants"] == ["webp", "thumb"]
+
+    @patch.dict("os.environ", {"IMAGE_VARIANTS": "webp,thumb"})
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.create_image_variants", side_effect=OSError("cannot identify image file"))
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_variant_failure_keeps_the_generation(self, mock_run, mock_session, mock_render, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that a failed variant render still saves and counts the original image."""
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+        mock_upload.side_effect = lambda image_data, **kwargs: image_data.read() and {"success": True}
+
+        result = _generate_image_core(**GENERATION_ARGS)
+
+        assert "Image generated successfully" in result
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+        assert mock_store.call_args[0][2]["variants"] == []
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.prepare_input_image_url", return_value="data:image/jpeg;base64,cHJlcGFyZWQ=")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_generate_image_sends_prepared_input(self, mock_run, mock_prepare, mock_session, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that Replicate receives the prepared copy of the source image rather than its URL."""
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+        _generate_image_core(**GENERATION_ARGS)
+
+        mock_prepare.assert_called_once_with("https://example.com/in.png", "test_user")
+        assert mock_run.call_args[1]["input"]["input_image"] == "data:image/jpeg;base64,cHJlcGFyZWQ="
+
+    @patch("llm.tools.reserve_ip_generation", return_value=None)
+    @patch("llm.tools.replicate.run")
+    def test_generate_image_limit_reached(self, mock_run, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that the weekly limit stops the generation before Replicate is called."""
+        result = _generate_image_core(**GENERATION_ARGS)
+
+        assert "max generation limit of 10" in result
+        mock_run.assert_not_called()
+        mock_upload.assert_not_called()
+        mock_refund.assert_not_called()
+
+    @patch.dict("os.environ", {"QUOTA_CACHE_ENABLED": "true"})
+    @patch("llm.tools.get_quota_cache")
+    @patch("llm.tools.replicate.run")
+    def test_limit_held_by_other_processes_answers_busy(self, mock_run, mock_cache, mock_refund, mock_upload, mock_store):
+        """Test that a limit reached while other processes hold leases asks for a retry instead of reporting the limit."""
+        mock_cache.return_value.reserve.side_effect = QuotaHeld("3 of IP 127.0.0.1's generations are leased by other processes")
+
+        result = _run_generation(**GENERATION_ARGS)
+
+        assert result == {"success": False, "message": QUOTA_HELD_MESSAGE, "busy": True}
+        mock_run.assert_not_called()
+        mock_cache.return_value.refund.assert_not_called()
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.replicate.run", side_effect=RuntimeError("prediction failed"))
+    def test_generation_error_refunds_the_reservation(self, mock_run, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that a generation raising part way gives its reserved generation back."""
+        with pytest.raises(RuntimeError):
+            _generate_image_core(**GENERATION_ARGS)
+
+        mock_refund.assert_called_once_with("127.0.0.1", WEEK)
+
+    @patch("llm.tools.reserve_ip_generation", side_effect=OSError("connection refused"))
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_unreachable_counter_does_not_block_generation(self, mock_run, mock_session, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that a generation goes ahead uncounted when the reservation can't be made."""
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+        assert "Image generated successfully" in _generate_image_core(**GENERATION_ARGS)
+        mock_refund.assert_not_called()
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.adispatch_custom_event", new_callable=AsyncMock)
+    @patch("llm.tools.get_async_http_client", side_effect=_stub_async_client)
+    @patch("llm.tools.replicate.async_run", new_callable=AsyncMock, return_value="https://replicate.delivery/out.png")
+    def test_agenerate_image_reports_progress(self, mock_run, mock_client, mock_dispatch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test the async path reports each stage as a generation_progress event."""
+        config = {"configurable": {"client_ip": "127.0.0.1"}}
+        uploaded = []
+        mock_upload.side_effect = lambda image_data, **kwargs: uploaded.append(image_data.read()) or {"success": True}
+        # The upload is still reading when a stage is reported if nothing has been uploaded yet
+        uploads_at_report = []
+        mock_dispatch.side_effect = lambda *args, **kwargs: uploads_at_report.append(len(uploaded))
+
+        result = asyncio.run(_agenerate_image_core(**GENERATION_ARGS, config=config))
+
+        assert "Image generated successfully" in result
+        stages = [call.args[1]["stage"] for call in mock_dispatch.call_args_list]
+        assert stages == ["generating", "downloading", "uploading"]
+        assert uploads_at_report == [0, 0, 0]
+        assert mock_dispatch.call_args.args[1] == {"stage": "uploading", "size_bytes": len(b"png-bytes")}
+        assert all(call.args[0] == "generation_progress" for call in mock_dispatch.call_args_list)
+        assert uploaded == [b"png-bytes"]
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.get_async_http_client")
+    @patch("llm.tools.replicate.async_run", new_callable=AsyncMock, return_value="https://replicate.delivery/out.png")
+    def test_agenerate_image_download_failure(self, mock_run, mock_client, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that a download failing mid-stream aborts the upload and is not counted."""
+
+        def failing_client():
+            transport = httpx.MockTransport(lambda request: httpx.Response(502))
+            return httpx.AsyncClient(transport=transport)
+
+        mock_client.side_effect = failing_client
+        mock_upload.side_effect = lambda image_data, **kwargs: image_data.read() and {"success": True}
+
+        result = asyncio.run(_agenerate_image_core(**GENERATION_ARGS))
+
+        assert result.startswith("Failed to process generated image")
+        mock_refund.assert_called_once_with("127.0.0.1", WEEK)
+        mock_store.assert_not_called()
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.adispatch_custom_event", new_callable=AsyncMock)
+    @patch("llm.tools.replicate.async_run", new_callable=AsyncMock, return_value=None)
+    def test_agenerate_image_without_output(self, mock_run, mock_dispatch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that an empty Replicate output fails without counting the generation."""
+        result = asyncio.run(_agenerate_image_core(**GENERATION_ARGS))
+
+        assert result == "Failed to generate image. Please try again."
+        mock_dispatch.assert_not_called()
+        mock_refund.assert_called_once_with("127.0.0.1", WEEK)
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.replicate.run")
+    def test_full_generation_queue_answers_busy(self, mock_run, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that a generation finding every slot and queue place taken returns at once and gives its reservation back."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=0)
+        scheduler.acquire("other_user")
+
+        with patch("llm.tools.get_generation_scheduler", return_value=scheduler):
+            result = _run_generation(**GENERATION_ARGS)
+
+        assert result == {"success": False, "message": BUSY_MESSAGE, "busy": True}
+        mock_run.assert_not_called()
+        mock_refund.assert_called_once_with("127.0.0.1", WEEK)
+
+    @patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+    @patch("llm.tools.adispatch_custom_event", new_callable=AsyncMock)
+    @patch("llm.tools.replicate.async_run", new_callable=AsyncMock)
+    def test_agenerate_image_gives_up_after_the_queue_timeout(self, mock_run, mock_dispatch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that the async path waits in the queue no longer than its deadline."""
+        scheduler = GenerationScheduler(max_concurrency=1, max_waiting=4, queue_timeout=0.05)
+        scheduler.acquire("other_user")
+
+        with patch("llm.tools.get_generation_scheduler", return_value=scheduler):
+            result = asyncio.run(_agenerate_image_core(**GENERATION_ARGS))
+
+        assert result == BUSY_MESSAGE
+        mock_run.assert_not_called()
+        mock_refund.assert_called_once_with("127.0.0.1", WEEK)
+        assert (scheduler.get_stats()["timed_out"], scheduler.get_stats()["waiting"]) == (1, 0)
+
+
+def _wait_for_followers(count, timeout=5.0):
+    """Block until count callers have joined a generation in flight."""
+    deadline = time.monotonic() + timeout
+    while get_generation_flight_stats()["coalesced"] < count:
+        assert time.monotonic() < deadline, "timed out waiting for coalesced calls"
+        time.sleep(0.005)
+
+
+@patch.dict(
+    "os.environ", {"IMAGE_INPUT_PREPROCESS": "false", "IMAGE_VARIANTS": "", "GENERATION_CACHE_ENABLED": "false", "QUOTA_CACHE_ENABLED": "false"}
+)
+@patch("llm.tools.store_tool_result")
+@patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+@patch("llm.tools.refund_ip_generation", return_value=True)
+@patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+class TestGenerationCoalescing:
+    """Concurrent identical generations for a user make a single Replicate call."""
+
+    CALLERS = 5
+
+    @patch("llm.tools.get_http_session")
+    def test_concurrent_sync_calls_make_one_replicate_call(self, mock_session, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that double-clicks and retries in worker threads share one generation and one quota unit."""
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+        baseline = get_generation_flight_stats()["coalesced"]
+        release = threading.Event()
+
+        def run(model, input):
+            release.wait(5)
+            return "https://replicate.delivery/out.png"
+
+        with patch("llm.tools.replicate.run", side_effect=run) as mock_run, ThreadPoolExecutor(max_workers=self.CALLERS) as executor:
+            futures = [executor.submit(_generate_image_core, **GENERATION_ARGS) for _ in range(self.CALLERS)]
+            _wait_for_followers(baseline + self.CALLERS - 1)
+            release.set()
+            results = [future.result() for future in futures]
+
+        assert mock_run.call_count == 1
+        mock_upload.assert_called_once()
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+        assert len(set(results)) == 1 and "Image generated successfully" in results[0]
+        # Every caller's turn gets the image
+        assert mock_store.call_count == self.CALLERS
+        assert len({call[0][2]["image_id"] for call in mock_store.call_args_list}) == 1
+
+    @patch("llm.tools.get_async_http_client", side_effect=_stub_async_client)
+    def test_concurrent_async_calls_make_one_replicate_call(self, mock_client, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that concurrent tool calls on the event loop share one generation."""
+
+        async def async_run(model, input):
+            await asyncio.sleep(0.05)
+            return "https://replicate.delivery/out.png"
+
+        async def main():
+            return await asyncio.gather(*(_agenerate_image_core(**GENERATION_ARGS) for _ in range(self.CALLERS)))
+
+        with patch("llm.tools.replicate.async_run", side_effect=async_run) as mock_run:
+            results = asyncio.run(main())
+
+        assert mock_run.await_count == 1
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+        assert len(set(results)) == 1 and "Image generated successfully" in results[0]
+
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_different_prompts_are_not_coalesced(self, mock_run, mock_session, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that only identical requests share a generation."""
+        mock_session.return_value.get.side_effect = lambda *args, **kwargs: MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda prompt: _generate_image_core(**{**GENERATION_ARGS, "prompt": prompt}), ["A sunset", "A sunrise"]))
+
+        assert mock_run.call_count == 2
+
+
+CACHED_ROW = {"user_id": "owner", "image_id": "img-1", "content_type": "image/png", "variants": ["webp"]}
+
+
+@patch.dict(
+    "os.environ", {"IMAGE_INPUT_PREPROCESS": "false", "IMAGE_VARIANTS": "", "GENERATION_CACHE_ENABLED": "true", "QUOTA_CACHE_ENABLED": "false"}
+)
+@patch("llm.tools.store_tool_result")
+@patch("llm.tools.refund_ip_generation", return_value=True)
+@patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+@patch("llm.tools.store_generation")
+class TestGenerationCache:
+    """Test cases for serving repeated generations from the generation cache."""
+
+    @patch("llm.tools.lookup_generation", return_value=CACHED_ROW)
+    @patch("llm.tools.copy_generated_image", return_value={"success": True, "image_id": "new", "variants": ["webp"]})
+    @patch("llm.tools.replicate.run")
+    def test_hit_copies_without_generating(self, mock_run, mock_copy, mock_lookup, mock_store_cache, mock_reserve, mock_refund, mock_store):
+        """Test that a hit copies the cached image into the user's gallery without Replicate or the quota."""
+        result = _generate_image_core(**GENERATION_ARGS)
+
+        assert "Image generated successfully" in result
+        mock_run.assert_not_called()
+        # The copy doesn't use a generation, so none is reserved or refunded
+        mock_reserve.assert_not_called()
+        mock_refund.assert_not_called()
+        mock_store_cache.assert_not_called()
+        source_user, source_image, user_id, image_id = mock_copy.call_args[0][:4]
+        assert (source_user, source_image, user_id) == ("owner", "img-1", "test_user")
+        assert mock_store.call_args[0][2]["image_id"] == image_id
+        assert mock_store.call_args[0][2]["variants"] == ["webp"]
+
+    @patch("llm.tools.lookup_generation", return_value=CACHED_ROW)
+    @patch("llm.tools.copy_generated_image", return_value={"success": True, "image_id": "new", "variants": ["webp"]})
+    @patch("llm.tools.replicate.async_run", new_callable=AsyncMock)
+    def test_hit_is_served_at_the_limit(self, mock_run, mock_copy, mock_lookup, mock_store_cache, mock_reserve, mock_refund, mock_store):
+        """Test that an IP that used up its weekly generations still gets cached results, on both paths."""
+        mock_reserve.return_value = None
+
+        assert "Image generated successfully" in _generate_image_core(**GENERATION_ARGS)
+        assert "Image generated successfully" in asyncio.run(_agenerate_image_core(**GENERATION_ARGS))
+
+        mock_reserve.assert_not_called()
+        mock_run.assert_not_called()
+        assert mock_copy.call_count == 2
+
+    @patch("llm.tools.lookup_generation", return_value=None)
+    @patch("llm.tools.get_http_session")
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    @patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+    def test_miss_generates_and_stores(
+        self, mock_upload, mock_run, mock_session, mock_lookup, mock_store_cache, mock_reserve, mock_refund, mock_store
+    ):
+        """Test that a miss generates as usual and records the saved image under the same key."""
+        mock_session.return_value.get.return_value = MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+        result = _generate_image_core(**GENERATION_ARGS)
+
+        assert "Image generated successfully" in result
+        mock_run.assert_called_once()
+        mock_reserve.assert_called_once_with("127.0.0.1", 10)
+        mock_refund.assert_not_called()
+        cache_key, model, user_id, image_id, variants = mock_store_cache.call_args[0]
+        assert cache_key == mock_lookup.call_args[0][0]
+        assert (model, user_id, image_id, variants) == ("black-forest-labs/flux-kontext-pro", "test_user", mock_store.call_args[0][2]["image_id"], [])
+
+    @patch("llm.tools.lookup_generation", return_value=CACHED_ROW)
+    @patch("llm.tools.copy_generated_image", return_value={"success": False, "error": "NoSuchKey"})
+    @patch("llm.tools.forget_generation")
+    @patch("llm.tools.replicate.async_run", new_callable=AsyncMock, return_value="https://replicate.delivery/out.png")
+    @patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+    @patch("llm.tools.get_async_http_client", side_effect=_stub_async_client)
+    def test_stale_entry_is_dropped_and_regenerated(
+        self, mock_client, mock_upload, mock_run, mock_forget, mock_copy, mock_lookup, mock_store_cache, mock_reserve, mock_refund, mock_store
+    ):
+        """Test that an entry whose image is gone is forgotten and the async path generates again."""
+        result = asyncio.run(_agenerate_image_core(**GENERATION_ARGS))
+
+        assert "Image generated successfully" in result
+        mock_forget.assert_called_once_with(mock_lookup.call_args[0][0])
+        mock_run.assert_awaited_once()
+        mock_store_cache.assert_called_once()
+
+    @patch("llm.tools.lookup_generation", side_effect=Exception("database is down"))
+    @patch("llm.tools.replicate.run", return_value=None)
+    def test_lookup_failure_is_a_miss(self, mock_run, mock_lookup, mock_store_cache, mock_reserve, mock_refund, mock_store):
+        """Test that the cache being unavailable doesn't stop a generation."""
+        _generate_image_core(**GENERATION_ARGS)
+
+        mock_run.assert_called_once()
+
+
+EDIT_ARGS = {
+    "user_id": "test_user",
+    "image_url": "https://example.com/in.png",
+    "operations": [{"op": "rotate", "degrees": 90}, {"op": "grayscale"}],
+    "title": "Rotated",
+}
+
+
+@patch.dict("os.environ", {"IMAGE_VARIANTS": ""})
+@patch("llm.tools.store_tool_result")
+@patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+@patch("llm.tools.refund_ip_generation")
+@patch("llm.tools.reserve_ip_generation")
+@patch("llm.tools.fetch_image", return_value=b"source-bytes")
+class TestEditImageCore:
+    """Test cases for the local edit_image tool core."""
+
+    @patch("llm.tools.apply_edits", return_value=(b"edited-bytes", "image/jpeg"))
+    def test_edit_image_success(self, mock_apply, mock_fetch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that the edit is uploaded and stored without touching the generation limit."""
+        result = _edit_image_core(**EDIT_ARGS, output_format="jpeg")
+
+        assert "Image edited successfully" in result
+        mock_apply.assert_called_once_with(b"source-bytes", EDIT_ARGS["operations"], "jpeg")
+        args, kwargs = mock_upload.call_args
+        assert args[0] == b"edited-bytes"
+        assert kwargs["content_type"] == "image/jpeg"
+        assert mock_store.call_args[0][1] == "edit_image"
+        assert mock_store.call_args[0][2]["prompt"] == "rotate (degrees=90), grayscale"
+        mock_reserve.assert_not_called()
+        mock_refund.assert_not_called()
+
+    def test_invalid_edit_is_reported(self, mock_fetch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that an invalid operation is explained to the model and nothing is saved."""
+        source = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(source, format="PNG")
+        mock_fetch.return_value = source.getvalue()
+
+        result = _edit_image_core(**{**EDIT_ARGS, "operations": [{"op": "resize"}]})
+
+        assert result.startswith("Could not apply the edit: resize needs a width or a height")
+        mock_upload.assert_not_called()
+        mock_store.assert_not_called()
+
+    @patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+    @patch("llm.images.get_http_session")
+    def test_urls_outside_the_users_images_are_refused(self, mock_session, mock_fetch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that an image_url other than one of the user's own images is never fetched."""
+        mock_fetch.side_effect = fetch_image
+        for url in ("http://169.254.169.254/latest/meta-data/", "https://test-bucket.s3.amazonaws.com/users/someone_else/images/1"):
+            result = _edit_image_core(**{**EDIT_ARGS, "image_url": url})
+
+            assert result == "Could not apply the edit: image_url must be one of the user's images"
+        mock_session.assert_not_called()
+        mock_upload.assert_not_called()
+
+    @patch("llm.tools.apply_edits", return_value=(b"edited-bytes", "image/png"))
+    def test_async_callable_drops_unset_parameters(self, mock_apply, mock_fetch, mock_reserve, mock_refund, mock_upload, mock_store):
+        """Test that the ainvoke path validates inputs and passes only the parameters the model set."""
+        inputs = {**EDIT_ARGS, "operations": [{"op": "flip", "direction": "vertical"}]}
+
+        result = asyncio.run(_aedit_image_callable(inputs, config={}))
+
+        assert "Image edited successfully" in result
+        assert mock_apply.call_args[0][1] == [{"op": "flip", "direction": "vertical"}]
+        assert mock_upload.call_args[1]["content_type"] == "image/png"
+
+
+class _LazyImageHandler(BaseHTTPRequestHandler):
+    """Serves /<size> bytes, written in small chunks so the server holds little memory."""
+
+    def do_GET(self):
+        size = int(self.path.strip("/"))
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = b"\x89" * 65536
+        for offset in range(0, size, len(chunk)):
+            self.wfile.write(chunk[: size - offset])
+
+    def log_message(self, *args):
+        pass
+
+
+class _DiscardingS3:
+    """botocore before-send hook answering S3 upload calls without storing the bodies."""
+
+    def __init__(self):
+        self.bytes_received = 0
+        self.parts = 0
+
+    def __call__(self, request, **kwargs):
+        from botocore.awsrequest import AWSResponse
+
+        body = request.body
+        size = len(body) if isinstance(body, (bytes, bytearray)) else len(body.read()) if body else 0
+        query = request.url.split("?", 1)[1] if "?" in request.url else ""
+        if request.method == "POST" and "uploads" in query:
+            content = b"<InitiateMultipartUploadResult><Bucket>b</Bucket><Key>k</Key><UploadId>upload-1</UploadId></InitiateMultipartUploadResult>"
+        elif request.method == "POST":
+            content = b"<CompleteMultipartUploadResult><Bucket>b</Bucket><Key>k</Key><ETag>&quot;e&quot;</ETag></CompleteMultipartUploadResult>"
+        else:
+            self.parts += request.method == "PUT"
+            # Newer botocore sends parts aws-chunked with a trailing checksum
+            self.bytes_received += int(request.headers.get("x-amz-decoded-content-length", size))
+            content = b""
+        raw = Mock(stream=lambda: iter([content]))
+        return AWSResponse(request.url, 200, {"ETag": '"etag"'}, raw)
+
+
+@pytest.mark.slow
+@patch.dict(
+    "os.environ",
+    {
+        "AWS_ACCESS_KEY_ID": "AKIDEXAMPLE",
+        "AWS_SECRET_ACCESS_KEY": "secret",
+        "AWS_S3_BUCKET_NAME": "test-bucket",
+        "S3_MULTIPART_CHUNK_MB": "5",
+        "S3_UPLOAD_CONCURRENCY": "2",
+        "IMAGE_INPUT_PREPROCESS": "false",
+        "IMAGE_VARIANTS": "",
+        "GENERATION_CACHE_ENABLED": "false",
+        "QUOTA_CACHE_ENABLED": "false",
+    },
+)
+@patch("llm.tools.store_tool_result")
+@patch("llm.tools.refund_ip_generation", return_value=True)
+@patch("llm.tools.reserve_ip_generation", return_value=WEEK)
+class TestStreamingMemory:
+    """Peak memory of the download-to-S3 pipeline stays flat as the image grows."""
+
+    SMALL = 24 * 1024 * 1024
+    LARGE = 96 * 1024 * 1024
+
+    @pytest.fixture(autouse=True)
+    def image_server(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _LazyImageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{server.server_port}"
+        reset_s3_client()
+        yield
+        server.shutdown()
+        reset_s3_client()
+
+    def _measure(self, generate, size):
+        """Run one generation of the given size and return (tracemalloc peak, hook)."""
+        s3 = _DiscardingS3()
+        # The client is created outside the measurement, like the long-lived shared client
+        reset_s3_client()
+        get_s3_client().meta.events.register("before-send.s3", s3)
+
+        tracemalloc.start()
+        try:
+            result = generate(f"{self.base_url}/{size}")
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert result["success"] is True, result
+        assert s3.bytes_received == size
+        assert s3.parts == -(-size // (5 * 1024 * 1024))
+        return peak
+
+    def _assert_flat(self, generate, label):
+        small = self._measure(generate, self.SMALL)
+        large = self._measure(generate, self.LARGE)
+        print(f"\n[BENCH] {label} peak memory: {small / 2**20:.1f} MB for {self.SMALL >> 20} MB, {large / 2**20:.1f} MB for {self.LARGE >> 20} MB")
+        assert large < self.LARGE / 2
+        assert large < small * 1.5
+
+    def test_sync_pipeline_memory_is_bounded(self, mock_reserve, mock_refund, mock_store):
+        """Test that requests streaming into upload_fileobj keeps a few parts in memory."""
+
+        def generate(url):
+            with patch("llm.tools.replicate.run", return_value=url):
+                return _run_generation(**GENERATION_ARGS)
+
+        self._assert_flat(generate, "sync")
+
+    def test_variants_keep_memory_bounded(self, mock_reserve, mock_refund, mock_store):
+        """Test that the copy kept for the default variants doesn't hold the image in memory."""
+
+        def generate(url):
+            with patch("llm.tools.replicate.run", return_value=url):
+                return _run_generation(**GENERATION_ARGS)
+
+        with patch.dict("os.environ", {"IMAGE_VARIANTS": "webp,thumb"}):
+            # Both sizes are under IMAGE_VARIANT_MAX_BYTES, so both are copied for their variants
+            with patch("llm.tools.VARIANT_MAX_SOURCE_BYTES", self.LARGE + 1):
+                self._assert_flat(generate, "sync with variants")
+
+    def test_async_pipeline_memory_is_bounded(self, mock_reserve, mock_refund, mock_store):
+        """Test that the async download feeding the upload through a ChunkPipe keeps a few chunks in memory."""
+
+        def generate(url):
+            return asyncio.run(_astream_to_storage(url, "test_user", "A sunset", "Sunset"))
+
+        self._assert_flat(generate, "async")
+
+
+@pytest.fixture
+def quota_ip():
+    """A unique client IP whose rate_limits rows are removed after the test."""
+    client_ip = f"test-{uuid.uuid4().hex[:12]}"
+    yield client_ip
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM rate_limits WHERE ip_address = %s", (client_ip,))
+
+
+def _saved_response(*args, **kwargs):
+    return MagicMock(raw=io.BytesIO(b"png-bytes"))
+
+
+@pytest.fixture(params=[False, True], ids=["direct", "quota-cache"])
+def quota_cache(request):
+    """Run the test reserving straight from rate_limits, then through a fresh quota cache."""
+    cache = QuotaCache(lease_size=5) if request.param else None
+    with patch.dict("os.environ", {"QUOTA_CACHE_ENABLED": str(request.param).lower()}), patch("llm.tools.get_quota_cache", return_value=cache):
+        yield cache
+
+
+@pytest.mark.database
+@patch.dict("os.environ", {"IMAGE_INPUT_PREPROCESS": "false", "IMAGE_VARIANTS": "", "GENERATION_CACHE_ENABLED": "false"})
+@patch("llm.tools.store_tool_result")
+@patch("llm.tools.upload_generated_image_to_s3", return_value={"success": True})
+@patch("llm.tools.get_http_session")
+class TestGenerationQuota:
+    """The weekly limit is reserved atomically in rate_limits."""
+
+    PARALLEL = 50
+
+    def _generate(self, client_ip, n):
+        # A distinct prompt per call, so identical generations aren't coalesced
+        return _generate_image_core(**{**GENERATION_ARGS, "prompt": f"A sunset #{n}", "client_ip": client_ip})
+
+    def _count(self, client_ip, cache):
+        """The IP's count once the cache, if any, has returned what it holds."""
+        if cache is not None:
+            cache.flush(everything=True)
+        return get_ip_generation_count(client_ip)
+
+    @patch("llm.tools.replicate.run", return_value="https://replicate.delivery/out.png")
+    def test_parallel_generations_stop_at_the_limit(self, mock_run, mock_session, mock_upload, mock_store, quota_ip, quota_cache):
+        """Test that of 50 parallel generations from one IP exactly 10 run, with no overshoot."""
+        mock_session.return_value.get.side_effect = _saved_response
+
+        with ThreadPoolExecutor(max_workers=self.PARALLEL) as executor:
+            results = list(executor.map(lambda n: self._generate(quota_ip, n), range(self.PARALLEL)))
+
+        assert sum("Image generated successfully" in result for result in results) == 10
+        assert sum("max generation limit of 10" in result for result in results) == self.PARALLEL - 10
+        assert mock_run.call_count == 10
+        assert self._count(quota_ip, quota_cache) == 10
+        if quota_cache is not None:
+            # Leases of 5, 3, 1 and 1, each at most half of what was left, and one refused;
+            # the other 40 were turned away from memory
+            assert quota_cache.get_stats()["leases"] == 5
+
+    @patch("llm.tools.replicate.run")
+    def test_failed_generations_are_refunded(self, mock_run, mock_session, mock_upload, mock_store, quota_ip, quota_cache):
+        """Test that generations without an image give their reservation back."""
+        mock_session.return_value.get.side_effect = _saved_response
+        mock_run.return_value = None
+        for n in range(3):
+            assert self._generate(quota_ip, n) == "Failed to generate image. Please try again."
+        assert self._count(quota_ip, quota_cache) == 0
+
+        mock_run.return_value = "https://replicate.delivery/out.png"
+        results = [self._generate(quota_ip, n) for n in range(11)]
+
+        assert all("Image generated successfully" in result for result in results[:10])
+        assert "max generation limit of 10" in results[10]
+        assert self._count(quota_ip, quota_cache) == 10
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
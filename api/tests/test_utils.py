@@ -6,13 +6,21 @@ import pytest
 with patch("langgraph.checkpoint.postgres.PostgresSaver"):
     with patch("llm.connection_manager.get_checkpointer"):
         with patch("llm.connection_manager._test_connection", return_value=True):
-            from llm.utils import upload_generated_image_to_s3
+            from llm.storage import reset_s3_client
+            from llm.utils import copy_generated_image, upload_generated_image_to_s3, upload_image_variants
 
 
 class TestS3Utils:
     """Test cases for S3 utility functions."""
 
-    @patch("llm.utils.boto3.client")
+    @pytest.fixture(autouse=True)
+    def fresh_s3_client(self):
+        """Each test patches boto3.client, so don't reuse a client cached by an earlier test."""
+        reset_s3_client()
+        yield
+        reset_s3_client()
+
+    @patch("llm.storage.boto3.client")
     @patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
     def test_upload_generated_image_success(self, mock_boto3_client):
         """Test successful image upload to S3."""
@@ -45,7 +53,7 @@ class TestS3Utils:
         assert put_call[1]["Body"] == b"fake_image_data"
         assert put_call[1]["ContentType"] == "image/png"
 
-    @patch("llm.utils.boto3.client")
+    @patch("llm.storage.boto3.client")
     def test_upload_generated_image_missing_bucket(self, mock_boto3_client):
         """Test upload when S3 bucket name is not set."""
         with patch.dict("os.environ", {}, clear=True):
@@ -54,7 +62,7 @@ class TestS3Utils:
             assert result["success"] is False
             assert "AWS_S3_BUCKET_NAME environment variable is not set" in result["error"]
 
-    @patch("llm.utils.boto3.client")
+    @patch("llm.storage.boto3.client")
     def test_upload_generated_image_s3_error(self, mock_boto3_client):
         """Test upload when S3 operations fail."""
         mock_s3_client = Mock()
@@ -66,7 +74,7 @@ class TestS3Utils:
         assert result["success"] is False
         assert "S3 upload failed" in result["error"]
 
-    @patch("llm.utils.boto3.client")
+    @patch("llm.storage.boto3.client")
     def test_upload_generated_image_default_title(self, mock_boto3_client):
         """Test upload with default title when none provided."""
         mock_s3_client = Mock()
@@ -81,6 +89,51 @@ class TestS3Utils:
         metadata = put_call[1]["Metadata"]
         assert metadata["title"] == "Generated Image"
 
+    @patch("llm.storage.boto3.client")
+    @patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+    def test_upload_image_variants(self, mock_boto3_client):
+        """Test that variants are stored next to the original and a failed one is skipped."""
+        mock_s3_client = mock_boto3_client.return_value
+        mock_s3_client.put_object.side_effect = [None, Exception("SlowDown")]
+
+        stored = upload_image_variants("test_user", "test-uuid-123", {"webp": (b"webp", "image/webp"), "thumb": (b"thumb", "image/webp")})
+
+        assert stored == ["webp"]
+        first = mock_s3_client.put_object.call_args_list[0][1]
+        assert first["Key"] == "users/test_user/images/test-uuid-123.webp"
+        assert first["ContentType"] == "image/webp"
+        assert mock_s3_client.put_object.call_args_list[1][1]["Key"] == "users/test_user/images/test-uuid-123.thumb"
+
+    @patch("llm.storage.boto3.client")
+    @patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+    def test_copy_generated_image(self, mock_boto3_client):
+        """Test that the image and its variants are copied inside S3 with the new owner's metadata."""
+        mock_s3_client = mock_boto3_client.return_value
+        mock_s3_client.copy_object.side_effect = [None, None, Exception("NoSuchKey")]
+
+        result = copy_generated_image("owner", "img-1", "test_user", "img-2", "A sunset", "Sunset", ["webp", "thumb"])
+
+        assert result == {"success": True, "image_id": "img-2", "variants": ["webp"]}
+        original, webp = (call[1] for call in mock_s3_client.copy_object.call_args_list[:2])
+        assert original["CopySource"] == {"Bucket": "test-bucket", "Key": "users/owner/images/img-1"}
+        assert original["Key"] == "users/test_user/images/img-2"
+        assert original["MetadataDirective"] == "REPLACE"
+        assert (original["Metadata"]["userId"], original["Metadata"]["title"]) == ("test_user", "Sunset")
+        assert webp["Key"] == "users/test_user/images/img-2.webp"
+        assert webp["ContentType"] == "image/webp"
+        mock_s3_client.put_object.assert_not_called()
+
+    @patch("llm.storage.boto3.client")
+    @patch.dict("os.environ", {"AWS_S3_BUCKET_NAME": "test-bucket"})
+    def test_copy_generated_image_missing_source(self, mock_boto3_client):
+        """Test that a source image that is gone fails the copy."""
+        mock_boto3_client.return_value.copy_object.side_effect = Exception("NoSuchKey")
+
+        result = copy_generated_image("owner", "img-1", "test_user", "img-2", "A sunset", "Sunset", ["webp"])
+
+        assert result["success"] is False
+        assert "NoSuchKey" in result["error"]
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,121 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+from dotenv import load_dotenv
+
+# Mock dependencies before importing
+with patch("langgraph.checkpoint.postgres.PostgresSaver"):
+    with patch("llm.connection_manager.get_checkpointer"):
+        with patch("llm.connection_manager._test_connection", return_value=True):
+            from llm import job_queue
+            from llm.connection_manager import get_db_connection
+            from llm.worker import process_job
+
+load_dotenv()
+
+TEST_USER_PREFIX = "worker-test-"
+
+
+@pytest.fixture
+def test_user():
+    """A unique user id whose queued jobs are removed after the test."""
+    user_id = f"{TEST_USER_PREFIX}{uuid.uuid4().hex[:8]}"
+    yield user_id
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM generation_jobs WHERE user_id = %s", (user_id,))
+
+
+def _enqueue(user_id, **kwargs):
+    return job_queue.enqueue_generation("A sunset", user_id, "https://example.com/in.png", "Sunset", "127.0.0.1", **kwargs)
+
+
+def _claim_own(user_id, worker_id, **kwargs):
+    """Claim until one of the user's jobs comes up, so stray rows from other tests don't interfere."""
+    for _ in range(50):
+        job = job_queue.claim_job(worker_id, **kwargs)
+        if job is None or job["user_id"] == user_id:
+            return job
+    return None
+
+
+SUCCESS = {
+    "success": True,
+    "message": "Image generated successfully!",
+    "image_id": "img-1",
+    "title": "Sunset",
+    "prompt": "A sunset",
+    "variants": ["webp", "thumb"],
+}
+
+
+@pytest.mark.database
+class TestGenerationQueue:
+    """Test cases for the Postgres-backed generation queue and worker."""
+
+    def test_concurrent_claims_get_distinct_jobs(self, test_user):
+        """Test that SKIP LOCKED hands each concurrent worker a different job."""
+        enqueued = {_enqueue(test_user)["id"] for _ in range(5)}
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            claimed = list(executor.map(lambda i: _claim_own(test_user, f"worker-{i}"), range(5)))
+
+        assert {job["id"] for job in claimed} == enqueued
+        assert all(job["status"] == "running" and job["attempts"] == 1 for job in claimed)
+
+    @patch("llm.worker._run_generation", return_value=SUCCESS)
+    def test_worker_completes_job(self, mock_run, test_user):
+        """Test that a processed job stores its result and reads back as succeeded."""
+        job_id = _enqueue(test_user)["id"]
+
+        assert process_job(_claim_own(test_user, "worker-a"), "worker-a") == "succeeded"
+
+        snapshot = job_queue.to_job_snapshot(job_queue.get_queued_job(str(job_id)))
+        assert snapshot["status"] == "succeeded"
+        assert snapshot["image"] == {"image_id": "img-1", "title": "Sunset", "prompt": "A sunset", "variants": ["webp", "thumb"]}
+        assert job_queue.list_queued_user_jobs(test_user)[0]["id"] == job_id
+        mock_run.assert_called_once_with("A sunset", test_user, "https://example.com/in.png", "Sunset", "127.0.0.1", False)
+
+    @patch("llm.worker._run_generation", return_value={"success": False, "message": "Failed to generate image. Please try again."})
+    def test_failed_job_is_retried_then_dead_lettered(self, mock_run, test_user):
+        """Test that failures are retried with backoff until max_attempts, then dead-lettered."""
+        job_id = _enqueue(test_user, max_attempts=2)["id"]
+
+        with patch.object(job_queue, "_retry_backoff", 0):
+            assert process_job(_claim_own(test_user, "worker-a"), "worker-a") == "queued"
+            assert process_job(_claim_own(test_user, "worker-a"), "worker-a") == "dead"
+
+        row = job_queue.get_queued_job(str(job_id))
+        assert row["attempts"] == 2
+        assert row["last_error"] == "Failed to generate image. Please try again."
+        assert job_queue.to_job_snapshot(row)["status"] == "failed"
+        assert _claim_own(test_user, "worker-a") is None
+
+    @patch.dict("os.environ", {"QUOTA_CACHE_ENABLED": "false"})
+    @patch("llm.tools.replicate.run")
+    @patch("llm.tools.reserve_ip_generation", return_value=None)
+    def test_quota_failure_is_not_retried(self, mock_reserve, mock_run, test_user):
+        """Test that a job refused a generation by the weekly limit fails without retries."""
+        job_id = _enqueue(test_user)["id"]
+
+        assert process_job(_claim_own(test_user, "worker-a"), "worker-a") == "failed"
+        assert job_queue.get_queued_job(str(job_id))["last_error"] == "Failed as user exceeded the max generation limit of 10 this week."
+        mock_run.assert_not_called()
+
+    def test_expired_visibility_timeout_is_reclaimed(self, test_user):
+        """Test that a job whose worker stopped heartbeating is claimed again, fencing the old worker."""
+        job_id = _enqueue(test_user)["id"]
+        first = _claim_own(test_user, "worker-a", visibility_timeout=1)
+        assert _claim_own(test_user, "worker-b") is None
+
+        time.sleep(1.2)
+        second = _claim_own(test_user, "worker-b")
+
+        assert second["id"] == first["id"] == job_id
+        assert second["attempts"] == 2
+        # The first worker no longer holds the job, so its late result is dropped
+        assert job_queue.complete_job(job_id, "worker-a", SUCCESS) is False
+        assert job_queue.extend_lock(job_id, "worker-a") is False
+        assert job_queue.complete_job(job_id, "worker-b", SUCCESS) is True
@@ -1,5 +1,9 @@
 import { describe, it, expect, vi, afterEach } from "vitest";
-import { downloadImage } from "./actions";
+import { downloadImage, sendChatMessage } from "./actions";
+
+vi.mock("next/headers", () => ({
+  headers: async () => new Headers({ "x-forwarded-for": "203.0.113.7" }),
+}));
 
 describe("downloadImage", () => {
   afterEach(() => {
@@ -28,3 +32,54 @@ describe("downloadImage", () => {
     expect(result.error).toBeDefined();
   });
 });
+
+describe("sendChatMessage", () => {
+  afterEach(() => {
+    vi.restoreAllMocks();
+  });
+
+  it("retries with the same Idempotency-Key after a network error", async () => {
+    const fetchMock = vi
+      .spyOn(global, "fetch")
+      .mockRejectedValueOnce(new TypeError("fetch failed"))
+      .mockResolvedValueOnce(
+        new Response(JSON.stringify({ response: "Hi!", status: "success" }), {
+          status: 200,
+        }),
+      );
+
+    const result = await sendChatMessage({
+      message: "Hello",
+      selected_images: [],
+      user_id: "test_user",
+    });
+
+    expect(result.response).toBe("Hi!");
+    expect(fetchMock).toHaveBeenCalledTimes(2);
+    const keys = fetchMock.mock.calls.map(
+      ([, init]) =>
+        (init?.headers as Record<string, string>)["Idempotency-Key"],
+    );
+    expect(keys[0]).toBeTruthy();
+    expect(keys[1]).toBe(keys[0]);
+  });
+
+  it("asks the user to slow down when rate limited", async () => {
+    const fetchMock = vi.spyOn(global, "fetch").mockResolvedValue(
+      new Response(JSON.stringify({ detail: "Too many messages" }), {
+        status: 429,
+        headers: { "Retry-After": "7" },
+      }),
+    );
+
+    const result = await sendChatMessage({
+      message: "Hello",
+      selected_images: [],
+      user_id: "test_user",
+    });
+
+    expect(result.status).toBe("error");
+    expect(result.response).toContain("7 seconds");
+    expect(fetchMock).toHaveBeenCalledTimes(1);
+  });
+});
@@ -8,6 +8,7 @@ import {
 import { getSignedUrl } from "@aws-sdk/s3-request-presigner";
 import type { GeneratedImage } from "./types";
 import { headers } from "next/headers";
+import { randomUUID } from "crypto";
 
 interface ChatRequest {
   message: string;
@@ -61,16 +62,38 @@ export async function sendChatMessage(
 
     const client_ip = raw.split(",")[0]?.trim() || "unknown";
 
-    const response = await fetch(`${HF_API_URL}/chat`, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({
-        ...request,
-        client_ip: client_ip,
-      }),
-    });
+    // One key per message: a retry with the same key gets the first reply
+    // replayed instead of running the agent turn (and any generation) again
+    const idempotencyKey = randomUUID();
+    const send = () =>
+      fetch(`${HF_API_URL}/chat`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          "Idempotency-Key": idempotencyKey,
+        },
+        body: JSON.stringify({
+          ...request,
+          client_ip: client_ip,
+        }),
+      });
+
+    let response: Response;
+    try {
+      response = await send();
+    } catch {
+      response = await send();
+    }
+    if ([502, 503, 504].includes(response.status)) {
+      response = await send();
+    }
+    if (response.status === 429) {
+      const retryAfter = response.headers.get("Retry-After") || "a few";
+      return {
+        response: `You're sending messages too quickly. Please wait ${retryAfter} seconds and try again.`,
+        status: "error",
+      };
+    }
 
     if (!response.ok) {
       throw new Error(`HTTP error! status: ${response.status}`);